@@ -0,0 +1,88 @@
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class TTLCache:
+    """Size bounded LRU mapping whose entries expire ttl seconds after they are stored.
+    Not thread safe, it is meant to be used from the event loop."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: Hashable, value: Any):
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"size": len(self), "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0}
+
+
+class CacheBackend(ABC):
+    """What the app caches through. Async so a shared backend, e.g. redis, can implement it over the network."""
+
+    @abstractmethod
+    async def get(self, key: Hashable) -> Optional[Any]:
+        pass
+
+    @abstractmethod
+    async def set(self, key: Hashable, value: Any):
+        pass
+
+    @abstractmethod
+    async def invalidate(self, key: Hashable):
+        pass
+
+    @abstractmethod
+    def stats(self) -> dict:
+        pass
+
+
+class LocalCache(CacheBackend):
+    """In-process backend, each worker holds its own TTLCache."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.cache = TTLCache(maxsize, ttl)
+
+    async def get(self, key: Hashable) -> Optional[Any]:
+        return self.cache.get(key)
+
+    async def set(self, key: Hashable, value: Any):
+        self.cache.set(key, value)
+
+    async def invalidate(self, key: Hashable):
+        self.cache.invalidate(key)
+
+    def stats(self) -> dict:
+        return self.cache.stats()
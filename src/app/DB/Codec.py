@@ -0,0 +1,339 @@
+"""Stores events in the compact form of app.Models.Compact while routes keep using the NewEventInDB shape.
+
+EVENT_STORAGE picks the stored form, moved through in order with a migration between each step:
+
+    legacy   long keys, no translation
+    dual     reads long keys, writes both forms; then `python -m app.DB.Migrations compact`
+    compact  reads and writes short keys only; then `python -m app.DB.Migrations compact_cleanup`
+
+Going back to legacy is safe until compact is switched on.
+"""
+import os
+from typing import Any, Dict, List, Optional
+
+import pymongo
+from pymongo import IndexModel
+
+from ..Models.Compact import FIELDS, encode_event, decode_event, encode_value, storage_path
+
+EVENT_STORAGE = os.getenv('EVENT_STORAGE', 'legacy')
+COLLECTIONS = ('events',)
+# Whether the events text index is on the stored short keys. In dual mode it moves there with
+# Migrations.compact_events, detect_text_index reads which at startup.
+compact_text_index = EVENT_STORAGE == 'compact'
+
+LOGICAL_OPERATORS = ('$and', '$or', '$nor')
+# Operators whose operand is compared with the field's value, as opposed to $exists, $regex, $size...
+VALUE_OPERATORS = ('$eq', '$ne', '$gt', '$gte', '$lt', '$lte')
+LIST_OPERATORS = ('$in', '$nin', '$all')
+
+
+def _condition(path: str, condition: Any) -> Any:
+    if isinstance(condition, dict) and condition and all(key.startswith('$') for key in condition):
+        return {operator: [encode_value(path, item) for item in operand] if operator in LIST_OPERATORS
+                else encode_value(path, operand) if operator in VALUE_OPERATORS else operand
+                for operator, operand in condition.items()}
+    return encode_value(path, condition)
+
+
+def translate_filter(query: Optional[dict]) -> Optional[dict]:
+    if not query:
+        return query
+    translated = {}
+    for key, condition in query.items():
+        if key in LOGICAL_OPERATORS:
+            translated[key] = [translate_filter(part) for part in condition]
+        elif key.startswith('$'):
+            # $text searches whichever fields the text index covers, $expr is left to the caller
+            translated[key] = condition
+        else:
+            translated[storage_path(key)] = _condition(key, condition)
+    return translated
+
+
+def translate_update(update: Any) -> Any:
+    if isinstance(update, list):
+        # Aggregation pipeline updates already name stored fields
+        return update
+    translated = {}
+    for operator, fields in update.items():
+        if operator in ('$push', '$addToSet'):
+            translated[operator] = {
+                storage_path(path): {'$each': [encode_value(path, item) for item in value['$each']]}
+                if isinstance(value, dict) and '$each' in value else encode_value(path, value)
+                for path, value in fields.items()}
+        elif operator in ('$set', '$setOnInsert', '$pull'):
+            translated[operator] = {storage_path(path): encode_value(path, value) for path, value in fields.items()}
+        else:
+            translated[operator] = {storage_path(path): value for path, value in fields.items()}
+    return translated
+
+
+def translate_projection(projection: Any) -> Any:
+    if isinstance(projection, dict):
+        return {storage_path(path): value for path, value in projection.items()}
+    if projection is not None:
+        return [storage_path(path) for path in projection]
+    return projection
+
+
+def translate_sort(sort: Any) -> Any:
+    if isinstance(sort, list):
+        return [(storage_path(path), direction) for path, direction in sort]
+    return sort
+
+
+def _merge(update: dict, other: dict) -> dict:
+    merged = {operator: dict(fields) for operator, fields in update.items()}
+    for operator, fields in other.items():
+        merged.setdefault(operator, {}).update(fields)
+    return merged
+
+
+def _is_text(index: IndexModel) -> bool:
+    return 'text' in dict(index.document['key']).values()
+
+
+def storage_indexes(indexes: List[IndexModel], mode: Optional[str] = None,
+                    compact_text: Optional[bool] = None) -> List[IndexModel]:
+    """The indexes to keep in mode, EVENT_STORAGE by default. Dual mode keeps both sets but one text index, as a
+    collection holds one at most: on the long keys until Migrations.compact_events moves it, compact_text after."""
+    compact = []
+    for index in indexes:
+        document = dict(index.document)
+        keys = [(storage_path(path), direction) for path, direction in document.pop('key').items()]
+        if 'weights' in document:
+            document['weights'] = {storage_path(path): weight for path, weight in document['weights'].items()}
+        if 'partialFilterExpression' in document:
+            document['partialFilterExpression'] = translate_filter(document['partialFilterExpression'])
+        document['name'] = f"compact_{document['name']}"
+        compact.append(IndexModel(keys, **document))
+    mode = mode or EVENT_STORAGE
+    if mode == 'compact':
+        return compact
+    if mode == 'dual':
+        compact_text = compact_text_index if compact_text is None else compact_text
+        return ([index for index in indexes if not (compact_text and _is_text(index))]
+                + [index for index in compact if compact_text or not _is_text(index)])
+    return indexes
+
+
+async def detect_text_index(collection) -> bool:
+    """Reads whether the stored collection's text index is on the short keys into compact_text_index. Only dual
+    mode can have either, a worker keeps what it read at startup until restarted."""
+    global compact_text_index
+    if EVENT_STORAGE == 'dual':
+        compact_text_index = any(name.startswith('compact_') and 'text' in dict(info['key']).values()
+                                 for name, info in (await collection.index_information()).items())
+    return compact_text_index
+
+
+# bulk_write requests on events. They are pymongo's, which keeps its arguments in private fields, with the
+# arguments kept where CodecCollection can translate them.
+
+class InsertOne(pymongo.InsertOne):
+    def __init__(self, document: dict):
+        super().__init__(document)
+        self.document = document
+
+    def translated(self, codec: 'CodecCollection') -> pymongo.InsertOne:
+        return pymongo.InsertOne(codec._document(self.document))
+
+
+class UpdateOne(pymongo.UpdateOne):
+    def __init__(self, filter: dict, update: Any, upsert: bool = False):
+        super().__init__(filter, update, upsert)
+        self.filter, self.update, self.upsert = filter, update, upsert
+
+    def translated(self, codec: 'CodecCollection') -> pymongo.UpdateOne:
+        return pymongo.UpdateOne(codec._filter(self.filter), codec._update(self.update), self.upsert)
+
+
+class UpdateMany(pymongo.UpdateMany):
+    def __init__(self, filter: dict, update: Any, upsert: bool = False):
+        super().__init__(filter, update, upsert)
+        self.filter, self.update, self.upsert = filter, update, upsert
+
+    def translated(self, codec: 'CodecCollection') -> pymongo.UpdateMany:
+        return pymongo.UpdateMany(codec._filter(self.filter), codec._update(self.update), self.upsert)
+
+
+class ReplaceOne(pymongo.ReplaceOne):
+    def __init__(self, filter: dict, replacement: dict, upsert: bool = False):
+        super().__init__(filter, replacement, upsert)
+        self.filter, self.replacement, self.upsert = filter, replacement, upsert
+
+    def translated(self, codec: 'CodecCollection') -> pymongo.ReplaceOne:
+        return pymongo.ReplaceOne(codec._filter(self.filter), codec._document(self.replacement), self.upsert)
+
+
+class DeleteOne(pymongo.DeleteOne):
+    def __init__(self, filter: dict):
+        super().__init__(filter)
+        self.filter = filter
+
+    def translated(self, codec: 'CodecCollection') -> pymongo.DeleteOne:
+        return pymongo.DeleteOne(codec._filter(self.filter))
+
+
+class DeleteMany(pymongo.DeleteMany):
+    def __init__(self, filter: dict):
+        super().__init__(filter)
+        self.filter = filter
+
+    def translated(self, codec: 'CodecCollection') -> pymongo.DeleteMany:
+        return pymongo.DeleteMany(codec._filter(self.filter))
+
+
+class CodecCursor:
+    """Decodes what a cursor returns, everything else goes to the cursor."""
+
+    def __init__(self, cursor, decode):
+        self._cursor = cursor
+        self._decode = decode
+        self._iterator = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __aiter__(self):
+        self._iterator = self._cursor.__aiter__()
+        return self
+
+    async def __anext__(self):
+        return self._decode(await self._iterator.__anext__())
+
+    async def to_list(self, length: Optional[int]) -> List[dict]:
+        return [self._decode(document) for document in await self._cursor.to_list(length=length)]
+
+
+class CodecCollection:
+    """A motor collection of events taking and returning NewEventInDB shaped documents, filters, projections,
+    sorts and updates. Calls it does not translate, like aggregate and watch, go through unchanged and name
+    stored fields, see storage_path."""
+
+    def __init__(self, collection, mode: str):
+        self._collection = collection
+        self.mode = mode
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    # Translation of each argument kind for the mode
+
+    def _filter(self, query: Optional[dict]) -> Optional[dict]:
+        if self.mode == 'compact':
+            return translate_filter(query)
+        if compact_text_index and query and '$text' in query and 'owner_id' in query:
+            # Once Migrations.compact_events moved the text index to the short keys, which every event has then,
+            # its prefix is o
+            return {**query, 'o': query['owner_id']}
+        return query
+
+    def _update(self, update: Any) -> Any:
+        if self.mode == 'compact':
+            return translate_update(update)
+        if isinstance(update, list):
+            return update
+        return _merge(update, translate_update(update))
+
+    def _document(self, document: dict) -> dict:
+        if self.mode == 'compact':
+            return encode_event(document)
+        return {**document, **{key: value for key, value in encode_event(document).items() if key != '_id'}}
+
+    def _decode(self, document: Optional[dict]) -> Optional[dict]:
+        if document is None:
+            return None
+        if self.mode == 'compact':
+            return decode_event(document)
+        return {key: value for key, value in document.items() if key not in FIELDS}
+
+    def _options(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        if self.mode == 'compact':
+            if 'projection' in kwargs:
+                kwargs['projection'] = translate_projection(kwargs['projection'])
+            if 'sort' in kwargs:
+                kwargs['sort'] = translate_sort(kwargs['sort'])
+        return kwargs
+
+    def _projection(self, projection: Any) -> Any:
+        return translate_projection(projection) if self.mode == 'compact' else projection
+
+    def _request(self, request):
+        """Rebuilds one bulk_write request around translated arguments."""
+        if not hasattr(request, 'translated'):
+            raise TypeError(f"{type(request).__name__} on events: use the write requests of app.DB.Codec")
+        return request.translated(self)
+
+    # Collection methods
+
+    def find(self, filter=None, projection=None, *args, **kwargs) -> CodecCursor:
+        cursor = self._collection.find(self._filter(filter), self._projection(projection), *args,
+                                       **self._options(kwargs))
+        return CodecCursor(cursor, self._decode)
+
+    async def find_one(self, filter=None, *args, **kwargs) -> Optional[dict]:
+        if args:
+            args = (self._projection(args[0]),) + args[1:]
+        return self._decode(await self._collection.find_one(self._filter(filter), *args, **self._options(kwargs)))
+
+    async def find_one_and_update(self, filter, update, *args, **kwargs) -> Optional[dict]:
+        return self._decode(await self._collection.find_one_and_update(
+            self._filter(filter), self._update(update), *args, **self._options(kwargs)))
+
+    async def find_one_and_replace(self, filter, replacement, *args, **kwargs) -> Optional[dict]:
+        return self._decode(await self._collection.find_one_and_replace(
+            self._filter(filter), self._document(replacement), *args, **self._options(kwargs)))
+
+    async def find_one_and_delete(self, filter, *args, **kwargs) -> Optional[dict]:
+        return self._decode(await self._collection.find_one_and_delete(self._filter(filter), *args,
+                                                                       **self._options(kwargs)))
+
+    async def insert_one(self, document: dict, *args, **kwargs):
+        result = await self._collection.insert_one(self._document(document), *args, **kwargs)
+        # Callers rely on insert_one setting _id on the document they passed
+        document.setdefault('_id', result.inserted_id)
+        return result
+
+    async def insert_many(self, documents, *args, **kwargs):
+        documents = list(documents)
+        result = await self._collection.insert_many([self._document(document) for document in documents],
+                                                    *args, **kwargs)
+        for document, inserted_id in zip(documents, result.inserted_ids):
+            document.setdefault('_id', inserted_id)
+        return result
+
+    async def replace_one(self, filter, replacement, *args, **kwargs):
+        return await self._collection.replace_one(self._filter(filter), self._document(replacement), *args,
+                                                  **kwargs)
+
+    async def update_one(self, filter, update, *args, **kwargs):
+        return await self._collection.update_one(self._filter(filter), self._update(update), *args, **kwargs)
+
+    async def update_many(self, filter, update, *args, **kwargs):
+        return await self._collection.update_many(self._filter(filter), self._update(update), *args, **kwargs)
+
+    async def delete_one(self, filter, *args, **kwargs):
+        return await self._collection.delete_one(self._filter(filter), *args, **kwargs)
+
+    async def delete_many(self, filter, *args, **kwargs):
+        return await self._collection.delete_many(self._filter(filter), *args, **kwargs)
+
+    async def count_documents(self, filter, *args, **kwargs) -> int:
+        return await self._collection.count_documents(self._filter(filter), *args, **kwargs)
+
+    async def bulk_write(self, requests, *args, **kwargs):
+        return await self._collection.bulk_write([self._request(request) for request in requests], *args, **kwargs)
+
+
+def event_path(path: str) -> str:
+    """The stored path for aggregation pipelines, which CodecCollection passes through."""
+    return storage_path(path) if EVENT_STORAGE == 'compact' else path
+
+
+def codec_collection(collection_name: str, collection):
+    """Wraps the collections with a compact form while EVENT_STORAGE is not legacy."""
+    if EVENT_STORAGE == 'legacy' or collection_name not in COLLECTIONS:
+        return collection
+    return CodecCollection(collection, EVENT_STORAGE)
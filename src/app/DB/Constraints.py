@@ -0,0 +1,48 @@
+"""Constraints, one document each, kept apart from the events they are on."""
+from typing import Iterable
+
+from bson import ObjectId
+from pymongo import ReplaceOne
+
+from .DB import get_collection
+from ..Models.Constraint import ConstraintType
+
+COLLECTION = 'constraints'
+
+
+def constraint_document(owner_id: str, event_id: str, constraint: dict) -> dict:
+    """The stored form of a constraint on event_id. The event an EventStageConstraint waits on is kept as
+    prerequisite_id, event_id is always the constrained event."""
+    document = {key: value for key, value in constraint.items() if key not in ('id', '_id')}
+    if document.get('constraint_type') == ConstraintType.stage:
+        document['prerequisite_id'] = document.pop('event_id')
+    return {**document, '_id': ObjectId(constraint.get('id', constraint.get('_id'))),
+            'owner_id': owner_id, 'event_id': event_id}
+
+
+async def delete_event_constraints(owner_id: str, event_ids: Iterable[str]):
+    """Removes the constraints on deleted events, stage constraints waiting on them stay and keep blocking."""
+    event_ids = list(event_ids)
+    if event_ids:
+        await get_collection(COLLECTION).delete_many({'owner_id': owner_id, 'event_id': {'$in': event_ids}})
+
+
+async def migrate_embedded_constraints(batch_size: int = 1000) -> int:
+    """Moves constraints embedded in events to the constraints collection. Returns the number of events moved."""
+    events = get_collection('events')
+    migrated = 0
+    while True:
+        batch = await events.find({'constraints': {'$exists': True}}, {'owner_id': 1, 'constraints': 1},
+                                  limit=batch_size).to_list(length=batch_size)
+        if not batch:
+            return migrated
+        # Replacing by _id makes a pass interrupted before the $unset safe to re-run
+        requests = [ReplaceOne({'_id': document['_id']}, document, upsert=True)
+                    for event in batch for document in (
+                        constraint_document(event['owner_id'], str(event['_id']), constraint)
+                        for constraint in event['constraints'])]
+        if requests:
+            await get_collection(COLLECTION).bulk_write(requests, ordered=False)
+        await events.update_many({'_id': {'$in': [event['_id'] for event in batch]}}, {'$unset': {'constraints': ''}})
+        migrated += len(batch)
+        print(f"constraints: {migrated} events")
@@ -1,30 +1,75 @@
-from fastapi import HTTPException
-from pymongo import MongoClient
-from pymongo.collection import Collection
-from pymongo.errors import ConnectionFailure
-from starlette import status
+import os
+from typing import Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+from pymongo.errors import PyMongoError
+
+from .Codec import codec_collection
 
 MONGO_CONTAINER_NAME = 'mongo'
+MONGO_URI = os.getenv('MONGO_URI', f'mongodb://{MONGO_CONTAINER_NAME}:27017')
+MONGO_DATABASE = os.getenv('MONGO_DATABASE', 'reminder')
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', 100))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', 0))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', 5000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv('MONGO_SOCKET_TIMEOUT_MS', 30000))
+
+_client: Optional[AsyncIOMotorClient] = None
+
+
+def connect(client: Optional[AsyncIOMotorClient] = None, **options) -> AsyncIOMotorClient:
+    """Creates the process wide db client. Called once at app startup. A client passed in, e.g. an in-memory
+    stand-in for benchmarks, replaces it instead."""
+    global _client
+    if client is not None:
+        _client = client
+    elif _client is None:
+        settings = dict(maxPoolSize=MONGO_MAX_POOL_SIZE,
+                        minPoolSize=MONGO_MIN_POOL_SIZE,
+                        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                        connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                        socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS)
+        settings.update(options)
+        _client = AsyncIOMotorClient(MONGO_URI, **settings)
+    return _client
+
 
+def close():
+    """Closes the process wide db client and its connection pool."""
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
 
-def get_client() -> MongoClient:
-    """Creates the db client."""
-    client = MongoClient(MONGO_CONTAINER_NAME, 27017)
+
+def get_client() -> AsyncIOMotorClient:
+    """Returns the pooled db client, connecting on first use."""
+    if _client is None:
+        return connect()
+    return _client
+
+
+async def ping() -> bool:
+    """Checks the db answers, used by the health check."""
     try:
-        # Test the client is alive.
-        client.admin.command('ping')
-    except ConnectionFailure:
-        # Client is dead cannot service request
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
-    return client
+        await get_client().admin.command('ping')
+    except PyMongoError:
+        return False
+    return True
 
 
-def get_collection(collection_name: str) -> Collection:
-    database = get_client().get_database('reminder')
+def get_stored_collection(collection_name: str) -> AsyncIOMotorCollection:
+    """The collection as stored, without the codec get_collection adds. For migrations between stored forms."""
+    database = get_client().get_database(MONGO_DATABASE)
     collection = database.get_collection(collection_name)
     return collection
 
 
+def get_collection(collection_name: str) -> AsyncIOMotorCollection:
+    return codec_collection(collection_name, get_stored_collection(collection_name))
+
+
 if __name__ == "__main__":
     pass
     # print("test")
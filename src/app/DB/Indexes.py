@@ -0,0 +1,126 @@
+"""Indexes each collection needs, ensured at startup.
+
+Run `python -m app.DB.Indexes` from src/ to report missing, undeclared and
+unused indexes, or `python -m app.DB.Indexes --create` to build the missing ones.
+"""
+import argparse
+import asyncio
+import logging
+from typing import Dict, List
+
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from pymongo.errors import OperationFailure
+
+from .Codec import COLLECTIONS, detect_text_index, storage_indexes
+from .DB import get_collection, get_stored_collection
+from .Tombstones import TOMBSTONE_TTL_DAYS
+
+logger = logging.getLogger(__name__)
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    'events': [
+        # user_and_event_filter and the keyset pages of get_all_events, version covers If-None-Match lookups
+        IndexModel([('owner_id', ASCENDING), ('_id', ASCENDING), ('version', ASCENDING)], name='owner_id__id_version'),
+        IndexModel([('owner_id', ASCENDING), ('time_details.start_time', ASCENDING)], name='owner_id_start_time'),
+        # Time window queries, multikey on the months each event covers
+        IndexModel([('owner_id', ASCENDING), ('time_buckets', ASCENDING), ('time_details.start_time', ASCENDING)],
+                   name='owner_id_time_buckets_start_time'),
+        # Event search, the owner_id prefix keeps every text query within one user's events
+        IndexModel([('owner_id', ASCENDING), ('name', TEXT), ('description', TEXT), ('tags.tag', TEXT)],
+                   name='owner_id_text', weights={'name': 10, 'tags.tag': 5, 'description': 1}),
+        # Multikey, one entry per tag, _id keeps tag filtered pages in order
+        IndexModel([('owner_id', ASCENDING), ('tags.tag', ASCENDING), ('_id', ASCENDING)], name='owner_id_tags__id'),
+        # Delta sync pages through an owner's events in write order
+        IndexModel([('owner_id', ASCENDING), ('updated_at', ASCENDING), ('_id', ASCENDING)],
+                   name='owner_id_updated_at__id'),
+    ],
+    'constraints': [
+        # Constraints on one event, and the graph load reads every constraint of an owner
+        IndexModel([('owner_id', ASCENDING), ('event_id', ASCENDING), ('_id', ASCENDING)],
+                   name='owner_id_event_id__id'),
+        IndexModel([('owner_id', ASCENDING), ('constraint_type', ASCENDING), ('_id', ASCENDING)],
+                   name='owner_id_constraint_type__id'),
+    ],
+    'feed': [
+        # Messages only matter to change streams open now, an hour covers a stream resuming after a failover
+        IndexModel([('created_at', ASCENDING)], name='created_at', expireAfterSeconds=3600),
+    ],
+    'tombstones': [
+        IndexModel([('owner_id', ASCENDING), ('updated_at', ASCENDING), ('_id', ASCENDING)],
+                   name='owner_id_updated_at__id'),
+        IndexModel([('updated_at', ASCENDING)], name='updated_at', expireAfterSeconds=TOMBSTONE_TTL_DAYS * 86400),
+    ],
+    'tag_counts': [
+        # Prefix autocomplete is an anchored regex range scan on tag
+        IndexModel([('owner_id', ASCENDING), ('tag', ASCENDING)], name='owner_id_tag', unique=True),
+        IndexModel([('owner_id', ASCENDING), ('count', DESCENDING)], name='owner_id_count'),
+    ],
+    'users': [
+        # get_user runs on every authenticated request
+        IndexModel([('username', ASCENDING)], name='username', unique=True),
+        IndexModel([('email', ASCENDING)], name='email', unique=True,
+                   partialFilterExpression={'email': {'$type': 'string'}}),
+    ],
+}
+
+
+def declared_indexes(collection_name: str) -> List[IndexModel]:
+    """INDEXES of the collection, on the keys its EVENT_STORAGE form stores."""
+    if collection_name in COLLECTIONS:
+        return storage_indexes(INDEXES[collection_name])
+    return INDEXES[collection_name]
+
+
+async def ensure_indexes():
+    """Creates any declared index that is missing, existing ones are left alone."""
+    for collection_name in INDEXES:
+        if collection_name in COLLECTIONS:
+            await detect_text_index(get_stored_collection(collection_name))
+        try:
+            await get_collection(collection_name).create_indexes(declared_indexes(collection_name))
+        except OperationFailure as error:
+            # e.g. duplicates already stored under a unique key, the app still works without the index
+            logger.error("Could not ensure indexes on %s: %s", collection_name, error)
+
+
+async def report() -> bool:
+    """Prints declared indexes that are missing and existing ones that are undeclared or unused.
+    Returns True when nothing is missing."""
+    complete = True
+    for collection_name in INDEXES:
+        collection = get_collection(collection_name)
+        if collection_name in COLLECTIONS:
+            await detect_text_index(get_stored_collection(collection_name))
+        indexes = declared_indexes(collection_name)
+        existing = await collection.index_information()
+        declared = {index.document['name'] for index in indexes}
+        usage = {stats['name']: stats['accesses']['ops']
+                 async for stats in collection.aggregate([{'$indexStats': {}}])}
+
+        print(collection_name)
+        for name in sorted(declared - set(existing)):
+            complete = False
+            print(f"  missing     {name}")
+        for name in sorted(set(existing) - declared - {'_id_'}):
+            print(f"  undeclared  {name}")
+        for name in sorted(existing):
+            if name != '_id_' and usage.get(name, 0) == 0:
+                print(f"  unused      {name} (no accesses since the last mongod restart)")
+    return complete
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report on the indexes declared in app.DB.Indexes.")
+    parser.add_argument('--create', action='store_true', help="create missing indexes before reporting")
+    args = parser.parse_args()
+
+    async def run():
+        if args.create:
+            await ensure_indexes()
+        return await report()
+
+    raise SystemExit(0 if asyncio.run(run()) else 1)
+
+
+if __name__ == "__main__":
+    main()
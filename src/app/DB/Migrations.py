@@ -0,0 +1,135 @@
+"""One off data migrations, safe to run while the app is serving and to re-run.
+
+    python -m app.DB.Migrations time_buckets
+    python -m app.DB.Migrations tag_counts
+    python -m app.DB.Migrations summaries
+    python -m app.DB.Migrations summaries_verify
+    python -m app.DB.Migrations versions
+    python -m app.DB.Migrations constraints
+    python -m app.DB.Migrations compact
+    python -m app.DB.Migrations compact_cleanup
+
+Run the others before compact, they name the long keys.
+"""
+import argparse
+import asyncio
+
+from pymongo import UpdateOne
+
+from .Codec import EVENT_STORAGE, storage_indexes
+from .Constraints import migrate_embedded_constraints
+from .DB import get_collection, get_stored_collection
+from .Indexes import INDEXES
+from .Summaries import rebuild_summaries, verify_summaries
+from .TagCounts import rebuild_tag_counts
+from ..Models.Compact import KEYS, encode_event
+from ..Models.Event import EventTime, time_buckets
+
+BATCH_SIZE = 1000
+
+
+async def backfill_time_buckets(batch_size: int = BATCH_SIZE) -> int:
+    """Stores time_buckets on events written before range queries existed."""
+    events = get_collection('events')
+    migrated = 0
+    while True:
+        batch = await events.find({'time_buckets': {'$exists': False}}, {'time_details': 1},
+                                  limit=batch_size).to_list(length=batch_size)
+        if not batch:
+            return migrated
+        # Matching on time_details leaves events edited since the read for the next pass
+        await events.bulk_write([
+            UpdateOne({'_id': event['_id'], 'time_details': event['time_details']},
+                      {'$set': {'time_buckets': time_buckets(EventTime(**event['time_details']))}})
+            for event in batch
+        ], ordered=False)
+        migrated += len(batch)
+        print(f"time_buckets: {migrated} events")
+
+
+async def backfill_versions(batch_size: int = BATCH_SIZE) -> int:
+    """Starts events written before versioning at version 1, updated when their id was made."""
+    # A pipeline update runs on the server, writes racing it already carry a version and are skipped
+    result = await get_collection('events').update_many(
+        {'version': {'$exists': False}}, [{'$set': {'version': 1, 'updated_at': {'$toDate': '$_id'}}}])
+    print(f"versions: {result.modified_count} events")
+    return result.modified_count
+
+
+async def compact_events(batch_size: int = BATCH_SIZE) -> int:
+    """Adds the compact form to events stored before EVENT_STORAGE=dual, then moves the text index to it.
+    Run it once every worker is in dual mode, after it compact can be switched on."""
+    if EVENT_STORAGE != 'dual':
+        raise SystemExit("Run with EVENT_STORAGE=dual, as the workers are")
+    events = get_stored_collection('events')
+    migrated = 0
+    while True:
+        # Only inserts and this migration store o, an update in dual mode wrote part of the compact form at most
+        batch = await events.find({'o': {'$exists': False}}, limit=batch_size).to_list(length=batch_size)
+        if not batch:
+            break
+        # Matching on version leaves events written since the read for the next pass
+        await events.bulk_write([
+            UpdateOne({'_id': event['_id'], 'version': event.get('version')},
+                      {'$set': {key: value for key, value in encode_event(event).items() if key != '_id'}})
+            for event in batch
+        ], ordered=False)
+        migrated += len(batch)
+        print(f"compact: {migrated} events")
+
+    text_indexes = [index for index in INDEXES['events'] if 'text' in index.document['key'].values()]
+    existing = await events.index_information()
+    for index in text_indexes:
+        if index.document['name'] in existing:
+            await events.drop_index(index.document['name'])
+    # Search fails from the drop until the build ends, and on each worker until it restarts and detects the move
+    await events.create_indexes(storage_indexes(text_indexes, 'compact'))
+    print("compact: moved the text index, restart the workers to search with it")
+    return migrated
+
+
+async def compact_cleanup(batch_size: int = BATCH_SIZE) -> int:
+    """Removes the long keys and their indexes once every worker runs with EVENT_STORAGE=compact."""
+    if EVENT_STORAGE != 'compact':
+        raise SystemExit("Run with EVENT_STORAGE=compact, as the workers are")
+    events = get_stored_collection('events')
+    cleaned = 0
+    while True:
+        # The owner_id indexes find the events left, they are dropped once none is
+        batch = await events.find({'owner_id': {'$exists': True}}, {'_id': 1},
+                                  limit=batch_size).to_list(length=batch_size)
+        if not batch:
+            break
+        await events.update_many({'_id': {'$in': [event['_id'] for event in batch]}},
+                                 {'$unset': {key: '' for key in KEYS}})
+        cleaned += len(batch)
+        print(f"compact_cleanup: {cleaned} events")
+    existing = await events.index_information()
+    for index in INDEXES['events']:
+        if index.document['name'] in existing:
+            await events.drop_index(index.document['name'])
+    return cleaned
+
+
+MIGRATIONS = {
+    'time_buckets': backfill_time_buckets,
+    'tag_counts': rebuild_tag_counts,
+    'summaries': rebuild_summaries,
+    'summaries_verify': verify_summaries,
+    'versions': backfill_versions,
+    'constraints': migrate_embedded_constraints,
+    'compact': compact_events,
+    'compact_cleanup': compact_cleanup,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a data migration.")
+    parser.add_argument('migration', choices=sorted(MIGRATIONS))
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+    asyncio.run(MIGRATIONS[args.migration](args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
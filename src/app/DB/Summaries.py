@@ -0,0 +1,143 @@
+"""Per-user dashboard counters, one document per owner keyed by owner id, kept current by the routes that change
+an event's stage, color or start time.
+
+    {'_id': owner_id, 'total': 12, 'stage': {'started': 7, ...}, 'color': {'#f00': 3, ...},
+     'week': {'2021-W05': 2, ...}}
+"""
+from collections import Counter
+from datetime import datetime
+from typing import Iterable, List, Optional
+
+from bson import ObjectId
+from pymongo import ReplaceOne
+
+from .Codec import event_path
+from .DB import get_collection
+from ..Models.Compact import decode_color
+from ..Models.Event import as_utc
+
+COLLECTION = 'summaries'
+SUMMARY_FIELDS = ('stage', 'color', 'week')
+# The event fields the counters are computed from
+SUMMARY_SOURCES = ('stage', 'presentation', 'time_details')
+
+
+def iso_week(moment: datetime) -> str:
+    """"YYYY-Www" of the ISO week holding moment in UTC, as $dateToString writes it with %G-W%V."""
+    year, week, _ = as_utc(moment).isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+def summary_keys(event: dict) -> List[str]:
+    """The counters one event adds to, as dotted paths into the summary document."""
+    keys = ['total']
+    stage = event.get('stage')
+    if stage:
+        keys.append(f"stage.{getattr(stage, 'value', stage)}")
+    color = (event.get('presentation') or {}).get('color')
+    if color:
+        keys.append(f"color.{color}")
+    start_time = (event.get('time_details') or {}).get('start_time')
+    if start_time:
+        keys.append(f"week.{iso_week(start_time)}")
+    return keys
+
+
+async def count_summary(owner_id: str, added: Iterable[str] = (), removed: Iterable[str] = ()):
+    """Applies the summary_keys of added and removed events to the owner's counters in one update."""
+    deltas = Counter(added)
+    deltas.subtract(removed)
+    increments = {key: delta for key, delta in deltas.items() if delta}
+    if increments:
+        # Counters that reach zero stay behind, find_summary skips them and rebuild_summaries removes them
+        await get_collection(COLLECTION).update_one({'_id': owner_id}, {'$inc': increments}, upsert=True)
+
+
+async def find_summary(owner_id: str) -> dict:
+    summary = await get_collection(COLLECTION).find_one({'_id': owner_id}) or {}
+    return {'total': summary.get('total', 0),
+            **{field: {key: count for key, count in sorted(summary.get(field, {}).items()) if count}
+               for field in SUMMARY_FIELDS}}
+
+
+def _summary_pipeline() -> list:
+    return [
+        {'$group': {
+            '_id': {'owner_id': f"${event_path('owner_id')}", 'stage': f"${event_path('stage')}",
+                    'color': f"${event_path('presentation.color')}",
+                    'week': {'$dateToString': {'format': '%G-W%V',
+                                               'date': f"${event_path('time_details.start_time')}"}}},
+            'count': {'$sum': 1}}},
+        {'$sort': {'_id.owner_id': 1}},
+    ]
+
+
+def _summary_document(owner_id: str, groups: List[dict]) -> dict:
+    summary = {'_id': owner_id, 'total': 0, **{field: {} for field in SUMMARY_FIELDS}}
+    for group in groups:
+        summary['total'] += group['count']
+        for field in SUMMARY_FIELDS:
+            key = group['_id'].get(field)
+            if key is None:
+                continue
+            if field == 'color' and isinstance(key, int):
+                # Compact storage packs the color, the counters keep the hex string the routes count
+                key = decode_color(key)
+            summary[field][key] = summary[field].get(key, 0) + group['count']
+    return summary
+
+
+def _drifted(stored: Optional[dict], summary: dict) -> bool:
+    stored = stored or {}
+    if stored.get('total', 0) != summary['total']:
+        return True
+    return any({key: count for key, count in stored.get(field, {}).items() if count} != summary[field]
+               for field in SUMMARY_FIELDS)
+
+
+async def _recount(batch_size: int, repair: bool) -> int:
+    summaries = get_collection(COLLECTION)
+    stamp = ObjectId()
+    drifted = 0
+    requests = []
+
+    async def check(owner_id: str, groups: List[dict]):
+        nonlocal drifted, requests
+        summary = _summary_document(owner_id, groups)
+        if _drifted(await summaries.find_one({'_id': owner_id}), summary):
+            drifted += 1
+            print(f"summaries: {owner_id} drifted")
+        if repair:
+            requests.append(ReplaceOne({'_id': owner_id}, {**summary, 'rebuild': stamp}, upsert=True))
+            if len(requests) == batch_size:
+                await summaries.bulk_write(requests, ordered=False)
+                requests = []
+
+    owner_id, groups = None, []
+    # Sorted by owner, so one owner's groups arrive together
+    async for group in get_collection('events').aggregate(_summary_pipeline(), allowDiskUse=True):
+        if group['_id']['owner_id'] != owner_id and groups:
+            await check(owner_id, groups)
+            groups = []
+        owner_id = group['_id']['owner_id']
+        groups.append(group)
+    if groups:
+        await check(owner_id, groups)
+    if repair:
+        if requests:
+            await summaries.bulk_write(requests, ordered=False)
+        # Owners left without events
+        await summaries.delete_many({'rebuild': {'$ne': stamp}})
+    print(f"summaries: {drifted} owners drifted")
+    return drifted
+
+
+async def rebuild_summaries(batch_size: int = 1000) -> int:
+    """Recomputes every owner's counters from the events collection, repairing drift. Returns the number of owners
+    whose counters had drifted. Writes racing it can be lost, so run it when traffic is low."""
+    return await _recount(batch_size, repair=True)
+
+
+async def verify_summaries(batch_size: int = 1000) -> int:
+    """Like rebuild_summaries but only reports the owners whose counters drifted."""
+    return await _recount(batch_size, repair=False)
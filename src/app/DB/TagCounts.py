@@ -0,0 +1,53 @@
+"""Per-user tag counts, kept current by the routes that change tags."""
+from collections import Counter
+from typing import Iterable, List, Optional
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from .Codec import event_path
+from .DB import get_collection
+
+COLLECTION = 'tag_counts'
+
+
+async def count_tags(owner_id: str, added: Iterable[str] = (), removed: Iterable[str] = ()):
+    """Applies tag additions and removals to the owner's counts in one round-trip."""
+    deltas = Counter(added)
+    deltas.subtract(removed)
+    requests = [UpdateOne({'owner_id': owner_id, 'tag': tag}, {'$inc': {'count': delta}}, upsert=delta > 0)
+                for tag, delta in deltas.items() if delta]
+    if requests:
+        # Counts that reach zero stay behind, reads skip them and rebuild_tag_counts removes them
+        await get_collection(COLLECTION).bulk_write(requests, ordered=False)
+
+
+async def find_tag_counts(owner_id: str, query: Optional[dict] = None, sort=None, limit: int = 0) -> List[dict]:
+    cursor = get_collection(COLLECTION).find({'owner_id': owner_id, 'count': {'$gt': 0}, **(query or {})},
+                                             {'_id': 0, 'tag': 1, 'count': 1}, sort=sort, limit=limit)
+    return await cursor.to_list(length=limit or None)
+
+
+async def rebuild_tag_counts(batch_size: int = 1000) -> int:
+    """Recomputes every count from the events collection, repairing drift. Returns the number of counts.
+    Tags first used while it runs can be dropped, so run it when traffic is low."""
+    counts = get_collection(COLLECTION)
+    stamp = ObjectId()
+    pipeline = [
+        {'$unwind': f"${event_path('tags')}"},
+        {'$group': {'_id': {'owner_id': f"${event_path('owner_id')}", 'tag': f"${event_path('tags.tag')}"},
+                    'count': {'$sum': 1}}},
+    ]
+    requests = []
+    written = 0
+    async for group in get_collection('events').aggregate(pipeline, allowDiskUse=True):
+        requests.append(UpdateOne(group['_id'], {'$set': {'count': group['count'], 'rebuild': stamp}}, upsert=True))
+        if len(requests) == batch_size:
+            await counts.bulk_write(requests, ordered=False)
+            written += len(requests)
+            requests = []
+    if requests:
+        await counts.bulk_write(requests, ordered=False)
+        written += len(requests)
+    await counts.delete_many({'rebuild': {'$ne': stamp}})
+    return written
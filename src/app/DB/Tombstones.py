@@ -0,0 +1,26 @@
+"""Records of deleted events, read by delta sync so clients learn what to drop. Expired by a TTL index."""
+import os
+from typing import Iterable, Optional
+
+from bson import ObjectId
+from pymongo import ReplaceOne
+
+from .DB import get_collection
+from ..Models.Event import utc_now
+
+COLLECTION = 'tombstones'
+# Sync tokens older than this can no longer list every deletion, their clients refetch everything
+TOMBSTONE_TTL_DAYS = int(os.getenv('TOMBSTONE_TTL_DAYS', 30))
+
+
+async def add_tombstones(owner_id: str, event_ids: Iterable, versions: Optional[dict] = None):
+    """Records events as deleted now. versions maps an event id to its version when deleted, when known."""
+    versions = versions or {}
+    deleted_at = utc_now()
+    # Keyed by the event id, so recording a deletion twice keeps one tombstone
+    requests = [ReplaceOne({'_id': ObjectId(event_id)},
+                           {'owner_id': owner_id, 'updated_at': deleted_at, 'version': versions.get(str(event_id))},
+                           upsert=True)
+                for event_id in event_ids]
+    if requests:
+        await get_collection(COLLECTION).bulk_write(requests, ordered=False)
@@ -0,0 +1,274 @@
+"""Streaming export and import of one user's events, for backups and moving accounts.
+
+Both run in constant memory. Export reads a batched cursor and compresses each batch as it goes. Import
+decompresses and splits the stream as it arrives, then validates and writes IMPORT_BATCH events at a time
+with one unordered insert_many. Events are written as
+
+    ndjson  one JSON event per line
+    bson    BSON documents back to back
+
+gzip compressed unless asked otherwise, import tells the two apart by the gzip header. From src/:
+
+    python -m app.DB.Transfer export alice alice.ndjson.gz
+    python -m app.DB.Transfer import bob alice.ndjson.gz
+"""
+import argparse
+import asyncio
+import os
+import sys
+import zlib
+from typing import AsyncIterator, Dict, List, Tuple
+
+import bson
+import orjson
+from pydantic import BaseModel, ValidationError
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError
+
+from .DB import get_collection
+from .Summaries import count_summary, summary_keys
+from .TagCounts import count_tags
+from .Utilities import get_user
+from ..Models.Bulk import describe
+from ..Models.Event import NewEvent, NewEventInDB, Stage, event_projection, event_response
+from ..Models.Transfer import TransferFormat
+
+TRANSFER_BATCH = int(os.getenv('TRANSFER_BATCH', 1000))  # Events per cursor batch on export
+IMPORT_BATCH = int(os.getenv('IMPORT_BATCH', 1000))  # Events per insert_many on import
+TRANSFER_COMPRESSION_LEVEL = int(os.getenv('TRANSFER_COMPRESSION_LEVEL', 6))
+IMPORT_MAX_ERRORS = 100
+# A valid event is well under 8KiB in either format, a longer record is not one and is not buffered further
+IMPORT_MAX_RECORD = 64 * 1024
+READ_SIZE = 64 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+# Event fields an export carries, _id aside. Imported events get new ids.
+EXPORT_FIELDS = ('name', 'description', 'tags', 'time_details', 'presentation', 'stage')
+
+
+def _encode_ndjson(event: dict) -> bytes:
+    return orjson.dumps(event) + b'\n'
+
+
+ENCODERS = {TransferFormat.ndjson: _encode_ndjson, TransferFormat.bson: bson.encode}
+
+
+async def export_events(owner_id: str, transfer_format: TransferFormat = TransferFormat.ndjson,
+                        compress: bool = True) -> AsyncIterator[bytes]:
+    """Yields the owner's events in transfer_format, one block per cursor batch."""
+    encode = ENCODERS[transfer_format]
+    compressor = zlib.compressobj(TRANSFER_COMPRESSION_LEVEL, zlib.DEFLATED, GZIP_WBITS) if compress else None
+    events_cursor = get_collection('events').find({'owner_id': owner_id}, event_projection(EXPORT_FIELDS),
+                                                  sort=[('_id', ASCENDING)], batch_size=TRANSFER_BATCH)
+    blocks = []
+    async for event in events_cursor:
+        blocks.append(encode(event_response(event, EXPORT_FIELDS)))
+        if len(blocks) == TRANSFER_BATCH:
+            block = b''.join(blocks)
+            blocks = []
+            block = compressor.compress(block) if compressor else block
+            if block:
+                yield block
+    block = b''.join(blocks)
+    if compressor:
+        block = compressor.compress(block) + compressor.flush()
+    if block:
+        yield block
+
+
+async def _decompressed(data: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """The stream with gzip undone when it starts with a gzip header, READ_SIZE at most at a time so a small
+    upload cannot unpack to a large block."""
+    head = b''
+    async for block in data:
+        head += block
+        if len(head) >= len(GZIP_MAGIC):
+            break
+    if not head.startswith(GZIP_MAGIC):
+        if head:
+            yield head
+        async for block in data:
+            yield block
+        return
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    block = head
+    while True:
+        unpacked = decompressor.decompress(block, READ_SIZE)
+        # A full block can leave output behind even with the input used up
+        while len(unpacked) == READ_SIZE or decompressor.unconsumed_tail:
+            yield unpacked
+            unpacked = decompressor.decompress(decompressor.unconsumed_tail, READ_SIZE)
+        if unpacked:
+            yield unpacked
+        if decompressor.eof:
+            return
+        block = b''
+        async for block in data:
+            if block:
+                break
+        if not block:
+            raise ValueError("Truncated gzip stream")
+
+
+async def _ndjson_records(data: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    pending = b''
+    async for block in data:
+        lines = (pending + block).split(b'\n')
+        pending = lines.pop()
+        if len(pending) > IMPORT_MAX_RECORD:
+            raise ValueError(f"Line longer than {IMPORT_MAX_RECORD} bytes")
+        for line in lines:
+            if line.strip():
+                yield line
+    if pending.strip():
+        yield pending
+
+
+async def _bson_records(data: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    pending = bytearray()
+    async for block in data:
+        pending += block
+        offset = 0
+        while len(pending) - offset >= 4:
+            size = int.from_bytes(pending[offset:offset + 4], 'little')
+            if not 5 <= size <= IMPORT_MAX_RECORD:
+                raise ValueError(f"Invalid BSON document size {size}")
+            if len(pending) - offset < size:
+                break
+            yield bytes(pending[offset:offset + size])
+            offset += size
+        del pending[:offset]
+    if pending:
+        raise ValueError("Truncated BSON document")
+
+
+RECORD_READERS = {TransferFormat.ndjson: _ndjson_records, TransferFormat.bson: _bson_records}
+DECODERS = {TransferFormat.ndjson: orjson.loads, TransferFormat.bson: bson.decode}
+
+
+def _plain(value):
+    """model.dict() without its include and exclude handling, which costs as much as validating an event."""
+    if isinstance(value, BaseModel):
+        return {key: _plain(item) for key, item in value.__dict__.items()}
+    if isinstance(value, list):
+        return [_plain(item) for item in value]
+    return value
+
+
+def parse_event(record: dict, owner_id: str) -> dict:
+    """The stored form of one exported event, validated as NewEvent. Fields outside NewEvent and stage, like an
+    owner_id or version, are not taken from the stream."""
+    fields = {field: record[field] for field in NewEvent.__fields__ if field in record}
+    return _plain(NewEventInDB(**fields, owner_id=owner_id, stage=record.get('stage', Stage.started)))
+
+
+class ImportResult:
+    def __init__(self):
+        self.imported = 0
+        self.failed = 0
+        self.errors: List[Dict] = []
+
+    def fail(self, index: int, error: str):
+        self.failed += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append({'index': index, 'error': error})
+
+    def dict(self) -> dict:
+        return {'imported': self.imported, 'failed': self.failed,
+                'errors': sorted(self.errors, key=lambda error: error['index'])}
+
+
+async def _insert_chunk(owner_id: str, chunk: List[Tuple[int, dict]], result: ImportResult):
+    failed = set()
+    try:
+        await get_collection('events').insert_many([event for _, event in chunk], ordered=False)
+    except BulkWriteError as error:
+        for write_error in error.details['writeErrors']:
+            failed.add(write_error['index'])
+            result.fail(chunk[write_error['index']][0], write_error['errmsg'])
+    inserted = [event for position, (_, event) in enumerate(chunk) if position not in failed]
+    result.imported += len(inserted)
+    await count_tags(owner_id, added=[tag['tag'] for event in inserted for tag in event['tags']])
+    await count_summary(owner_id, added=[key for event in inserted for key in summary_keys(event)])
+
+
+async def import_events(owner_id: str, data: AsyncIterator[bytes],
+                        transfer_format: TransferFormat = TransferFormat.ndjson) -> ImportResult:
+    """Adds every valid event of the stream to the owner's events. An invalid event only fails itself, a stream
+    that cannot be read further stops the import with the events before it kept. Imported events reach other
+    devices through the delta sync rather than one feed message each."""
+    decode = DECODERS[transfer_format]
+    result = ImportResult()
+    chunk = []
+    index = 0
+    # The insert of one chunk runs while the next is parsed and validated
+    inserting = None
+    try:
+        async for record in RECORD_READERS[transfer_format](_decompressed(data)):
+            try:
+                event = decode(record)
+                if not isinstance(event, dict):
+                    raise ValueError("Not an object")
+                chunk.append((index, parse_event(event, owner_id)))
+            except (ValueError, ValidationError, bson.errors.InvalidBSON) as error:
+                result.fail(index, describe(error))
+            index += 1
+            if len(chunk) == IMPORT_BATCH:
+                if inserting:
+                    await inserting
+                inserting = asyncio.ensure_future(_insert_chunk(owner_id, chunk, result))
+                # Hands the insert to the driver before parsing on
+                await asyncio.sleep(0)
+                chunk = []
+    except (ValueError, zlib.error) as error:
+        result.fail(index, f"Unreadable stream: {error}")
+    finally:
+        if inserting:
+            await inserting
+    if chunk:
+        await _insert_chunk(owner_id, chunk, result)
+    return result
+
+
+async def read_file(path: str) -> AsyncIterator[bytes]:
+    file = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    try:
+        block = file.read(READ_SIZE)
+        while block:
+            yield block
+            block = file.read(READ_SIZE)
+    finally:
+        if file is not sys.stdin.buffer:
+            file.close()
+
+
+async def run(args):
+    user = await get_user(args.username)
+    if user is None:
+        raise SystemExit(f"No user {args.username}")
+    transfer_format = TransferFormat(args.format)
+    if args.command == 'export':
+        output = sys.stdout.buffer if args.path == '-' else open(args.path, 'wb')
+        try:
+            async for block in export_events(user.id, transfer_format, compress=not args.no_compress):
+                output.write(block)
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
+    else:
+        result = await import_events(user.id, read_file(args.path), transfer_format)
+        print(orjson.dumps(result.dict()).decode())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import one user's events.")
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('username')
+    parser.add_argument('path', help="file to write or read, - for stdout or stdin")
+    parser.add_argument('--format', choices=[item.value for item in TransferFormat], default='ndjson')
+    parser.add_argument('--no-compress', action='store_true', help="export without gzip")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
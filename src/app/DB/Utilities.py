@@ -1,15 +1,26 @@
+import os
 from functools import partial
 from typing import Optional
 
 import bson
 from fastapi import HTTPException
+from pymongo import ReturnDocument
 
+from .Cache import CacheBackend, LocalCache
 from .DB import get_collection
+from ..Models.Event import event_projection
+from ..Models.User import DBUser
 
+# Writes invalidate on the worker that made them, other workers see them within EVENT_CACHE_TTL seconds
+EVENT_CACHE_SIZE = int(os.getenv('EVENT_CACHE_SIZE', 10000))
+EVENT_CACHE_TTL = float(os.getenv('EVENT_CACHE_TTL', 10))
+event_cache: CacheBackend = LocalCache(EVENT_CACHE_SIZE, EVENT_CACHE_TTL)
+_invalidations = 0
 
-def or_fail(func):
+
+async def or_fail(func):
     try:
-        results = func()
+        results = await func()
     except bson.errors.InvalidId:
         raise HTTPException(status_code=404, detail="Item not found")
     if not results:
@@ -17,9 +28,9 @@ def or_fail(func):
     return results
 
 
-def fail_on_success(func, error_code: int = 422, error_msg="Unprocessable Entity"):
+async def fail_on_success(func, error_code: int = 422, error_msg="Unprocessable Entity"):
     try:
-        results = func()
+        results = await func()
     except bson.errors.InvalidId:
         raise HTTPException(status_code=404, detail="Item not found")
     if not results:
@@ -27,35 +38,77 @@ def fail_on_success(func, error_code: int = 422, error_msg="Unprocessable Entity
     raise HTTPException(status_code=404, detail="Item not found")
 
 
-def x_or_x(x, x2, collection_name, filter_factory: Optional[dict] = None, update_factory: Optional[dict] = None):
+async def x_or_x(x, x2, collection_name, filter_factory: Optional[dict] = None, update_factory: Optional[dict] = None,
+                 **kwargs):
     collection_handle = get_collection(collection_name)
     possible = [filter_factory, update_factory]
-    func = partial(collection_handle.__getattribute__(x), *[param for param in possible if param is not None])
-    return x2(func)
+    func = partial(getattr(collection_handle, x), *[param for param in possible if param is not None], **kwargs)
+    return await x2(func)
+
+
+async def x_or_fail(x, collection_name, filter_factory: Optional[dict] = None, update_factory: Optional[dict] = None,
+                    **kwargs):
+    return await x_or_x(x, or_fail, collection_name, filter_factory, update_factory, **kwargs)
+
 
+async def x_or_fail_on_success(x, collection_name, filter_factory: Optional[dict] = None,
+                               update_factory: Optional[dict] = None):
+    return await x_or_x(x, fail_on_success, collection_name, filter_factory, update_factory)
 
-def x_or_fail(x, collection_name, filter_factory: Optional[dict] = None, update_factory: Optional[dict] = None):
-    return x_or_x(x, or_fail, collection_name, filter_factory, update_factory)
 
+async def find_one_or_fail(collection_name, filter_factory: dict, **kwargs):
+    return await x_or_fail('find_one', collection_name, filter_factory, **kwargs)
 
-def x_or_fail_on_success(x, collection_name, filter_factory: Optional[dict] = None,
-                         update_factory: Optional[dict] = None):
-    return x_or_x(x, fail_on_success, collection_name, filter_factory, update_factory)
 
+async def delete_one_or_fail(collection_name, filter_factory: dict):
+    return await x_or_fail('delete_one', collection_name, filter_factory)
 
-def find_one_or_fail(collection_name, filter_factory: dict):
-    return x_or_fail('find_one', collection_name, filter_factory)
 
+async def update_one_or_fail(collection_name, filter_factory: dict,
+                             update_factory: dict):
+    return await x_or_fail('update_one', collection_name, filter_factory, update_factory)
 
-def delete_one_or_fail(collection_name, filter_factory: dict):
-    return x_or_fail('delete_one', collection_name, filter_factory)
 
+async def find_one_and_update_or_fail(collection_name, filter_factory: dict, update_factory: dict, **kwargs):
+    """Applies the update and returns the updated document in one round-trip."""
+    kwargs.setdefault('return_document', ReturnDocument.AFTER)
+    return await x_or_fail('find_one_and_update', collection_name, filter_factory, update_factory, **kwargs)
 
-def update_one_or_fail(collection_name, filter_factory: dict,
-                       update_factory: dict):
-    return x_or_fail('update_one', collection_name, filter_factory, update_factory)
 
+async def find_one_and_delete_or_fail(collection_name, filter_factory: dict, **kwargs):
+    """Deletes the document and returns it in one round-trip."""
+    return await x_or_fail('find_one_and_delete', collection_name, filter_factory, **kwargs)
 
-def fail_if_found_one(collection_name, filter_factory: dict):
+
+async def fail_if_found_one(collection_name, filter_factory: dict):
     """Fails if item is found."""
-    return x_or_fail_on_success('find_one', collection_name, filter_factory)
+    return await x_or_fail_on_success('find_one', collection_name, filter_factory)
+
+
+def event_key(owner_id: str, event_id) -> tuple:
+    return owner_id, str(event_id).lower()
+
+
+async def invalidate_event(owner_id: str, event_id):
+    """Drops a cached event, every write to an event calls it once the write is done."""
+    global _invalidations
+    _invalidations += 1
+    await event_cache.invalidate(event_key(owner_id, event_id))
+
+
+async def load_event_or_fail(owner_id: str, event_id, filter_factory: dict) -> dict:
+    """Reads the event's response fields and version and caches them, unless an invalidation ran meanwhile
+    and the read may predate it."""
+    invalidations = _invalidations
+    results = await find_one_or_fail('events', filter_factory, projection=event_projection(None, 'version'))
+    if invalidations == _invalidations:
+        await event_cache.set(event_key(owner_id, event_id), results)
+    return results
+
+
+async def get_user(username: str) -> DBUser:
+    """Get user from database."""
+    users = get_collection('users')
+    user_dict = await users.find_one({"username": f"{username}"})
+    if user_dict is not None:
+        return DBUser(**user_dict)
@@ -0,0 +1,47 @@
+from enum import Enum
+from typing import List, Optional
+
+from pydantic import BaseModel, Field, ValidationError
+
+from .Event import NewEvent, EventPatch, Tag
+
+BULK_MAX_OPERATIONS = 1000
+
+
+class BulkOperationType(str, Enum):
+    create = 'create'
+    update = 'update'
+    add_tag = 'add_tag'
+    remove_tag = 'remove_tag'
+    delete = 'delete'
+
+
+class BulkOperation(BaseModel):
+    op: BulkOperationType
+    event_id: Optional[str] = Field(None, regex='^[0-9a-fA-F]{24}$')  # every op but create
+    event: Optional[NewEvent]  # create
+    fields: Optional[EventPatch]  # update
+    tag: Optional[Tag]  # add_tag and remove_tag
+
+
+class BulkRequest(BaseModel):
+    # Items are validated one by one so a bad item only fails itself
+    operations: List[dict] = Field(..., min_items=1, max_items=BULK_MAX_OPERATIONS)
+
+
+class BulkResult(BaseModel):
+    index: int
+    ok: bool
+    event_id: Optional[str]
+    error: Optional[str]
+
+
+class BulkResponse(BaseModel):
+    results: List[BulkResult]
+
+
+def describe(error: ValueError) -> str:
+    """One line naming each invalid field, for the result of a single item."""
+    if isinstance(error, ValidationError):
+        return '; '.join(f"{'.'.join(str(part) for part in item['loc'])}: {item['msg']}" for item in error.errors())
+    return str(error)
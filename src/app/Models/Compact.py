@@ -0,0 +1,104 @@
+"""Compact stored form of events: one or two letter keys, tags as plain strings and the color packed in an int.
+
+Routes keep working on the NewEventInDB shape, app.DB.Codec translates between the two on every db call.
+"""
+from functools import lru_cache
+from typing import Any, Dict
+
+from pydantic.color import Color
+
+KEYS = {
+    'owner_id': 'o',
+    'name': 'n',
+    'description': 'd',
+    'tags': 'g',
+    'time_details': 't',
+    'presentation': 'c',
+    'stage': 's',
+    'time_buckets': 'b',
+    'version': 'v',
+    'updated_at': 'u',
+}
+TIME_KEYS = {'start_time': 's', 'end_time': 'e', 'all_day': 'a'}
+FIELDS = {short: key for key, short in KEYS.items()}
+TIME_FIELDS = {short: key for key, short in TIME_KEYS.items()}
+COLOR_CACHE_SIZE = 4096
+
+
+# Events share a handful of colors, so both directions are cached
+@lru_cache(maxsize=COLOR_CACHE_SIZE)
+def encode_color(color: str) -> int:
+    """0xTTRRGGBB with TT the transparency, so opaque colors fit an int32."""
+    red, green, blue, alpha = Color(color).as_rgb_tuple(alpha=True)
+    return (255 - round(alpha * 255)) << 24 | red << 16 | green << 8 | blue
+
+
+@lru_cache(maxsize=COLOR_CACHE_SIZE)
+def decode_color(packed: int) -> str:
+    """The hex string EventColor stores, as Color.as_hex writes it."""
+    values = [(packed >> 16) & 255, (packed >> 8) & 255, packed & 255]
+    if packed >> 24:
+        values.append(255 - (packed >> 24))
+    digits = ''.join(f'{value:02x}' for value in values)
+    if all(value % 17 == 0 for value in values):
+        # #ff0000 is written #f00
+        digits = digits[::2]
+    return f"#{digits}"
+
+
+def storage_path(path: str) -> str:
+    """The stored path of a dotted NewEventInDB path, e.g. time_details.start_time is t.s. Other paths, like _id
+    or a $meta projection, are kept."""
+    key, *rest = path.split('.')
+    if key == 'tags':
+        # tags.tag and tags.3.tag name the tag strings themselves
+        return '.'.join(['g'] + [part for part in rest if part != 'tag'])
+    if key == 'presentation':
+        return 'c'
+    if key == 'time_details' and rest:
+        return '.'.join(['t', TIME_KEYS.get(rest[0], rest[0])] + rest[1:])
+    return '.'.join([KEYS.get(key, key)] + rest)
+
+
+def encode_value(path: str, value: Any) -> Any:
+    """The stored form of a value found at path, or of one element when path is an array. Used for whole
+    documents, $set values, filter operands and $push/$pull elements."""
+    if path == 'tags':
+        if isinstance(value, list):
+            return [tag['tag'] for tag in value]
+        # One element, or a $pull/$elemMatch condition on it
+        return value['tag'] if isinstance(value, dict) and 'tag' in value else value
+    if path == 'presentation':
+        return encode_color(value['color']) if isinstance(value, dict) else value
+    if path == 'presentation.color':
+        return encode_color(value) if isinstance(value, str) else value
+    if path == 'time_details' and isinstance(value, dict):
+        # all_day is mostly False, and a missing all_day reads back as False
+        return {TIME_KEYS.get(key, key): item for key, item in value.items() if not (key == 'all_day' and not item)}
+    return value
+
+
+def decode_value(key: str, value: Any) -> Any:
+    if key == 'tags':
+        return [{'tag': tag} for tag in value]
+    if key == 'presentation':
+        return {'color': decode_color(value)}
+    if key == 'time_details':
+        time_details = {TIME_FIELDS.get(short, short): item for short, item in value.items()}
+        if 'start_time' in time_details or 'end_time' in time_details:
+            time_details.setdefault('all_day', False)
+        return time_details
+    return value
+
+
+def encode_event(event: Dict[str, Any]) -> Dict[str, Any]:
+    """The stored form of a NewEventInDB dict. Stored keys already in it, written by a dual mode update to an
+    event not yet migrated, are dropped and recomputed."""
+    return {KEYS.get(key, key): encode_value(key, value) for key, value in event.items() if key not in FIELDS}
+
+
+def decode_event(document: Dict[str, Any]) -> Dict[str, Any]:
+    """The NewEventInDB dict of a stored event, or of the fields a projection read. Old long keys left beside
+    the short ones until the cleanup migration are skipped."""
+    return {FIELDS.get(key, key): decode_value(FIELDS.get(key, key), value) for key, value in document.items()
+            if key not in KEYS}
@@ -1,5 +1,6 @@
 from datetime import datetime
 from enum import Enum
+from typing import Literal, Optional, Union
 
 from bson import ObjectId
 from pydantic import BaseModel, Field, validator
@@ -38,9 +39,16 @@ class EventStageConstraint(EventStage, Constraint):
 
 
 class EventTime(BaseModel):
+    """A constraint on the current time, which must be from start_time up to end_time"""
     start_time: datetime
     end_time: datetime
-    all_day = bool
+    all_day: bool = False
+
+    @validator('end_time')
+    def end_after_start(cls, v: datetime, values: dict):
+        if 'start_time' in values and v <= values['start_time']:
+            raise ValueError("end_time must be after start_time")
+        return v
 
 
 class EventTimeConstraint(EventTime, Constraint):
@@ -61,5 +69,36 @@ class EventColorConstraint(EventColor, Constraint):
     pass
 
 
+class NewEventStageConstraint(EventStage, NewConstraint):
+    constraint_type: Literal[ConstraintType.stage]
+
+
+class NewEventTimeConstraint(EventTime, NewConstraint):
+    constraint_type: Literal[ConstraintType.time]
+
+
+class NewEventColorConstraint(EventColor, NewConstraint):
+    constraint_type: Literal[ConstraintType.color]
+
+
+# A new constraint of any type, told apart by constraint_type
+NewTypedConstraint = Union[NewEventStageConstraint, NewEventTimeConstraint, NewEventColorConstraint]
+TypedConstraint = Union[EventStageConstraint, EventTimeConstraint, EventColorConstraint]
+
+
+class StoredConstraint(NewConstraint):
+    """Any constraint as stored, with the event it is on."""
+    id: str = Field(..., alias='_id')
+    event_id: str  # The constrained event
+    prerequisite_id: Optional[str]  # EventStageConstraint, the event that must be complete
+    color: Optional[str]  # EventColorConstraint
+    start_time: Optional[datetime]  # EventTimeConstraint
+    end_time: Optional[datetime]
+
+    @validator('id', pre=True, always=True)
+    def id_to_string(cls, v: ObjectId):
+        return str(v)
+
+
 if __name__ == "__main__":
     pass
@@ -1,7 +1,8 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from enum import Enum
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
+import bson
 from bson import ObjectId
 from fastapi import APIRouter
 from pydantic import BaseModel, Field, validator
@@ -21,6 +22,73 @@ class EventTime(BaseModel):
     all_day: bool = False
 
 
+def as_utc(moment: datetime) -> datetime:
+    """Naive UTC, the form mongo stores and returns datetimes in."""
+    if moment.tzinfo is not None:
+        return moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def floor_day(moment: datetime) -> datetime:
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def ceil_day(moment: datetime) -> datetime:
+    floored = floor_day(moment)
+    return floored if floored == moment else floored + timedelta(days=1)
+
+
+def month_buckets(start: datetime, end: datetime) -> List[str]:
+    """Every "YYYY-MM" from the month of start through the month of end."""
+    year, month = start.year, start.month
+    buckets = []
+    while (year, month) <= (end.year, end.month):
+        buckets.append(f"{year:04d}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return buckets
+
+
+def time_buckets(time_details: EventTime) -> List[str]:
+    """Months the event overlaps, stored so time window queries only read those months."""
+    return month_buckets(as_utc(time_details.start_time), as_utc(time_details.end_time))
+
+
+def utc_now() -> datetime:
+    """Naive UTC at the millisecond precision mongo keeps."""
+    now = datetime.utcnow()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def stored_values(values: dict) -> dict:
+    """values as mongo stores and returns them: datetimes naive UTC to the millisecond, enums as their values."""
+    return bson.decode(bson.encode(values))
+
+
+def versioned(update: dict) -> dict:
+    """Adds the version bump and updated_at every write to an existing event carries."""
+    return {**update, '$set': {**update.get('$set', {}), 'updated_at': utc_now()},
+            '$inc': {**update.get('$inc', {}), 'version': 1}}
+
+
+def event_etag(event: dict) -> Optional[str]:
+    return f'"{event["version"]}"' if 'version' in event else None
+
+
+def etag_versions(header: str) -> List[int]:
+    """Versions named by an If-Match or If-None-Match list, weak tags compare equal to strong ones."""
+    versions = []
+    for tag in header.split(','):
+        tag = tag.strip()
+        tag = tag[2:] if tag.startswith('W/') else tag
+        if tag.startswith('"') and tag.endswith('"') and tag[1:-1].isdigit():
+            versions.append(int(tag[1:-1]))
+    return versions
+
+
+class TagCount(Tag):
+    count: int  # Events of the owner carrying the tag
+
+
 class Tags(BaseModel):
     tags: List[Tag] = Field(..., max_items=10)  # [set of tags applicable to event]
 
@@ -56,9 +124,35 @@ class Stage(str, Enum):
     complete = 'complete'
 
 
+class EventPatch(BaseModel):
+    """Any subset of the settable event fields."""
+    name: Optional[str] = Field(None, min_length=1, max_length=64)
+    description: Optional[str] = Field(None, max_length=256)
+    time_details: Optional[EventTime]
+    presentation: Optional[EventColor]
+    tags: Optional[List[Tag]] = Field(None, max_items=10)
+    stage: Optional[Stage]
+
+    class Config:
+        use_enum_values = True
+
+    @validator('tags')
+    def valid_tags(cls, v):
+        return Tags(tags=v).tags
+
+
 class NewEventInDB(NewEvent):
     stage: Stage  # "stage of event"
     owner_id: str  # Who owns the event
+    time_buckets: List[str] = []  # Months covered by time_details
+    version: int = 1  # Bumped by every write, sent as the ETag
+    updated_at: datetime = Field(default_factory=utc_now)
+
+    @validator('time_buckets', always=True)
+    def fill_time_buckets(cls, v, values):
+        if 'time_details' in values:
+            return time_buckets(values['time_details'])
+        return v
 
 
 class EventResponse(NewEvent):
@@ -69,6 +163,54 @@ class EventResponse(NewEvent):
         return str(v)
 
 
+class PartialEventResponse(BaseModel):
+    """An EventResponse holding only the fields a client selected."""
+    id: str = Field(..., alias='_id')
+    tags: Optional[List[Tag]]
+    name: Optional[str]
+    description: Optional[str]
+    time_details: Optional[EventTime]
+    presentation: Optional[EventColor]
+
+
+class EventChanges(BaseModel):
+    """One page of a delta sync."""
+    events: List[PartialEventResponse]  # Created or modified since the token, in write order
+    deleted: List[str]  # Ids of events deleted since the token
+    next: str  # Token to pass as `since` for the next page, or the next sync
+    more: bool  # Whether another page is ready now
+
+
+class EventSummary(BaseModel):
+    """Dashboard counts of the caller's events."""
+    total: int
+    stage: Dict[str, int]  # Events in each Stage
+    color: Dict[str, int]  # Events of each presentation color
+    week: Dict[str, int]  # Events starting in each ISO week, "YYYY-Www"
+
+
+EVENT_RESPONSE_FIELDS = ('tags', 'name', 'description', 'time_details', 'presentation')
+
+
+def event_projection(fields: Optional[Tuple[str, ...]] = None, *extra: str) -> dict:
+    """Mongo projection reading only the response fields, or the selected subset of them, plus extra paths."""
+    if fields is None:
+        fields = EVENT_RESPONSE_FIELDS
+    projection = {'_id': 1, **{field: 1 for field in fields}}
+    # Mongo rejects a path together with one of its parents
+    projection.update({path: 1 for path in extra if path.split('.')[0] not in fields})
+    return projection
+
+
+def event_response(event: dict, fields: Optional[Tuple[str, ...]] = None) -> dict:
+    """The EventResponse shape of a stored event. Events are validated when written, so reads skip pydantic."""
+    if fields is None:
+        fields = EVENT_RESPONSE_FIELDS
+    response = {field: event[field] for field in fields if field in event}
+    response['_id'] = str(event['_id'])
+    return response
+
+
 class EventInDB(EventResponse):
     stage: Stage  # "stage of event"
     owner_id: str  # Who owns the event
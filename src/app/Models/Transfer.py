@@ -0,0 +1,20 @@
+from enum import Enum
+from typing import List
+
+from pydantic import BaseModel
+
+
+class TransferFormat(str, Enum):
+    ndjson = 'ndjson'  # One JSON event per line
+    bson = 'bson'  # BSON documents back to back
+
+
+class ImportFailure(BaseModel):
+    index: int  # Position of the event in the stream, from 0
+    error: str
+
+
+class ImportResponse(BaseModel):
+    imported: int
+    failed: int
+    errors: List[ImportFailure]  # The first IMPORT_MAX_ERRORS failures
@@ -0,0 +1,253 @@
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from bson import ObjectId
+from fastapi import APIRouter, Depends
+from pymongo.errors import BulkWriteError
+
+from ..DB.Codec import InsertOne, UpdateOne, DeleteOne
+from ..DB.DB import get_collection
+from ..DB.Constraints import delete_event_constraints
+from ..DB.Summaries import SUMMARY_SOURCES, count_summary, summary_keys
+from ..DB.TagCounts import count_tags
+from ..DB.Tombstones import add_tombstones
+from ..DB.Utilities import invalidate_event
+from ..Models.Bulk import describe, BulkOperation, BulkOperationType, BulkRequest, BulkResponse, BulkResult
+from ..Models.Event import NewEventInDB, Stage, event_projection, time_buckets, versioned
+from ..Models.User import DBUser
+from ..constraints import forget_graph
+from ..feed import change_message, feed
+from ..dependencies import get_current_active_user
+from .Event import tag_names
+
+BulkRouter = APIRouter(prefix="/events", tags=["bulk"])
+
+REQUIRED_PARTS = {
+    BulkOperationType.create: 'event',
+    BulkOperationType.update: 'fields',
+    BulkOperationType.add_tag: 'tag',
+    BulkOperationType.remove_tag: 'tag',
+    BulkOperationType.delete: None,
+}
+
+
+CHANGE_TYPES = {
+    BulkOperationType.create: 'created',
+    BulkOperationType.update: 'updated',
+    BulkOperationType.add_tag: 'updated',
+    BulkOperationType.remove_tag: 'updated',
+    BulkOperationType.delete: 'deleted',
+}
+
+
+class PlannedWrite:
+    """The write for one operation and how it changes the owner's tag counts and summary counters."""
+
+    def __init__(self, event_id: str, request=None, added: List[str] = (), removed: List[str] = (),
+                 counted: List[str] = (), uncounted: List[str] = ()):
+        self.event_id = event_id
+        self.request = request
+        self.added = added
+        self.removed = removed
+        self.counted = counted
+        self.uncounted = uncounted
+
+
+def parse_operation(item: dict) -> BulkOperation:
+    operation = BulkOperation(**item)
+    if operation.op != BulkOperationType.create and operation.event_id is None:
+        raise ValueError("event_id is required")
+    if operation.event_id:
+        # Ids are compared as str(ObjectId), which is lowercase
+        operation.event_id = operation.event_id.lower()
+    part = REQUIRED_PARTS[operation.op]
+    if part and getattr(operation, part) is None:
+        raise ValueError(f"{part} is required")
+    return operation
+
+
+def plan_write(operation: BulkOperation, owner_id: str, event_tags: Dict[str, List[str]],
+               event_summaries: Dict[str, dict]) -> PlannedWrite:
+    """Turns an operation into its write. event_tags and event_summaries hold the current tags and SUMMARY_SOURCES
+    of every event the batch can touch and are updated as if each planned write succeeded, so later operations
+    see earlier ones."""
+    if operation.op == BulkOperationType.create:
+        new_event = NewEventInDB(**operation.event.dict(), owner_id=owner_id, stage=Stage.started).dict()
+        new_event['_id'] = ObjectId()
+        event_id = str(new_event['_id'])
+        event_tags[event_id] = tag_names(new_event)
+        event_summaries[event_id] = new_event
+        return PlannedWrite(event_id, InsertOne(new_event), added=event_tags[event_id],
+                            counted=summary_keys(new_event))
+
+    event_id = operation.event_id
+    if event_id not in event_tags:
+        raise ValueError("Item not found")
+    event_filter = {'owner_id': owner_id, '_id': ObjectId(event_id)}
+    current_tags = event_tags[event_id]
+
+    if operation.op == BulkOperationType.update:
+        fields = operation.fields.dict(exclude_unset=True, exclude_none=True)
+        if not fields:
+            raise ValueError("fields is empty")
+        if 'time_details' in fields:
+            fields['time_buckets'] = time_buckets(operation.fields.time_details)
+        added, removed = (), ()
+        if 'tags' in fields:
+            event_tags[event_id] = tag_names(fields)
+            added, removed = event_tags[event_id], current_tags
+        counted, uncounted = (), ()
+        if any(field in fields for field in SUMMARY_SOURCES):
+            current = event_summaries[event_id]
+            event_summaries[event_id] = {**current, **fields}
+            counted, uncounted = summary_keys(event_summaries[event_id]), summary_keys(current)
+        return PlannedWrite(event_id, UpdateOne(event_filter, versioned({'$set': fields})), added, removed,
+                            counted, uncounted)
+
+    if operation.op == BulkOperationType.add_tag:
+        tag = operation.tag.tag
+        if tag in current_tags or len(current_tags) >= 10:
+            raise ValueError("Validation Error")
+        event_tags[event_id] = current_tags + [tag]
+        # Same guards as add_tag_to_event in case the event changed since it was read
+        guarded_filter = {**event_filter, 'tags.tag': {'$ne': tag}, 'tags.9': {'$exists': False}}
+        return PlannedWrite(event_id, UpdateOne(guarded_filter, versioned({'$push': {'tags': operation.tag.dict()}})),
+                            added=[tag])
+
+    if operation.op == BulkOperationType.remove_tag:
+        tag = operation.tag.tag
+        if tag not in current_tags:
+            return PlannedWrite(event_id)
+        event_tags[event_id] = [name for name in current_tags if name != tag]
+        return PlannedWrite(event_id, UpdateOne(event_filter, versioned({'$pull': {'tags': operation.tag.dict()}})),
+                            removed=[tag])
+
+    del event_tags[event_id]
+    return PlannedWrite(event_id, DeleteOne(event_filter), removed=current_tags,
+                        uncounted=summary_keys(event_summaries.pop(event_id)))
+
+
+async def read_events(owner_id: str, event_ids) -> Dict[str, dict]:
+    """The tags, version and SUMMARY_SOURCES of the owner's events among event_ids, by id."""
+    if not event_ids:
+        return {}
+    events_cursor = get_collection('events').find(
+        {'owner_id': owner_id, '_id': {'$in': [ObjectId(event_id) for event_id in event_ids]}},
+        ['tags', 'version', *SUMMARY_SOURCES])
+    return {str(event['_id']): event async for event in events_cursor}
+
+
+async def publish_changes(owner_id: str, changes: List[Tuple[str, str]], read: Dict[str, dict]):
+    """Publishes the (change type, event id) of every successful write with one read of the events they left and
+    one feed write. Created and updated events carry their event and version, deleted ones the version read
+    before the request. An event deleted since its write is published without either."""
+    changed = [ObjectId(event_id) for change_type, event_id in changes if change_type != 'deleted']
+    events = {}
+    if changed:
+        events_cursor = get_collection('events').find({'owner_id': owner_id, '_id': {'$in': changed}},
+                                                      event_projection(None, 'version'))
+        events = {str(event['_id']): event async for event in events_cursor}
+    messages = []
+    for change_type, event_id in changes:
+        if change_type == 'deleted':
+            messages.append(change_message(change_type, event_id, read.get(event_id, {}).get('version')))
+        elif event_id in events:
+            messages.append(change_message(change_type, event_id, events[event_id]['version'], events[event_id]))
+        else:
+            messages.append(change_message(change_type, event_id))
+    await feed.publish_many(owner_id, messages)
+
+
+@BulkRouter.post("/bulk", response_model=BulkResponse)
+async def bulk_events(bulk_request: BulkRequest, current_user: DBUser = Depends(get_current_active_user)):
+    """Runs creates, updates, tag changes and deletes on the caller's events as one bulk_write.
+    Each item is validated on its own and reports its own result."""
+    owner_id = current_user.id
+    results = [BulkResult(index=index, ok=False) for index in range(len(bulk_request.operations))]
+    operations = {}
+    for index, item in enumerate(bulk_request.operations):
+        try:
+            operations[index] = parse_operation(item)
+        except ValueError as error:
+            results[index].error = describe(error)
+
+    # One read for the tags and counters of every referenced event, it also tells which events exist
+    read = await read_events(owner_id, {operation.event_id for operation in operations.values() if operation.event_id})
+    event_tags = {event_id: tag_names(event) for event_id, event in read.items()}
+    event_summaries = dict(read)
+
+    planned = {}
+    for index, operation in operations.items():
+        try:
+            planned[index] = plan_write(operation, owner_id, event_tags, event_summaries)
+        except ValueError as error:
+            results[index].error = describe(error)
+    writes = [(index, write) for index, write in planned.items() if write.request is not None]
+
+    # Unordered writes are grouped by type on the server, so keep the order when an event is touched twice
+    touched = [write.event_id for _, write in writes]
+    ordered = len(set(touched)) < len(touched)
+    failed = set()
+    write_counts = {'nMatched': 0, 'nRemoved': 0}
+    if writes:
+        try:
+            write_counts = (await get_collection('events').bulk_write([write.request for _, write in writes],
+                                                                      ordered=ordered)).bulk_api_result
+        except BulkWriteError as error:
+            write_counts = error.details
+            for write_error in error.details['writeErrors']:
+                index = writes[write_error['index']][0]
+                failed.add(index)
+                results[index].error = write_error['errmsg']
+            if ordered:
+                # An ordered bulk_write stops at its first error
+                for index, _ in writes[error.details['writeErrors'][0]['index'] + 1:]:
+                    failed.add(index)
+                    results[index].error = "Not run, an earlier operation failed"
+        for event_id in set(touched):
+            await invalidate_event(owner_id, event_id)
+        forget_graph(owner_id)
+
+    # The writes only match what the read found, unless an event changed in between
+    expected = Counter(type(write.request) for index, write in writes if index not in failed)
+    if write_counts['nMatched'] < expected[UpdateOne] or write_counts['nRemoved'] < expected[DeleteOne]:
+        # bulk_write does not tell which writes matched, so read what they left behind. Writes to an event deleted
+        # since the read, and tags another request added first, fail and leave the counts alone. A delete racing
+        # another delete of the same event cannot be told apart and still counts.
+        current = await read_events(owner_id, {write.event_id for _, write in writes if write.event_id in read})
+        unmatched, unsure = {}, {}
+        for index, write in writes:
+            operation = operations[index]
+            if index in failed or write.event_id not in read or operation.op == BulkOperationType.delete:
+                continue
+            if write.event_id not in current:
+                unmatched[index] = "Item not found"
+            elif operation.op == BulkOperationType.add_tag:
+                # With the tag there now, this write or another request added it
+                target = unsure if operation.tag.tag in tag_names(current[write.event_id]) else unmatched
+                target[index] = "Validation Error"
+        if expected[UpdateOne] - write_counts['nMatched'] - len(unmatched) >= len(unsure):
+            unmatched.update(unsure)
+        for index, error in unmatched.items():
+            failed.add(index)
+            results[index].error = error
+
+    added, removed, counted, uncounted = [], [], [], []
+    for index, write in planned.items():
+        if index not in failed:
+            results[index].ok = True
+            results[index].event_id = write.event_id
+            added += write.added
+            removed += write.removed
+            counted += write.counted
+            uncounted += write.uncounted
+    await count_tags(owner_id, added=added, removed=removed)
+    await count_summary(owner_id, added=counted, removed=uncounted)
+    deleted = [results[index].event_id for index, operation in operations.items()
+               if operation.op == BulkOperationType.delete and results[index].ok]
+    await delete_event_constraints(owner_id, deleted)
+    await add_tombstones(owner_id, deleted)
+    changes = [(CHANGE_TYPES[operations[index].op], write.event_id) for index, write in writes if index not in failed]
+    if changes and feed.listened(owner_id):
+        await publish_changes(owner_id, changes, read)
+    return BulkResponse(results=results)
@@ -1,65 +1,151 @@
+from string import hexdigits
+from typing import List, Optional
+
+import bson
 from bson import ObjectId
-from fastapi import Depends, HTTPException, APIRouter
+from fastapi import Depends, APIRouter, HTTPException, Query, Response
 from pydantic.color import Color
-
-from ..DB.Utilities import find_one_or_fail, update_one_or_fail
-from ..Models.Constraint import Constraint, EventStageConstraint, EventColorConstraint, EventTimeConstraint, \
-    NewConstraint, EventColor
+from pymongo import ASCENDING
+
+from ..DB import Constraints
+from ..DB.Constraints import constraint_document
+from ..DB.DB import get_collection
+from ..DB.Utilities import find_one_or_fail, find_one_and_delete_or_fail
+from ..Models.Constraint import EventStageConstraint, EventColorConstraint, EventTimeConstraint, EventColor, \
+    EventStage, EventTime, ConstraintType, NewTypedConstraint, StoredConstraint, TypedConstraint
+from ..Models.Event import stored_values
 from ..Models.User import DBUser
+from ..constraints import constraint_added, constraint_removed, get_graph
 from ..dependencies import get_current_active_user, user_and_event_filter
 
 ConstraintRouter = APIRouter(prefix="/events", tags=["constraints"])
 
-
-@ConstraintRouter.get("/constraint")
-async def get_all_constraints():
-    pass
+CONSTRAINT_PAGE_SIZE = 100
+CONSTRAINT_PAGE_MAX = 1000
 
 
-def add_constraint_to_event(current_user: DBUser, event_id, new_constraint):
-    if not find_one_or_fail('events', user_and_event_filter(current_user.id, event_id)):
+def constraint_filter(owner_id: str, event_id: str, constraint_id: str) -> dict:
+    """Filters: the constraint at constraint_id is on event_id, which owner_id owns. Invalid ids are 404"""
+    event_filter = user_and_event_filter(owner_id, event_id)
+    try:
+        return {'_id': ObjectId(constraint_id), 'owner_id': owner_id, 'event_id': str(event_filter['_id'])}
+    except bson.errors.InvalidId:
         raise HTTPException(status_code=404, detail="Item not found")
 
-    update_one_or_fail('events', user_and_event_filter(current_user.id, event_id),
-                       {"$push": {"constraints": new_constraint.dict()}})
+
+@ConstraintRouter.get("/constraint", response_model=List[StoredConstraint])
+async def get_all_constraints(response: Response,
+                              event_id: Optional[str] = Query(None, regex=f'^[{hexdigits}]{{24}}$'),
+                              constraint_type: Optional[ConstraintType] = None,
+                              limit: int = Query(CONSTRAINT_PAGE_SIZE, ge=1, le=CONSTRAINT_PAGE_MAX),
+                              after: Optional[str] = Query(None, regex=f'^[{hexdigits}]{{24}}$'),
+                              current_user: DBUser = Depends(get_current_active_user)):
+    """Returns a page of the caller's constraints ordered by id, only those on event_id or of constraint_type
+    when given. Paged like the event list through the X-Next-After header."""
+    query = {'owner_id': current_user.id}
+    if event_id:
+        query['event_id'] = event_id.lower()
+    if constraint_type:
+        query['constraint_type'] = constraint_type
+    if after:
+        query['_id'] = {'$gt': ObjectId(after)}
+    cursor = get_collection(Constraints.COLLECTION).find(query, sort=[('_id', ASCENDING)], limit=limit + 1)
+    constraints = await cursor.to_list(length=limit + 1)
+    if len(constraints) > limit:
+        constraints = constraints[:limit]
+        response.headers['X-Next-After'] = str(constraints[-1]['_id'])
+    return constraints
+
+
+@ConstraintRouter.get("/{event_id}/constraint", response_model=List[StoredConstraint])
+async def get_event_constraints(event_id, current_user: DBUser = Depends(get_current_active_user)):
+    """Returns every constraint on the event."""
+    event_filter = user_and_event_filter(current_user.id, event_id)
+    await find_one_or_fail('events', event_filter, projection={'_id': 1})
+    cursor = get_collection(Constraints.COLLECTION).find({'owner_id': current_user.id,
+                                                          'event_id': str(event_filter['_id'])},
+                                                         sort=[('_id', ASCENDING)])
+    return await cursor.to_list(length=None)
+
+
+@ConstraintRouter.get("/constraint/unblocked", response_model=List[str])
+async def get_unblocked_events(current_user: DBUser = Depends(get_current_active_user)):
+    """Ids of the caller's incomplete events whose constraints all hold now."""
+    return (await get_graph(current_user.id)).unblocked()
+
+
+@ConstraintRouter.get("/constraint/cycles", response_model=List[List[str]])
+async def get_constraint_cycles(current_user: DBUser = Depends(get_current_active_user)):
+    """Groups of the caller's events whose stage constraints wait on each other, none of them can be unblocked."""
+    return (await get_graph(current_user.id)).cycles()
+
+
+async def add_constraint_to_event(current_user: DBUser, event_id, new_constraint):
+    event_filter = user_and_event_filter(current_user.id, event_id)
+    await find_one_or_fail('events', event_filter, projection={'_id': 1})
+    document = constraint_document(current_user.id, str(event_filter['_id']), new_constraint.dict())
+    await get_collection(Constraints.COLLECTION).insert_one(document)
+    constraint_added(current_user.id, document)
 
 
 @ConstraintRouter.post("/{event_id}/constraint/color", response_model=EventColorConstraint)
 async def add_color(event_id, color: Color, current_user: DBUser = Depends(get_current_active_user)):
     valid_color = EventColor(color=color).dict()
     new_constraint = EventColorConstraint(**valid_color, name=color.as_named(fallback=True), _id=str(ObjectId()))
-    add_constraint_to_event(current_user=current_user,
-                            event_id=event_id,
-                            new_constraint=new_constraint)
+    await add_constraint_to_event(current_user=current_user,
+                                  event_id=event_id,
+                                  new_constraint=new_constraint)
     return new_constraint
 
 
-@ConstraintRouter.post("/{event_id}/constraint/date", response_model=EventColorConstraint)
-async def add_date(event_id, color: Color, current_user: DBUser = Depends(get_current_active_user)):
-    valid_color = EventColor(color=color).dict()
-    new_constraint = EventColorConstraint(**valid_color, name=color.as_named(fallback=True), _id=str(ObjectId()))
-    add_constraint_to_event(current_user=current_user,
-                            event_id=event_id,
-                            new_constraint=new_constraint)
+@ConstraintRouter.post("/{event_id}/constraint/date", response_model=EventTimeConstraint)
+async def add_date(event_id, window: EventTime, current_user: DBUser = Depends(get_current_active_user)):
+    """Makes the event wait until the current time is inside the window."""
+    new_constraint = EventTimeConstraint(**stored_values(window.dict()), name="Time window", _id=str(ObjectId()))
+    await add_constraint_to_event(current_user=current_user, event_id=event_id, new_constraint=new_constraint)
+    return new_constraint
+
 
+async def add_stage_constraint(current_user: DBUser, event_id, prerequisite_id,
+                               name: str = "Waits on event") -> EventStageConstraint:
+    event_id = str(user_and_event_filter(current_user.id, event_id)['_id'])
+    prerequisite_id = str(user_and_event_filter(current_user.id, prerequisite_id)['_id'])
+    graph = await get_graph(current_user.id)
+    if prerequisite_id not in graph.stages:
+        raise HTTPException(status_code=404, detail="Item not found")
+    # Checked against this worker's graph, a cycle closed by concurrent requests shows up in /constraint/cycles
+    if graph.would_cycle(event_id, prerequisite_id):
+        raise HTTPException(status_code=422, detail="Constraint would create a cycle")
+    new_constraint = EventStageConstraint(event_id=prerequisite_id, name=name, _id=str(ObjectId()))
+    await add_constraint_to_event(current_user, event_id, new_constraint)
     return new_constraint
 
 
-@ConstraintRouter.post("/{event_id}/constraint", response_model=Constraint)
-async def add_event_constraint(event_id, constraint: NewConstraint,
+@ConstraintRouter.post("/{event_id}/constraint/stage", response_model=EventStageConstraint)
+async def add_stage(event_id, prerequisite: EventStage, current_user: DBUser = Depends(get_current_active_user)):
+    """Makes the event wait until the event prerequisite.event_id is complete."""
+    return await add_stage_constraint(current_user, event_id, prerequisite.event_id)
+
+
+@ConstraintRouter.post("/{event_id}/constraint", response_model=TypedConstraint)
+async def add_event_constraint(event_id, constraint: NewTypedConstraint,
                                current_user: DBUser = Depends(get_current_active_user)):
-    """Adds a constraint to the event indicated by the provided event_id"""
-    allowed_constraints = {"EventStageConstraint": EventStageConstraint,
-                           "EventColorConstraint": EventColorConstraint,
-                           "EventTimeConstraint": EventTimeConstraint
-                           }
-    final_constraint = allowed_constraints[constraint.constraint_type](**constraint.dict(), _id=ObjectId())
-    add_constraint_to_event(current_user, event_id, final_constraint)
+    """Adds a constraint of any type to the event indicated by the provided event_id, with the fields its
+    constraint_type needs. Checked and stored as by the route of that type."""
+    if constraint.constraint_type == ConstraintType.stage:
+        return await add_stage_constraint(current_user, event_id, constraint.event_id, constraint.name)
+    allowed_constraints = {ConstraintType.time: EventTimeConstraint, ConstraintType.color: EventColorConstraint}
+    final_constraint = allowed_constraints[constraint.constraint_type](**stored_values(constraint.dict()),
+                                                                       _id=str(ObjectId()))
+    await add_constraint_to_event(current_user, event_id, final_constraint)
     return final_constraint
 
 
-@ConstraintRouter.delete("/{event_id}/constraint/{constraint_id}", response_model=Constraint)
-async def delete_event_constraint(event_id: str, constraint_id: str):
+@ConstraintRouter.delete("/{event_id}/constraint/{constraint_id}", response_model=StoredConstraint)
+async def delete_event_constraint(event_id: str, constraint_id: str,
+                                  current_user: DBUser = Depends(get_current_active_user)):
     """Deletes a constraint indicated by constaint_id from an event indicated by the provided event_id"""
-    print(event_id)  # TODO event_id must match an actual event_id
-    return constraint_id
+    results = await find_one_and_delete_or_fail(Constraints.COLLECTION,
+                                                constraint_filter(current_user.id, event_id, constraint_id))
+    constraint_removed(current_user.id, results)
+    return results
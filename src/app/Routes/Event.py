@@ -1,139 +1,474 @@
+import os
+import re
+from datetime import datetime, timedelta
 from string import hexdigits
-from typing import List
+from typing import List, Optional, Tuple, Union
 
-from fastapi import APIRouter, Depends, Path, Body, HTTPException
-from pydantic import ValidationError
+import bson
+import orjson
+from bson import ObjectId
+from fastapi import APIRouter, Depends, Path, Body, Header, HTTPException, Query, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pymongo import ReturnDocument, ASCENDING, DESCENDING
 
+from ..DB.Constraints import delete_event_constraints
 from ..DB.DB import get_collection
-from ..DB.Utilities import find_one_or_fail, delete_one_or_fail, update_one_or_fail
+from ..DB.Summaries import count_summary, find_summary, summary_keys
+from ..DB.TagCounts import count_tags, find_tag_counts
+from ..DB.Tombstones import COLLECTION as TOMBSTONES, TOMBSTONE_TTL_DAYS, add_tombstones
+from ..DB.Utilities import event_cache, event_key, find_one_or_fail, invalidate_event, load_event_or_fail
 from ..Models.Constraint import EventColor
-from ..Models.Event import EventResponse, NewEvent, NewEventInDB, Stage, EventInDB, Tag, Tags
+from ..Models.Event import EventChanges, EventResponse, EventSummary, NewEvent, NewEventInDB, PartialEventResponse, \
+    Stage, Tag, Tags, TagCount, EVENT_RESPONSE_FIELDS, as_utc, ceil_day, etag_versions, event_etag, event_projection, \
+    event_response, floor_day, month_buckets, stored_values, time_buckets, utc_now, versioned
 from ..Models.User import DBUser
+from ..constraints import event_changed, event_removed
 from ..dependencies import get_current_active_user, user_and_event_filter
+from ..feed import event_stream, feed, publish
+from ..metrics import phase
 
 EventRouter = APIRouter(prefix="/events", tags=["events"])
 eventIDType = Path(..., regex=f'[{hexdigits}]+', max_length=24)
 
+EVENT_PAGE_SIZE = 100
+EVENT_PAGE_MAX = 1000
+EVENT_STREAM_BATCH = 500
+TAG_SUGGESTIONS_MAX = 50
+# Relevance order has no key to resume from, so search pages by skip and deep pages are capped
+SEARCH_SKIP_MAX = 10000
+# Seconds of writes a sync reads again, covering writes that commit late and clock skew between workers
+SYNC_OVERLAP = float(os.getenv('SYNC_OVERLAP', 5))
 
-@EventRouter.get("/events/", response_model=List[EventResponse])
-async def get_all_events(current_user: DBUser = Depends(get_current_active_user)):
-    """Returns list of all events"""
+
+def tag_names(event: dict) -> List[str]:
+    return [tag['tag'] for tag in event.get('tags', [])]
+
+
+def selected_fields(fields: Optional[str] = Query(None, description=(
+                        "Comma separated subset of " + ", ".join(EVENT_RESPONSE_FIELDS) + ", _id is always included"))
+                    ) -> Optional[Tuple[str, ...]]:
+    """The fields= parameter of event reads, None when every field is wanted."""
+    if fields is None:
+        return None
+    selected = tuple(dict.fromkeys(field.strip() for field in fields.split(',') if field.strip() not in ('', '_id')))
+    unknown = [field for field in selected if field not in EVENT_RESPONSE_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown fields: {', '.join(unknown)}")
+    return selected
+
+
+def event_json(event: dict, fields: Optional[Tuple[str, ...]] = None) -> ORJSONResponse:
+    """Sends a stored event as EventResponse, skipping the response_model validation."""
+    etag = event_etag(event)
+    with phase('serialize'):
+        return ORJSONResponse(event_response(event, fields), headers={'ETag': etag} if etag else None)
+
+
+def events_json(events: List[dict], headers: Optional[dict] = None,
+                fields: Optional[Tuple[str, ...]] = None) -> ORJSONResponse:
+    with phase('serialize'):
+        return ORJSONResponse([event_response(event, fields) for event in events], headers=headers)
+
+
+def if_match(if_match: Optional[str] = Header(None)) -> dict:
+    """If-Match as a filter on the event version, so the write itself checks it. Empty without the header or for *."""
+    if if_match is None or if_match.strip() == '*':
+        return {}
+    return {'version': {'$in': etag_versions(if_match)}}
+
+
+async def read_event(owner_id: str, event_id: str, if_none_match: Optional[str]) -> Union[dict, Response]:
+    """The event for a GET, or the 304 answering If-None-Match. Hot events come from event_cache, otherwise a poll
+    costs a version lookup covered by the owner_id__id_version index and only a changed event is read in full."""
+    event_filter = user_and_event_filter(owner_id, event_id)
+    results = await event_cache.get(event_key(owner_id, event_id))
+    if if_none_match is not None:
+        current = results or await find_one_or_fail('events', event_filter, projection={'version': 1})
+        etag = event_etag(current)
+        if etag and (if_none_match.strip() == '*' or current['version'] in etag_versions(if_none_match)):
+            return Response(status_code=304, headers={'ETag': etag})
+    if results is None:
+        results = await load_event_or_fail(owner_id, event_id, event_filter)
+    return results
+
+
+async def unmatched(event_filter: dict, precondition: dict) -> dict:
+    """Explains a conditional write that matched nothing, 404 when the event is gone and 412 when If-Match
+    named another version. Returns the event when neither holds, only runs on this failure path."""
+    results = await find_one_or_fail('events', event_filter)
+    if precondition and results.get('version') not in precondition['version']['$in']:
+        raise HTTPException(status_code=412, detail="Event was modified")
+    return results
+
+
+async def update_event(event_filter: dict, precondition: dict, update: dict, **kwargs) -> dict:
+    """find_one_and_update of one event under its If-Match precondition, the updated event by default."""
+    kwargs.setdefault('return_document', ReturnDocument.AFTER)
+    results = await get_collection('events').find_one_and_update({**event_filter, **precondition}, update, **kwargs)
+    await invalidate_event(event_filter['owner_id'], event_filter['_id'])
+    if results is None:
+        await unmatched(event_filter, precondition)
+        # Changed between the write and the lookup
+        raise HTTPException(status_code=412, detail="Event was modified")
+    return results
+
+
+async def set_event_fields(event_filter: dict, precondition: dict, fields: dict) -> Tuple[dict, dict]:
+    """Sets fields of one event under its If-Match precondition, returns the event before and after the write. The
+    after document is the before one with the update applied as mongo stores it, so it matches what reads return."""
+    update = versioned({"$set": fields})
+    before = await update_event(event_filter, precondition, update, return_document=ReturnDocument.BEFORE)
+    return before, {**before, **stored_values(update["$set"]), "version": before.get("version", 0) + 1}
+
+
+async def stream_events(events_cursor, fields: Optional[Tuple[str, ...]] = None):
+    """Yields NDJSON while the cursor is read, one chunk per batch."""
+    lines = []
+    async for event in events_cursor:
+        lines.append(orjson.dumps(event_response(event, fields)))
+        if len(lines) == EVENT_STREAM_BATCH:
+            yield b'\n'.join(lines) + b'\n'
+            lines = []
+    if lines:
+        yield b'\n'.join(lines) + b'\n'
+
+
+@EventRouter.get("/events/", response_model=List[PartialEventResponse])
+async def get_all_events(limit: int = Query(EVENT_PAGE_SIZE, ge=1, le=EVENT_PAGE_MAX),
+                         after: Optional[str] = Query(None, regex=f'^[{hexdigits}]{{24}}$'),
+                         stream: bool = False,
+                         tag: Optional[str] = Query(None, min_length=1, max_length=64),
+                         fields: Optional[Tuple[str, ...]] = Depends(selected_fields),
+                         current_user: DBUser = Depends(get_current_active_user)):
+    """Returns a page of events ordered by id, only those carrying `tag` when given. While more remain the
+    X-Next-After header holds the value to pass as `after` for the next page. With stream=true every event from
+    `after` on is sent as NDJSON instead."""
+    query = {'owner_id': current_user.id}
+    if tag:
+        query['tags.tag'] = tag
+    if after:
+        query['_id'] = {'$gt': ObjectId(after)}
     events_collection = get_collection('events')
-    events_cursor = events_collection.find({'owner_id': current_user.id})
-    return [event for event in events_cursor]
+    if stream:
+        events_cursor = events_collection.find(query, event_projection(fields), sort=[('_id', ASCENDING)],
+                                               batch_size=EVENT_STREAM_BATCH)
+        return StreamingResponse(stream_events(events_cursor, fields), media_type='application/x-ndjson')
+
+    # One extra document tells whether another page exists
+    events_cursor = events_collection.find(query, event_projection(fields), sort=[('_id', ASCENDING)],
+                                           limit=limit + 1)
+    events = await events_cursor.to_list(length=limit + 1)
+    headers = {}
+    if len(events) > limit:
+        events = events[:limit]
+        headers['X-Next-After'] = str(events[-1]['_id'])
+    return events_json(events, headers, fields)
+
+
+def range_cursor(event) -> str:
+    return f"{event['time_details']['start_time'].isoformat()}_{event['_id']}"
+
+
+def parse_range_cursor(cursor: str):
+    """The datetime and id of a cursor or sync token, the datetime as naive UTC whatever offset it was sent with."""
+    try:
+        start_time, event_id = cursor.rsplit('_', 1)
+        return as_utc(datetime.fromisoformat(start_time)), ObjectId(event_id)
+    except (ValueError, bson.errors.InvalidId):
+        raise HTTPException(status_code=422, detail="Invalid cursor")
+
+
+@EventRouter.get("/range", response_model=List[PartialEventResponse])
+async def get_events_in_range(start: datetime, end: datetime,
+                              limit: int = Query(EVENT_PAGE_SIZE, ge=1, le=EVENT_PAGE_MAX),
+                              after: Optional[str] = None,
+                              fields: Optional[Tuple[str, ...]] = Depends(selected_fields),
+                              current_user: DBUser = Depends(get_current_active_user)):
+    """Returns events whose time_details overlap [start, end), ordered by start time. All day events cover
+    every day from the day of start_time through the day of end_time. Paged like the event list through the
+    X-Next-After header."""
+    start, end = as_utc(start), as_utc(end)
+    if end <= start:
+        raise HTTPException(status_code=422, detail="end must be after start")
+
+    query = {
+        'owner_id': current_user.id,
+        # Bounds the index scan to the months the window touches
+        'time_buckets': {'$in': month_buckets(floor_day(start), end)},
+        '$and': [{'$or': [
+            {'time_details.all_day': {'$ne': True},
+             'time_details.start_time': {'$lt': end}, 'time_details.end_time': {'$gt': start}},
+            {'time_details.all_day': True,
+             'time_details.start_time': {'$lt': ceil_day(end)}, 'time_details.end_time': {'$gte': floor_day(start)}},
+        ]}],
+    }
+    if after:
+        after_start, after_id = parse_range_cursor(after)
+        query['$and'].append({'$or': [
+            {'time_details.start_time': {'$gt': after_start}},
+            {'time_details.start_time': after_start, '_id': {'$gt': after_id}},
+        ]})
+
+    events_cursor = get_collection('events').find(
+        query, event_projection(fields, 'time_details.start_time'),
+        sort=[('time_details.start_time', ASCENDING), ('_id', ASCENDING)], limit=limit + 1)
+    events = await events_cursor.to_list(length=limit + 1)
+    headers = {}
+    if len(events) > limit:
+        events = events[:limit]
+        headers['X-Next-After'] = range_cursor(events[-1])
+    return events_json(events, headers, fields)
+
+
+@EventRouter.get("/search", response_model=List[PartialEventResponse])
+async def search_events(q: str = Query(..., min_length=1, max_length=256),
+                        limit: int = Query(EVENT_PAGE_SIZE, ge=1, le=EVENT_PAGE_MAX),
+                        skip: int = Query(0, ge=0, le=SEARCH_SKIP_MAX),
+                        fields: Optional[Tuple[str, ...]] = Depends(selected_fields),
+                        current_user: DBUser = Depends(get_current_active_user)):
+    """Full text search over the name, description and tags of the caller's events, most relevant first.
+    While more results remain the X-Next-Skip header holds the value to pass as `skip` for the next page."""
+    events_cursor = get_collection('events').find(
+        {'owner_id': current_user.id, '$text': {'$search': q}},
+        {**event_projection(fields), 'score': {'$meta': 'textScore'}},
+        sort=[('score', {'$meta': 'textScore'})], skip=skip, limit=limit + 1)
+    events = await events_cursor.to_list(length=limit + 1)
+    headers = {}
+    if len(events) > limit:
+        events = events[:limit]
+        headers['X-Next-Skip'] = str(skip + limit)
+    return events_json(events, headers, fields)
+
+
+def sync_token(updated_at: datetime, event_id) -> str:
+    return f"{updated_at.isoformat()}_{event_id}"
+
+
+@EventRouter.get("/changes", response_model=EventChanges)
+async def get_event_changes(since: Optional[str] = None,
+                            limit: int = Query(EVENT_PAGE_SIZE, ge=1, le=EVENT_PAGE_MAX),
+                            fields: Optional[Tuple[str, ...]] = Depends(selected_fields),
+                            current_user: DBUser = Depends(get_current_active_user)):
+    """Events created or modified and ids of events deleted since the `since` token, every event without it.
+    Pass `next` back as `since` while `more` holds, and again on the next sync. Changes of the last SYNC_OVERLAP
+    seconds can come twice, apply them by id. 410 means the token is older than the deletions kept, refetch."""
+    query = {'owner_id': current_user.id}
+    if since:
+        updated_at, event_id = parse_range_cursor(since)
+        if updated_at < utc_now() - timedelta(days=TOMBSTONE_TTL_DAYS):
+            raise HTTPException(status_code=410, detail="Sync token expired, refetch all events")
+        query['$or'] = [{'updated_at': {'$gt': updated_at}}, {'updated_at': updated_at, '_id': {'$gt': event_id}}]
+    sort = [('updated_at', ASCENDING), ('_id', ASCENDING)]
+    synced_at = utc_now()
+    events = await get_collection('events').find(query, event_projection(fields, 'updated_at'), sort=sort,
+                                                 limit=limit + 1).to_list(length=limit + 1)
+    tombstones = await get_collection(TOMBSTONES).find(query, {'updated_at': 1}, sort=sort,
+                                                       limit=limit + 1).to_list(length=limit + 1)
+    changes = sorted(events + tombstones, key=lambda change: (change['updated_at'], change['_id']))
+    more = len(changes) > limit
+    changes = changes[:limit]
+    if more:
+        next_token = sync_token(changes[-1]['updated_at'], changes[-1]['_id'])
+    else:
+        # Writers stamp updated_at before their write lands, so a slow one can commit behind a position already
+        # handed out. The last page resumes SYNC_OVERLAP seconds back to pick those up.
+        next_token = sync_token(synced_at - timedelta(seconds=SYNC_OVERLAP), ObjectId('0' * 24))
+    deleted = {tombstone['_id'] for tombstone in tombstones}
+    with phase('serialize'):
+        return ORJSONResponse({
+            'events': [event_response(change, fields) for change in changes if change['_id'] not in deleted],
+            'deleted': [str(change['_id']) for change in changes if change['_id'] in deleted],
+            'next': next_token, 'more': more,
+        })
+
+
+@EventRouter.get("/summary", response_model=EventSummary)
+async def get_event_summary(current_user: DBUser = Depends(get_current_active_user)):
+    """Counts of the caller's events by stage, color and start week, read from one counters document."""
+    return ORJSONResponse(await find_summary(current_user.id))
+
+
+@EventRouter.get("/feed", response_class=StreamingResponse)
+async def event_feed(current_user: DBUser = Depends(get_current_active_user)):
+    """Server-Sent Events of changes to the caller's events. Each of created, updated and deleted carries the
+    event_id and version, created and updated also the event. A resync means changes were dropped because the
+    client fell behind, it should refetch its events."""
+    subscription = feed.subscribe(current_user.id)
+    return StreamingResponse(event_stream(subscription), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@EventRouter.get("/tags/autocomplete", response_model=List[TagCount], tags=["tags"])
+async def autocomplete_tags(prefix: str = Query(..., min_length=1, max_length=64),
+                            limit: int = Query(10, ge=1, le=TAG_SUGGESTIONS_MAX),
+                            current_user: DBUser = Depends(get_current_active_user)):
+    """Returns the caller's tags starting with prefix, alphabetically."""
+    return await find_tag_counts(current_user.id, {'tag': {'$regex': f'^{re.escape(prefix)}'}},
+                                 sort=[('tag', ASCENDING)], limit=limit)
+
+
+@EventRouter.get("/tags/facets", response_model=List[TagCount], tags=["tags"])
+async def get_tag_facets(limit: int = Query(TAG_SUGGESTIONS_MAX, ge=1, le=EVENT_PAGE_MAX),
+                         current_user: DBUser = Depends(get_current_active_user)):
+    """Returns the caller's tags with the number of events carrying each, most used first."""
+    return await find_tag_counts(current_user.id, sort=[('count', DESCENDING), ('tag', ASCENDING)], limit=limit)
 
 
 @EventRouter.post("/events/", response_model=EventResponse)
 async def add_event(event_data: NewEvent, current_user: DBUser = Depends(get_current_active_user)):
-    new_event = NewEventInDB(**event_data.dict(), owner_id=current_user.id, stage=Stage.started)
+    new_event = stored_values(NewEventInDB(**event_data.dict(), owner_id=current_user.id, stage=Stage.started).dict())
     events_collection = get_collection('events')
-    results = events_collection.insert_one(new_event.dict())
-    return EventInDB(**new_event.dict(), _id=str(results.inserted_id))
+    await events_collection.insert_one(new_event)  # sets new_event['_id']
+    await count_tags(current_user.id, added=tag_names(new_event))
+    await count_summary(current_user.id, added=summary_keys(new_event))
+    event_changed(current_user.id, new_event)
+    await publish(current_user.id, 'created', new_event['_id'], new_event['version'], new_event)
+    return event_json(new_event)
 
 
-@EventRouter.get("/events/{event_id}", response_model=EventResponse)
-async def get_event(event_id: str = eventIDType,
+@EventRouter.get("/events/{event_id}", response_model=PartialEventResponse)
+async def get_event(event_id: str = eventIDType, fields: Optional[Tuple[str, ...]] = Depends(selected_fields),
+                    if_none_match: Optional[str] = Header(None),
                     current_user: DBUser = Depends(get_current_active_user)):
-    results = find_one_or_fail('events', user_and_event_filter(current_user.id, event_id))
-    return results
+    """Returns the event with its version as the ETag, or 304 when If-None-Match holds that version."""
+    results = await read_event(current_user.id, event_id, if_none_match)
+    if isinstance(results, Response):
+        return results
+    return event_json(results, fields)
 
 
 @EventRouter.post("/events/{event_id}/set", response_model=EventResponse)
 async def set_event_attributes(event_data: NewEvent, event_id: str = eventIDType,
+                               precondition: dict = Depends(if_match),
                                current_user: DBUser = Depends(get_current_active_user)):
-    update_one_or_fail('events', user_and_event_filter(current_user.id, event_id), {"$set": event_data.dict()})
-    results = EventInDB(**find_one_or_fail('events', user_and_event_filter(current_user.id, event_id)))
-    return results
+    fields = {**event_data.dict(), "time_buckets": time_buckets(event_data.time_details)}
+    before, results = await set_event_fields(user_and_event_filter(current_user.id, event_id), precondition, fields)
+    await count_tags(current_user.id, added=tag_names(results), removed=tag_names(before))
+    await count_summary(current_user.id, added=summary_keys(results), removed=summary_keys(before))
+    event_changed(current_user.id, results)
+    await publish(current_user.id, 'updated', results['_id'], results['version'], results)
+    return event_json(results)
 
 
 @EventRouter.post("/events/{event_id}/set/name", response_model=EventResponse, tags=["modify attributes"])
 async def set_event_name(event_id: str, name: str = Body(..., min_length=1, max_length=64),
+                         precondition: dict = Depends(if_match),
                          current_user: DBUser = Depends(get_current_active_user)):
     """Allows the name of an event to be set."""
-    update_one_or_fail('events', user_and_event_filter(current_user.id, event_id), {"$set": {"name": name}})
-    results = EventInDB(**find_one_or_fail('events', user_and_event_filter(current_user.id, event_id)))
-    return results
+    results = await update_event(user_and_event_filter(current_user.id, event_id), precondition,
+                                 versioned({"$set": {"name": name}}))
+    await publish(current_user.id, 'updated', results['_id'], results['version'], results)
+    return event_json(results)
 
 
 @EventRouter.post("/events/{event_id}/set/description", response_model=EventResponse, tags=["modify attributes"])
 async def set_event_description(event_id: str, description: str = Body(..., max_length=256),
+                                precondition: dict = Depends(if_match),
                                 current_user: DBUser = Depends(get_current_active_user)):
     """Allows the description of an event to be set."""
-    update_one_or_fail('events', user_and_event_filter(current_user.id, event_id),
-                       {"$set": {"description": description}})
-    results = EventInDB(**find_one_or_fail('events', user_and_event_filter(current_user.id, event_id)))
-    return results
+    results = await update_event(user_and_event_filter(current_user.id, event_id), precondition,
+                                 versioned({"$set": {"description": description}}))
+    await publish(current_user.id, 'updated', results['_id'], results['version'], results)
+    return event_json(results)
 
 
 @EventRouter.post("/events/{event_id}/set/tags", response_model=EventResponse, tags=["modify attributes", "tags"])
 async def set_event_tags(event_id: str, tags: List[Tag] = Body(..., max_items=10),
+                         precondition: dict = Depends(if_match),
                          current_user: DBUser = Depends(get_current_active_user)):
     """Allows the tags of an event to be set. Overwrites tags not in body of request."""
-    update_one_or_fail('events', user_and_event_filter(current_user.id, event_id),
-                       {"$set": {"tags": [tag.dict() for tag in tags]}})
-    results = EventInDB(**find_one_or_fail('events', user_and_event_filter(current_user.id, event_id)))
-    return results
-
-
-def wrap_in_model(model, model_to_wrap):
-    try:
-        return model(**model_to_wrap.dict(by_alias=True))
-    except ValidationError:
-        raise HTTPException(status_code=422, detail="Validation Error")
+    before, results = await set_event_fields(user_and_event_filter(current_user.id, event_id), precondition,
+                                             {"tags": [tag.dict() for tag in tags]})
+    await count_tags(current_user.id, added=tag_names(results), removed=tag_names(before))
+    await publish(current_user.id, 'updated', results['_id'], results['version'], results)
+    return event_json(results)
 
 
 @EventRouter.post("/events/{event_id}/tags", response_model=EventResponse, tags=["modify attributes", "tags"])
-async def add_tag_to_event(event_id: str, tag: Tag,
+async def add_tag_to_event(event_id: str, tag: Tag, precondition: dict = Depends(if_match),
                            current_user: DBUser = Depends(get_current_active_user)):
     """Allows a tag to be added to an event"""
-    event = EventInDB(**find_one_or_fail('events', user_and_event_filter(current_user.id, event_id)))
-    event.tags.append(tag)
-    results = wrap_in_model(EventInDB, event)
-    update_one_or_fail('events', user_and_event_filter(current_user.id, event_id),
-                       {"$addToSet": {"tags": tag.dict()}})
-    return results
+    event_filter = user_and_event_filter(current_user.id, event_id)
+    # Only matches while the tag is new and the event has room for it (Tags allows 10)
+    results = await get_collection('events').find_one_and_update(
+        {**event_filter, **precondition, "tags.tag": {"$ne": tag.tag}, "tags.9": {"$exists": False}},
+        versioned({"$push": {"tags": tag.dict()}}), return_document=ReturnDocument.AFTER)
+    await invalidate_event(current_user.id, event_id)
+    if results is None:
+        await unmatched(event_filter, precondition)
+        raise HTTPException(status_code=422, detail="Validation Error")
+    await count_tags(current_user.id, added=[tag.tag])
+    await publish(current_user.id, 'updated', results['_id'], results['version'], results)
+    return event_json(results)
 
 
 @EventRouter.delete("/events/{event_id}/tags", response_model=EventResponse, tags=["modify attributes", "tags"])
-async def delete_tag_from_event(event_id: str, tag: Tag,
+async def delete_tag_from_event(event_id: str, tag: Tag, precondition: dict = Depends(if_match),
                                 current_user: DBUser = Depends(get_current_active_user)):
     """Allows a tag to be removed to an event"""
-    update_one_or_fail('events', user_and_event_filter(current_user.id, event_id),
-                       {"$pull": {"tags": tag.dict()}})
-    results = EventInDB(**find_one_or_fail('events', user_and_event_filter(current_user.id, event_id)))
-    return results
+    event_filter = user_and_event_filter(current_user.id, event_id)
+    results = await get_collection('events').find_one_and_update(
+        {**event_filter, **precondition, "tags": tag.dict()}, versioned({"$pull": {"tags": tag.dict()}}),
+        return_document=ReturnDocument.AFTER)
+    await invalidate_event(current_user.id, event_id)
+    if results is None:
+        # Tag was not on the event, nothing to remove
+        return event_json(await unmatched(event_filter, precondition))
+    await count_tags(current_user.id, removed=[tag.tag])
+    await publish(current_user.id, 'updated', results['_id'], results['version'], results)
+    return event_json(results)
 
 
 @EventRouter.get("/events/{event_id}/tags", response_model=Tags, tags=["modify attributes", "tags"])
-async def get_all_tags_from_event(event_id: str,
+async def get_all_tags_from_event(event_id: str, if_none_match: Optional[str] = Header(None),
                                   current_user: DBUser = Depends(get_current_active_user)):
-    """Returns all tags belonging to an event"""
-    results = EventInDB(**find_one_or_fail('events', user_and_event_filter(current_user.id, event_id)))
-    return Tags(tags=results.tags)
+    """Returns all tags belonging to an event, conditional on If-None-Match like get_event"""
+    results = await read_event(current_user.id, event_id, if_none_match)
+    if isinstance(results, Response):
+        return results
+    etag = event_etag(results)
+    return ORJSONResponse({'tags': results.get('tags', [])}, headers={'ETag': etag} if etag else None)
 
 
 @EventRouter.post("/events/{event_id}/set/presentation", response_model=EventResponse, tags=["modify attributes"])
 async def set_event_color(event_id: str, presentation: EventColor,
+                          precondition: dict = Depends(if_match),
                           current_user: DBUser = Depends(get_current_active_user)):
     """Allows the presentation info of an event to be set."""
-    update_one_or_fail('events', user_and_event_filter(current_user.id, event_id),
-                       {"$set": {"presentation": presentation.dict()}})
-    results = EventInDB(**find_one_or_fail('events', user_and_event_filter(current_user.id, event_id)))
-    return results
+    before, results = await set_event_fields(user_and_event_filter(current_user.id, event_id), precondition,
+                                             {"presentation": presentation.dict()})
+    await count_summary(current_user.id, added=summary_keys(results), removed=summary_keys(before))
+    event_changed(current_user.id, results)
+    await publish(current_user.id, 'updated', results['_id'], results['version'], results)
+    return event_json(results)
 
 
 @EventRouter.post("/events/{event_id}/set/stage", response_model=EventResponse)
-async def set_event_stage(event_id: str, stage: Stage, current_user: DBUser = Depends(get_current_active_user)):
+async def set_event_stage(event_id: str, stage: Stage, precondition: dict = Depends(if_match),
+                          current_user: DBUser = Depends(get_current_active_user)):
     """Allows the stage of an event to be set."""
-    update_one_or_fail('events', user_and_event_filter(current_user.id, event_id), {"$set": {"stage": stage}})
-    results = EventInDB(**find_one_or_fail('events', user_and_event_filter(current_user.id, event_id)))
-    return results
+    before, results = await set_event_fields(user_and_event_filter(current_user.id, event_id), precondition,
+                                             {"stage": stage})
+    await count_summary(current_user.id, added=summary_keys(results), removed=summary_keys(before))
+    event_changed(current_user.id, results)
+    await publish(current_user.id, 'updated', results['_id'], results['version'], results)
+    return event_json(results)
 
 
 @EventRouter.delete("/events/{event_id}", response_model=EventResponse)
-async def delete_event(event_id: str = eventIDType,
+async def delete_event(event_id: str = eventIDType, precondition: dict = Depends(if_match),
                        current_user: DBUser = Depends(get_current_active_user)):
     """Deletes an event from storage."""
-    results = EventInDB(**find_one_or_fail('events', user_and_event_filter(current_user.id, event_id)))
-    delete_one_or_fail('events', user_and_event_filter(current_user.id, event_id))
-    return results
+    event_filter = user_and_event_filter(current_user.id, event_id)
+    results = await get_collection('events').find_one_and_delete({**event_filter, **precondition})
+    await invalidate_event(current_user.id, event_id)
+    if results is None:
+        await unmatched(event_filter, precondition)
+        raise HTTPException(status_code=412, detail="Event was modified")
+    await count_tags(current_user.id, removed=tag_names(results))
+    await count_summary(current_user.id, removed=summary_keys(results))
+    await delete_event_constraints(current_user.id, [str(results['_id'])])
+    await add_tombstones(current_user.id, [results['_id']], {str(results['_id']): results.get('version')})
+    event_removed(current_user.id, results['_id'])
+    await publish(current_user.id, 'deleted', results['_id'], results.get('version'))
+    return event_json(results)
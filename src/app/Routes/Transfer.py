@@ -0,0 +1,32 @@
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import StreamingResponse
+
+from ..DB.Transfer import export_events, import_events
+from ..Models.Transfer import ImportResponse, TransferFormat
+from ..Models.User import DBUser
+from ..constraints import forget_graph
+from ..dependencies import get_current_active_user
+
+TransferRouter = APIRouter(prefix="/events", tags=["transfer"])
+
+MEDIA_TYPES = {TransferFormat.ndjson: 'application/x-ndjson', TransferFormat.bson: 'application/bson'}
+
+
+@TransferRouter.get("/export", response_class=StreamingResponse)
+async def export_all_events(format: TransferFormat = TransferFormat.ndjson, compress: bool = True,
+                            current_user: DBUser = Depends(get_current_active_user)):
+    """Streams every event of the caller as a file for import_all_events, gzip compressed unless compress=false."""
+    filename = f"events.{format.value}{'.gz' if compress else ''}"
+    return StreamingResponse(export_events(current_user.id, format, compress),
+                             media_type='application/gzip' if compress else MEDIA_TYPES[format],
+                             headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+@TransferRouter.post("/import", response_model=ImportResponse)
+async def import_all_events(request: Request, format: TransferFormat = TransferFormat.ndjson,
+                            current_user: DBUser = Depends(get_current_active_user)):
+    """Adds the events of an export sent as the request body, gzip compressed or not, as new events of the caller.
+    Each event is validated on its own and the response lists the first failures."""
+    result = await import_events(current_user.id, request.stream(), format)
+    forget_graph(current_user.id)
+    return result.dict()
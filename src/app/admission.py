@@ -0,0 +1,87 @@
+"""Admission control in front of the routers, so one busy client or a slow db cannot take every worker with it.
+
+Each check fails fast rather than queueing, which keeps latency bounded for the requests let in:
+
+- per-user token buckets, 429 once a user spends RATE_LIMIT_BURST requests faster than RATE_LIMIT_RATE per second
+- per-route concurrency, 503 past ROUTE_CONCURRENCY requests of one route in flight on this worker
+- load shedding, 503 while SHED_DB_OPERATIONS or more db operations hold or wait for a pooled connection
+
+Every limit is per worker, and 0 turns it off.
+"""
+import math
+import os
+import time
+from typing import Dict
+
+from fastapi import HTTPException, Request
+from starlette import status
+
+from .DB.Cache import TTLCache
+from .DB.DB import MONGO_MAX_POOL_SIZE
+from .metrics import Counter, Gauge, METRICS, db_operations
+
+RATE_LIMIT_RATE = float(os.getenv('RATE_LIMIT_RATE', 20))  # Requests per second each user is allowed
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', 60))
+RATE_LIMIT_USERS = int(os.getenv('RATE_LIMIT_USERS', 100000))  # Buckets kept, an evicted one starts full
+ROUTE_CONCURRENCY = int(os.getenv('ROUTE_CONCURRENCY', 64))
+# Per route overrides by handler name, e.g. "bulk_events=4,search_events=16"
+ROUTE_CONCURRENCY_LIMITS: Dict[str, int] = {
+    name.strip(): int(limit)
+    for name, limit in (item.split('=') for item in os.getenv('ROUTE_CONCURRENCY_LIMITS', '').split(',') if item)
+}
+# Operations running and queued for a connection, twice the pool means as many waiting as running
+SHED_DB_OPERATIONS = int(os.getenv('SHED_DB_OPERATIONS', 2 * MONGO_MAX_POOL_SIZE))
+SHED_RETRY_AFTER = 1
+# Open for as long as the client stays connected, bounded by FEED_MAX_SUBSCRIPTIONS instead
+UNLIMITED_ROUTES = {'event_feed'}
+
+rejected = Counter('admission_rejected_total', "Requests turned away", ('handler', 'reason'))
+route_in_flight = Gauge('admission_route_in_flight', "Requests of each route being handled", ('handler',))
+METRICS.extend([rejected, route_in_flight])
+
+# Username to (tokens left, when they were counted). A bucket left alone for burst / rate seconds is full again,
+# so expiring it then loses nothing.
+buckets = TTLCache(RATE_LIMIT_USERS, RATE_LIMIT_BURST / RATE_LIMIT_RATE if RATE_LIMIT_RATE else 0)
+_in_flight: Dict[str, int] = {}
+
+
+def take_token(username: str, handler: str = ''):
+    """Spends one of the user's tokens, or fails with 429 and the seconds until the next one."""
+    if not RATE_LIMIT_RATE:
+        return
+    now = time.monotonic()
+    tokens, counted_at = buckets.get(username, (RATE_LIMIT_BURST, now))
+    tokens = min(RATE_LIMIT_BURST, tokens + (now - counted_at) * RATE_LIMIT_RATE)
+    if tokens < 1:
+        rejected.inc(handler, 'rate_limit')
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Rate limit exceeded",
+                            headers={"Retry-After": str(math.ceil((1 - tokens) / RATE_LIMIT_RATE))})
+    buckets.set(username, (tokens - 1, now))
+
+
+def route_limit(handler: str) -> int:
+    return ROUTE_CONCURRENCY_LIMITS.get(handler, ROUTE_CONCURRENCY)
+
+
+async def admit(request: Request):
+    """Router dependency, runs before authentication so turning a request away costs next to nothing."""
+    handler = request.scope['endpoint'].__name__
+    if SHED_DB_OPERATIONS and db_operations() >= SHED_DB_OPERATIONS:
+        rejected.inc(handler, 'overload')
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Server is overloaded",
+                            headers={"Retry-After": str(SHED_RETRY_AFTER)})
+    limit = route_limit(handler)
+    if not limit or handler in UNLIMITED_ROUTES:
+        yield
+        return
+    if _in_flight.get(handler, 0) >= limit:
+        rejected.inc(handler, 'concurrency')
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many concurrent requests",
+                            headers={"Retry-After": str(SHED_RETRY_AFTER)})
+    _in_flight[handler] = _in_flight.get(handler, 0) + 1
+    route_in_flight.inc(handler)
+    try:
+        yield
+    finally:
+        _in_flight[handler] -= 1
+        route_in_flight.inc(handler, amount=-1)
@@ -0,0 +1,220 @@
+"""Constraint evaluation over all of a user's events.
+
+An event is unblocked when it is not complete and every constraint on it holds: each event named by an
+EventStageConstraint is complete, the current time is inside each EventTimeConstraint window and the event has
+the color of each EventColorConstraint. Stage constraints form a dependency graph, kept per user in memory and
+updated in place as events change, so answering never rescans the user's events.
+"""
+import os
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from .DB import Constraints
+from .DB.Cache import TTLCache
+from .DB.DB import get_collection
+from .Models.Constraint import ConstraintType
+from .Models.Event import Stage, as_utc
+
+# Changes made on another worker reach this worker's graphs when they expire
+GRAPH_CACHE_SIZE = int(os.getenv('CONSTRAINT_GRAPH_CACHE_SIZE', 1000))
+GRAPH_CACHE_TTL = float(os.getenv('CONSTRAINT_GRAPH_CACHE_TTL', 300))
+GRAPH_LOAD_BATCH = 1000
+GRAPH_PROJECTION = {'stage': 1, 'presentation.color': 1}
+
+
+class ConstraintGraph:
+    """The stage, color and constraints of every event of one user. Edges run from an event to the events its
+    stage constraints wait on, pending counts how many of those are not complete. An event missing from the
+    graph is never complete, so constraints on deleted events keep blocking."""
+
+    def __init__(self):
+        self.stages: Dict[str, str] = {}
+        self.colors: Dict[str, Optional[str]] = {}
+        self.constraints: Dict[str, Dict[str, dict]] = defaultdict(dict)
+        self.depends_on: Dict[str, Set[str]] = defaultdict(set)
+        self.dependents: Dict[str, Set[str]] = defaultdict(set)
+        self.pending: Dict[str, int] = defaultdict(int)
+        self.times: Dict[str, List[tuple]] = {}
+        self.required_colors: Dict[str, List[str]] = {}
+        # Incomplete events whose stage constraints all hold
+        self.ready: Set[str] = set()
+
+    def is_complete(self, event_id: str) -> bool:
+        return self.stages.get(event_id) == Stage.complete
+
+    def _refresh(self, event_id: str):
+        if event_id in self.stages and not self.is_complete(event_id) and self.pending[event_id] == 0:
+            self.ready.add(event_id)
+        else:
+            self.ready.discard(event_id)
+
+    def _set_stage(self, event_id: str, stage: Optional[str]):
+        was_complete = self.is_complete(event_id)
+        if stage is None:
+            self.stages.pop(event_id, None)
+        else:
+            self.stages[event_id] = stage
+        if was_complete != self.is_complete(event_id):
+            change = -1 if self.is_complete(event_id) else 1
+            for dependent in self.dependents[event_id]:
+                self.pending[dependent] += change
+                self._refresh(dependent)
+        self._refresh(event_id)
+
+    def _set_constraints(self, event_id: str, constraints: Iterable[dict]):
+        depends_on, times, colors = set(), [], []
+        for constraint in constraints:
+            constraint_type = constraint.get('constraint_type')
+            if constraint_type == ConstraintType.stage:
+                depends_on.add(constraint['prerequisite_id'])
+            elif constraint_type == ConstraintType.time:
+                times.append((as_utc(constraint['start_time']), as_utc(constraint['end_time'])))
+            elif constraint_type == ConstraintType.color:
+                colors.append(constraint['color'])
+        for prerequisite in self.depends_on[event_id] - depends_on:
+            self.dependents[prerequisite].discard(event_id)
+        for prerequisite in depends_on - self.depends_on[event_id]:
+            self.dependents[prerequisite].add(event_id)
+        self.depends_on[event_id] = depends_on
+        self.pending[event_id] = sum(not self.is_complete(prerequisite) for prerequisite in depends_on)
+        self.times[event_id] = times
+        self.required_colors[event_id] = colors
+        self._refresh(event_id)
+
+    def set_event(self, event: dict):
+        """Adds the event or applies its new stage and color. Costs the edges it touches."""
+        event_id = str(event['_id'])
+        if 'presentation' in event:
+            self.colors[event_id] = event['presentation'].get('color')
+        self._set_stage(event_id, event.get('stage', Stage.started))
+
+    def remove_event(self, event_id: str):
+        self._set_constraints(event_id, [])
+        self._set_stage(event_id, None)
+        for index in (self.colors, self.constraints, self.depends_on, self.pending, self.times, self.required_colors):
+            index.pop(event_id, None)
+
+    def add_constraint(self, constraint: dict):
+        """Adds a constraint in its stored form."""
+        event_id = constraint['event_id']
+        self.constraints[event_id][str(constraint['_id'])] = constraint
+        self._set_constraints(event_id, self.constraints[event_id].values())
+
+    def remove_constraint(self, constraint: dict):
+        event_id = constraint['event_id']
+        self.constraints[event_id].pop(str(constraint['_id']), None)
+        self._set_constraints(event_id, self.constraints[event_id].values())
+
+    def holds_now(self, event_id: str, now: datetime) -> bool:
+        """Whether the time and color constraints of the event hold."""
+        color = self.colors.get(event_id)
+        return (all(start <= now < end for start, end in self.times.get(event_id, ()))
+                and all(color == required for required in self.required_colors.get(event_id, ())))
+
+    def unblocked(self, now: Optional[datetime] = None) -> List[str]:
+        now = now or datetime.utcnow()
+        return sorted(event_id for event_id in self.ready if self.holds_now(event_id, now))
+
+    def would_cycle(self, event_id: str, prerequisite: str) -> bool:
+        """Whether making event_id wait on prerequisite closes a cycle, i.e. prerequisite already waits on it."""
+        seen, stack = set(), [prerequisite]
+        while stack:
+            current = stack.pop()
+            if current == event_id:
+                return True
+            if current not in seen:
+                seen.add(current)
+                stack.extend(self.depends_on.get(current, ()))
+        return False
+
+    def cycles(self) -> List[List[str]]:
+        """Groups of events waiting on each other, found with an iterative Tarjan's algorithm."""
+        index, low, on_stack, stack, found = {}, {}, set(), [], []
+        for root in list(self.depends_on):
+            if root in index:
+                continue
+            work = [(root, iter(self.depends_on.get(root, ())))]
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                node, edges = work[-1]
+                for successor in edges:
+                    if successor not in index:
+                        index[successor] = low[successor] = len(index)
+                        stack.append(successor)
+                        on_stack.add(successor)
+                        work.append((successor, iter(self.depends_on.get(successor, ()))))
+                        break
+                    if successor in on_stack:
+                        low[node] = min(low[node], index[successor])
+                else:
+                    work.pop()
+                    if work:
+                        low[work[-1][0]] = min(low[work[-1][0]], low[node])
+                    if low[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        if len(component) > 1 or node in self.depends_on.get(node, ()):
+                            found.append(sorted(component))
+        return found
+
+
+graph_cache = TTLCache(GRAPH_CACHE_SIZE, GRAPH_CACHE_TTL)
+_changes = 0
+
+
+async def get_graph(owner_id: str) -> ConstraintGraph:
+    """The user's graph, built from one read of their events and one of their constraints when it is not cached."""
+    graph = graph_cache.get(owner_id)
+    if graph is None:
+        changes = _changes
+        graph = ConstraintGraph()
+        async for event in get_collection('events').find({'owner_id': owner_id}, GRAPH_PROJECTION,
+                                                         batch_size=GRAPH_LOAD_BATCH):
+            graph.set_event(event)
+        async for constraint in get_collection(Constraints.COLLECTION).find({'owner_id': owner_id},
+                                                                            batch_size=GRAPH_LOAD_BATCH):
+            graph.add_constraint(constraint)
+        # A change made during the read may be missing from it
+        if changes == _changes:
+            graph_cache.set(owner_id, graph)
+    return graph
+
+
+def _apply(owner_id: str, change: Callable[[ConstraintGraph], None]):
+    global _changes
+    _changes += 1
+    graph = graph_cache.get(owner_id)
+    if graph is not None:
+        change(graph)
+
+
+def event_changed(owner_id: str, event: dict):
+    """Applies a written event to the cached graph of its owner, call it with the event as stored."""
+    _apply(owner_id, lambda graph: graph.set_event(event))
+
+
+def event_removed(owner_id: str, event_id: str):
+    _apply(owner_id, lambda graph: graph.remove_event(str(event_id)))
+
+
+def constraint_added(owner_id: str, constraint: dict):
+    _apply(owner_id, lambda graph: graph.add_constraint(constraint))
+
+
+def constraint_removed(owner_id: str, constraint: dict):
+    _apply(owner_id, lambda graph: graph.remove_constraint(constraint))
+
+
+def forget_graph(owner_id: str):
+    """Drops the user's graph after writes too many to apply one by one, e.g. a bulk request."""
+    global _changes
+    _changes += 1
+    graph_cache.invalidate(owner_id)
@@ -1,40 +1,54 @@
+import os
 from typing import Optional
 
 import bson
 from bson import ObjectId
-from fastapi import Depends, HTTPException
+from fastapi import Depends, HTTPException, Request
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
 from pydantic import BaseModel
-from pymongo.collection import Collection
 from starlette import status
 
-from .DB.DB import get_client
+from .DB.Cache import TTLCache
+from .DB.Utilities import get_user
 from .Models.User import DBUser
+from .admission import take_token
+from .metrics import phase
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Token requests read the user from a per worker cache. No route changes a user, so one disabled straight in the db
+# keeps its tokens working for up to USER_CACHE_TTL seconds (logins always read the db); 0 turns the cache off
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 30))
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
 
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> DBUser:
-    """Gets user from token passed in JWT"""
+
+async def get_current_user(request: Request, token: str = Depends(oauth2_scheme)) -> DBUser:
+    """Gets user from token passed in JWT, once the user's rate limit allows the request"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        with phase('jwt'):
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
+    take_token(token_data.username, request.scope['endpoint'].__name__)
 
-    # JWT is valid, get user from db by username
-    user = get_user(username=token_data.username)
+    # JWT is valid, get user from the cache or db by username
+    user = user_cache.get(token_data.username)
     if user is None:
-        raise credentials_exception
+        user = await get_user(username=token_data.username)
+        if user is None:
+            raise credentials_exception
+        user_cache.set(token_data.username, user)
     return user
 
 
@@ -60,13 +74,3 @@ ALGORITHM = "HS256"
 
 class TokenData(BaseModel):
     username: Optional[str] = None
-
-
-def get_user(username: str) -> DBUser:
-    """Get user from database."""
-    client = get_client()
-    database = client.get_database('reminder')
-    users: Collection = database.get_collection('users')
-    user_dict = users.find_one({"username": f"{username}"})
-    if user_dict is not None:
-        return DBUser(**user_dict)
@@ -0,0 +1,183 @@
+"""Per-user change feed, pushed to clients as Server-Sent Events instead of them polling the event list.
+
+Routes publish a message for every event they create, update or delete. The backend fans messages out to the
+owner's subscriptions: LocalFeed within this worker, MongoFeed across workers through a change stream on the
+feed collection, which needs a replica set. Pick one with FEED_BACKEND=local|mongo.
+"""
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+import orjson
+from fastapi import HTTPException
+from pymongo.errors import PyMongoError
+from starlette import status
+
+from .DB.DB import get_collection
+from .Models.Event import event_response
+
+logger = logging.getLogger(__name__)
+
+FEED_BACKEND = os.getenv('FEED_BACKEND', 'local')
+# Messages held for a subscriber that is not reading, past it they are replaced by one resync
+FEED_QUEUE_SIZE = int(os.getenv('FEED_QUEUE_SIZE', 100))
+FEED_MAX_SUBSCRIPTIONS = int(os.getenv('FEED_MAX_SUBSCRIPTIONS', 5))  # Per user and worker
+FEED_KEEPALIVE = float(os.getenv('FEED_KEEPALIVE', 15))
+FEED_RETRY_AFTER = 5
+COLLECTION = 'feed'
+
+RESYNC = {'type': 'resync'}
+
+
+class Subscription:
+    """One connected client's bounded queue of messages."""
+
+    def __init__(self, owner_id: str, maxsize: int = FEED_QUEUE_SIZE):
+        self.owner_id = owner_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def offer(self, message: dict):
+        """Queues without waiting on the client. One that fell behind loses what is queued and gets a resync,
+        telling it to refetch, so a slow reader costs at most maxsize messages."""
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.dropped += self.queue.qsize()
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC)
+
+
+class LocalFeed:
+    """In-process fan-out, subscribers see the writes made by this worker."""
+
+    def __init__(self):
+        self.subscriptions: Dict[str, Set[Subscription]] = defaultdict(set)
+
+    def subscribe(self, owner_id: str) -> Subscription:
+        if len(self.subscriptions[owner_id]) >= FEED_MAX_SUBSCRIPTIONS:
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too many open feeds",
+                                headers={"Retry-After": str(FEED_RETRY_AFTER)})
+        subscription = Subscription(owner_id)
+        self.subscriptions[owner_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self.subscriptions.get(subscription.owner_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[subscription.owner_id]
+
+    def deliver(self, owner_id: str, message: dict):
+        for subscription in list(self.subscriptions.get(owner_id, ())):
+            subscription.offer(message)
+
+    def resync_all(self):
+        for subscriptions in list(self.subscriptions.values()):
+            for subscription in list(subscriptions):
+                subscription.offer(RESYNC)
+
+    def listened(self, owner_id: str) -> bool:
+        """Whether a message for the owner can reach a subscriber, so publishers can skip building it."""
+        return owner_id in self.subscriptions
+
+    async def publish(self, owner_id: str, message: dict):
+        self.deliver(owner_id, message)
+
+    async def publish_many(self, owner_id: str, messages: List[dict]):
+        for message in messages:
+            self.deliver(owner_id, message)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def stats(self) -> dict:
+        return {"users": len(self.subscriptions),
+                "subscriptions": sum(len(subscriptions) for subscriptions in self.subscriptions.values())}
+
+
+class MongoFeed(LocalFeed):
+    """Publishes by inserting into the feed collection and delivers what its change stream returns, so every
+    worker sees every write. The created_at TTL index of the feed collection keeps it small."""
+
+    def __init__(self):
+        super().__init__()
+        self._task: Optional[asyncio.Task] = None
+
+    def listened(self, owner_id: str) -> bool:
+        # Subscribers on other workers are not known here
+        return True
+
+    async def publish(self, owner_id: str, message: dict):
+        await self.publish_many(owner_id, [message])
+
+    async def publish_many(self, owner_id: str, messages: List[dict]):
+        """One insert for every message, change streams deliver them in order."""
+        if messages:
+            created_at = datetime.utcnow()
+            await get_collection(COLLECTION).insert_many([{'owner_id': owner_id, 'message': message,
+                                                           'created_at': created_at} for message in messages])
+
+    async def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _watch(self):
+        resume_after = None
+        while True:
+            try:
+                async with get_collection(COLLECTION).watch([{'$match': {'operationType': 'insert'}}],
+                                                            resume_after=resume_after) as stream:
+                    async for change in stream:
+                        resume_after = stream.resume_token
+                        document = change['fullDocument']
+                        self.deliver(document['owner_id'], document['message'])
+            except PyMongoError as error:
+                logger.error("Feed change stream failed, retrying: %s", error)
+                # Anything written while the stream was down may be missing
+                self.resync_all()
+                await asyncio.sleep(1)
+
+
+feed = MongoFeed() if FEED_BACKEND == 'mongo' else LocalFeed()
+
+
+def change_message(change_type: str, event_id, version: Optional[int] = None, event: Optional[dict] = None) -> dict:
+    message = {'type': change_type, 'event_id': str(event_id), 'version': version}
+    if event is not None:
+        message['event'] = event_response(event)
+    return message
+
+
+async def publish(owner_id: str, change_type: str, event_id, version: Optional[int] = None,
+                  event: Optional[dict] = None):
+    """Tells the owner's feeds an event was created, updated or deleted, with the event itself when at hand."""
+    await feed.publish(owner_id, change_message(change_type, event_id, version, event))
+
+
+async def event_stream(subscription: Subscription):
+    """The subscription as text/event-stream, with a comment every FEED_KEEPALIVE seconds to hold the
+    connection open through proxies."""
+    try:
+        yield f"retry: {FEED_RETRY_AFTER * 1000}\n\n".encode()
+        while True:
+            try:
+                message = await asyncio.wait_for(subscription.queue.get(), FEED_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+                continue
+            yield b"event: " + message['type'].encode() + b"\ndata: " + orjson.dumps(message) + b"\n\n"
+    finally:
+        feed.unsubscribe(subscription)
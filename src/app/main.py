@@ -4,14 +4,21 @@ from typing import Optional
 from fastapi import Depends, FastAPI, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from jose import jwt
-from passlib.context import CryptContext
 from pydantic import BaseModel, Field, EmailStr
+from pymongo.errors import DuplicateKeyError
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response
+from . import metrics, passwords
+from .admission import admit
+from .feed import feed
+from .metrics import MetricsMiddleware
+from .DB import DB
 from .DB.DB import get_collection
-from .DB.Utilities import fail_if_found_one
+from .DB.Indexes import ensure_indexes
+from .DB.Utilities import event_cache, get_user
 from .Models.User import User, DBUser, NewDBUser
-from .Routes import Event
-from .dependencies import get_current_active_user, SECRET_KEY, ALGORITHM, get_user
+from .Routes import Event, Bulk, Constraint, Transfer
+from .dependencies import get_current_active_user, SECRET_KEY, ALGORITHM, user_cache
 
 # to get a string like this run:
 # openssl rand -hex 32
@@ -31,35 +38,62 @@ class Token(BaseModel):
     token_type: str
 
 
-password_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-# other_context = CryptContext(schemes=[])
-
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-After", "X-Next-Skip", "ETag"],
 )
-# app.include_router(Constraint.ConstraintRouter) Temporary disable
-app.include_router(Event.EventRouter)
+app.add_middleware(MetricsMiddleware)
+# Health, metrics and login stay outside admission control, login has its own bound on the hashing pool
+app.include_router(Event.EventRouter, dependencies=[Depends(admit)])
+app.include_router(Constraint.ConstraintRouter, dependencies=[Depends(admit)])
+app.include_router(Bulk.BulkRouter, dependencies=[Depends(admit)])
+app.include_router(Transfer.TransferRouter, dependencies=[Depends(admit)])
+
+
+@app.on_event("startup")
+async def open_db_client():
+    DB.connect(event_listeners=metrics.listeners())
+    await ensure_indexes()
+    await feed.start()
+
 
+@app.on_event("shutdown")
+async def close_db_client():
+    await feed.stop()
+    DB.close()
 
-def verify_password(plain_password, hashed_password):
-    return password_context.verify(plain_password, hashed_password)
 
+@app.get("/health")
+async def health():
+    """Cheap liveness check, 503 when the db does not answer."""
+    if not await DB.ping():
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Database unavailable")
+    return {"status": "ok"}
 
-def get_password_hash(password):
-    return password_context.hash(password)
 
+metrics.collectors.append(lambda: metrics.stats_lines(
+    'app_cache', 'cache', {"events": event_cache.stats(), "users": user_cache.stats()}))
+metrics.collectors.append(lambda: metrics.stats_lines('app_feed', 'backend', {"feed": feed.stats()}))
+metrics.collectors.append(lambda: metrics.stats_lines(
+    'app_password_hashing', 'pool', {"bcrypt": {"rejected": passwords.rejected}}))
 
-def authenticate_user(username: str, password: str):
-    user = get_user(username)
+
+@app.get("/metrics")
+async def get_metrics():
+    """This worker's metrics in the Prometheus text format."""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+async def authenticate_user(username: str, password: str):
+    user = await get_user(username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await passwords.verify_password(password, user.hashed_password):
         return False
     return user
 
@@ -78,13 +112,15 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 @app.post("/token", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
     """Token endpoint"""
-    user = authenticate_user(form_data.username, form_data.password)
+    user = await authenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    # Logging in reads the user fresh, so refresh the cached copy
+    user_cache.set(user.username, user)
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
@@ -97,8 +133,7 @@ async def read_users_me(current_user: DBUser = Depends(get_current_active_user))
     return current_user
 
 
-# TODO event_search, constraint_search, tag_search
-# TODO event time frames
+# TODO constraint_search
 
 
 # AUTH
@@ -110,23 +145,23 @@ class SignUp(BaseModel):
 class SignUpRequest(SignUp):
     password: str = Field(..., min_length=8, max_length=64)
 
-    def get_hashed_user_credentials(self):
+    async def get_hashed_user_credentials(self):
         """Hash the password and return SignUpRequest"""
         credentials = self.dict(exclude={'password'})
-        credentials.update({'hashed_password': get_password_hash(self.password)})
+        credentials.update({'hashed_password': await passwords.get_password_hash(self.password)})
         return credentials
 
 
 @app.post("/auth/signup", response_model=SignUp)
 async def sign_up(requested_credentials: SignUpRequest):
     # Todo Verify email active by verification
-    # TODO email not already registered
-
-    fail_if_found_one("users",
-                      {"$or": [{"username": requested_credentials.username, "email": requested_credentials.email}]})
-    new_user = NewDBUser(**requested_credentials.get_hashed_user_credentials())
+    new_user = NewDBUser(**await requested_credentials.get_hashed_user_credentials())
     users = get_collection("users")
-    users.insert_one(new_user.dict())
+    try:
+        # The unique username and email indexes reject duplicates
+        await users.insert_one(new_user.dict())
+    except DuplicateKeyError:
+        raise HTTPException(status_code=422, detail="Username or email already registered")
     return requested_credentials
 
 
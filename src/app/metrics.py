@@ -0,0 +1,264 @@
+"""Request, db command and connection pool metrics, served at /metrics in the Prometheus text format.
+
+Each worker keeps its own numbers, scrape every worker. With SLOW_REQUEST_MS set, requests slower than it are
+logged with the time spent per phase: jwt, db, hashing, serialize and the rest as other.
+"""
+import bisect
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 0))  # 0 turns slow request logging off
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+CONTENT_TYPE = 'text/plain; version=0.0.4'  # Starlette appends the charset
+
+# Seconds per phase of the request being handled. Motor runs commands with a copy of the caller's context,
+# so the command listener adds to the dict of the request that issued them.
+_phases: ContextVar[Optional[Dict[str, float]]] = ContextVar('phases', default=None)
+
+
+def _labels(names: Tuple[str, ...], values: Tuple) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name, self.help_text, self.label_names = name, help_text, labels
+        self.values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels(self.label_names, labels)} {value}"
+                  for labels, value in sorted(self.values.items())]
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, *labels, value: float):
+        with self._lock:
+            self.values[labels] = value
+
+    def total(self) -> float:
+        with self._lock:
+            return sum(self.values.values())
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...], buckets: Tuple[float, ...]):
+        self.name, self.help_text, self.label_names, self.buckets = name, help_text, labels, buckets
+        # labels -> [count per bucket, the last for +Inf], sum
+        self.values: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, *labels, value: float):
+        with self._lock:
+            counts, _ = self.values.setdefault(labels, [[0] * (len(self.buckets) + 1), 0.0])
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[labels][1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                bucket_labels = _labels(self.label_names + ('le',), labels + ('+Inf' if bound == float('inf')
+                                                                              else bound,))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+http_requests = Counter('http_requests_total', "Requests handled", ('handler', 'method', 'status'))
+http_latency = Histogram('http_request_duration_seconds', "Request latency", ('handler', 'method'), HTTP_BUCKETS)
+http_in_flight = Gauge('http_requests_in_flight', "Requests being handled")
+db_commands = Counter('mongodb_commands_total', "Commands sent", ('command', 'collection', 'outcome'))
+db_latency = Histogram('mongodb_command_duration_seconds', "Command latency as the driver saw it",
+                       ('command', 'collection'), DB_BUCKETS)
+pool_open = Gauge('mongodb_pool_connections', "Open connections", ('address',))
+pool_in_use = Gauge('mongodb_pool_connections_in_use', "Connections checked out", ('address',))
+pool_waiting = Gauge('mongodb_pool_waiting', "Operations waiting for a connection", ('address',))
+pool_checkout_failures = Counter('mongodb_pool_checkout_failures_total', "Failed connection checkouts",
+                                 ('address', 'reason'))
+METRICS = [http_requests, http_latency, http_in_flight, db_commands, db_latency, pool_open, pool_in_use,
+           pool_waiting, pool_checkout_failures]
+
+# Functions returning more lines to expose, e.g. cache statistics owned by other modules
+collectors: List[Callable[[], List[str]]] = []
+
+
+def stats_lines(prefix: str, label: str, stats: Dict[str, dict]) -> List[str]:
+    """Exposes stats() dicts, e.g. of caches, as one gauge per key labelled by the dict's name."""
+    gauges: Dict[str, Gauge] = {}
+    for name, values in stats.items():
+        for key, value in values.items():
+            gauge = gauges.setdefault(key, Gauge(f"{prefix}_{key}", f"{prefix.replace('_', ' ')} {key}", (label,)))
+            gauge.set(name, value=value)
+    return [line for gauge in gauges.values() for line in gauge.render()]
+
+
+def render() -> str:
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    for collector in collectors:
+        lines += collector()
+    return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def phase(name: str):
+    """Adds the time spent in the block to the current request's phase."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, time.perf_counter() - start)
+
+
+def record_phase(name: str, seconds: float):
+    phases = _phases.get()
+    if phases is not None:
+        phases[name] = phases.get(name, 0.0) + seconds
+
+
+class CommandListener(monitoring.CommandListener):
+    def __init__(self):
+        self._collections: Dict[Tuple, str] = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        key = (event.connection_id, event.request_id)
+        self._collections[key] = collection if isinstance(collection, str) else ''
+
+    def _finished(self, event, outcome: str):
+        collection = self._collections.pop((event.connection_id, event.request_id), '')
+        seconds = event.duration_micros / 1e6
+        db_commands.inc(event.command_name, collection, outcome)
+        db_latency.observe(event.command_name, collection, value=seconds)
+        record_phase('db', seconds)
+
+    def succeeded(self, event):
+        self._finished(event, 'ok')
+
+    def failed(self, event):
+        self._finished(event, 'error')
+
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self._open: Dict[str, int] = {}
+        self._in_use: Dict[str, int] = {}
+        self._waiting: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _add(self, counts: Dict[str, int], gauge: Gauge, address, change: int):
+        address = f"{address[0]}:{address[1]}"
+        with self._lock:
+            counts[address] = counts.get(address, 0) + change
+            gauge.set(address, value=counts[address])
+
+    def connection_created(self, event):
+        self._add(self._open, pool_open, event.address, 1)
+
+    def connection_closed(self, event):
+        self._add(self._open, pool_open, event.address, -1)
+
+    def connection_check_out_started(self, event):
+        self._add(self._waiting, pool_waiting, event.address, 1)
+
+    def connection_checked_out(self, event):
+        self._add(self._waiting, pool_waiting, event.address, -1)
+        self._add(self._in_use, pool_in_use, event.address, 1)
+
+    def connection_checked_in(self, event):
+        self._add(self._in_use, pool_in_use, event.address, -1)
+
+    def connection_check_out_failed(self, event):
+        self._add(self._waiting, pool_waiting, event.address, -1)
+        pool_checkout_failures.inc(f"{event.address[0]}:{event.address[1]}", event.reason)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+
+def db_operations() -> float:
+    """Operations holding or waiting for a pooled connection, across every server."""
+    return pool_in_use.total() + pool_waiting.total()
+
+
+def listeners() -> list:
+    """Pass as event_listeners when creating the db client."""
+    return [CommandListener(), PoolListener()]
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware timing every HTTP request. Labels requests by handler function name, so paths
+    with ids share a series."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        status_code = 500
+        phases: Dict[str, float] = {}
+        token = _phases.set(phases)
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        http_in_flight.inc(amount=1)
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            http_in_flight.inc(amount=-1)
+            _phases.reset(token)
+            endpoint = scope.get('endpoint')
+            handler = endpoint.__name__ if endpoint is not None else 'unmatched'
+            http_requests.inc(handler, scope['method'], status_code)
+            http_latency.observe(handler, scope['method'], value=elapsed)
+            if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+                other = max(0.0, elapsed - sum(phases.values()))
+                breakdown = ' '.join(f"{name}={seconds * 1000:.1f}ms"
+                                     for name, seconds in sorted({**phases, 'other': other}.items()))
+                logger.warning("Slow request %s %s -> %s in %.1fms: %s", scope['method'], scope['path'],
+                               status_code, elapsed * 1000, breakdown)
@@ -0,0 +1,46 @@
+"""Password hashing, run on a small thread pool so bcrypt never blocks the event loop."""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+from starlette import status
+
+from .metrics import phase
+
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 2))
+# Jobs allowed to wait for a worker before new ones are turned away
+PASSWORD_HASH_QUEUE = int(os.getenv('PASSWORD_HASH_QUEUE', 16))
+PASSWORD_HASH_RETRY_AFTER = 1
+
+password_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# bcrypt releases the GIL while hashing, so threads give real parallelism
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix='password-hash')
+_in_flight = 0
+rejected = 0
+
+
+async def run_hashing(func, *args):
+    """Runs func on the hashing pool, or fails with 503 when its queue is full."""
+    global _in_flight, rejected
+    if _in_flight >= PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE:
+        rejected += 1
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Too many authentication requests",
+                            headers={"Retry-After": str(PASSWORD_HASH_RETRY_AFTER)})
+    _in_flight += 1
+    try:
+        with phase('hashing'):
+            return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+    finally:
+        _in_flight -= 1
+
+
+async def verify_password(plain_password, hashed_password) -> bool:
+    return await run_hashing(password_context.verify, plain_password, hashed_password)
+
+
+async def get_password_hash(password) -> str:
+    return await run_hashing(password_context.hash, password)
@@ -0,0 +1,87 @@
+"""Stored size and codec cost of the compact event form against the long keys it replaces.
+
+Sizes and encode/decode rates need no database. Run from src/:
+
+    python -m bench.codec --events 100000
+
+With --mongo the events are also written to two scratch collections carrying the event indexes, one per form,
+to compare data and index sizes as mongod stores them:
+
+    MONGO_URI=mongodb://localhost:27017 python -m bench.codec --mongo
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+
+import bson
+
+os.environ.setdefault('MONGO_DATABASE', 'reminder_bench')
+
+from app.DB.Codec import storage_indexes  # noqa: E402
+from app.DB.DB import get_stored_collection  # noqa: E402
+from app.DB.Indexes import INDEXES  # noqa: E402
+from app.Models.Compact import decode_event, encode_event  # noqa: E402
+from bench.suite import synthetic_event  # noqa: E402
+
+INSERT_BATCH = 5000
+
+
+def timed(label: str, func, items: list) -> float:
+    start = time.perf_counter()
+    for item in items:
+        func(item)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<24} {len(items) / elapsed:12,.0f} events/s")
+    return elapsed
+
+
+async def stored_sizes(legacy: list, compact: list):
+    for form, documents, indexes in (('legacy', legacy, INDEXES['events']),
+                                     ('compact', compact, storage_indexes(INDEXES['events'], 'compact'))):
+        collection = get_stored_collection(f"bench_codec_{form}")
+        await collection.drop()
+        await collection.create_indexes(indexes)
+        for offset in range(0, len(documents), INSERT_BATCH):
+            await collection.insert_many(documents[offset:offset + INSERT_BATCH], ordered=False)
+        stats = await collection.database.command('collStats', collection.name)
+        start = time.perf_counter()
+        await collection.find({}).to_list(length=None)
+        read = time.perf_counter() - start
+        print(f"{form:<8} data {stats['size'] / 2 ** 20:8.1f} MiB  on disk {stats['storageSize'] / 2 ** 20:8.1f} MiB"
+              f"  indexes {stats['totalIndexSize'] / 2 ** 20:8.1f} MiB  full read {read * 1000:8.1f} ms")
+        await collection.drop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--mongo', action='store_true', help="also compare sizes stored by mongod")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    owner_id = str(bson.ObjectId())
+    events = [{**synthetic_event(rng, owner_id), '_id': bson.ObjectId()} for _ in range(args.events)]
+    compact = [encode_event(event) for event in events]
+
+    legacy_bytes = sum(len(bson.encode(event)) for event in events)
+    compact_bytes = sum(len(bson.encode(document)) for document in compact)
+    print(f"{'legacy BSON':<24} {legacy_bytes / len(events):12.1f} bytes/event")
+    print(f"{'compact BSON':<24} {compact_bytes / len(events):12.1f} bytes/event"
+          f"  ({1 - compact_bytes / legacy_bytes:.0%} smaller)")
+
+    timed("encode_event", encode_event, events)
+    timed("decode_event", decode_event, compact)
+    timed("BSON decode, legacy", bson.decode, [bson.encode(event) for event in events])
+    timed("BSON decode, compact", bson.decode, [bson.encode(document) for document in compact])
+    assert all(decode_event(document) == event for document, event in zip(compact[:1000], events)), \
+        "decode_event(encode_event(event)) differs from event"
+
+    if args.mongo:
+        asyncio.run(stored_sizes(events, compact))
+
+
+if __name__ == "__main__":
+    main()
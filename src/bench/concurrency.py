@@ -0,0 +1,91 @@
+"""Concurrent throughput against a running API.
+
+Run from src/ against a server started with uvicorn (one worker). The benchmark is one user sending as fast as
+it can, which the per-user rate limit is there to stop, so start the server with it off, or the numbers measure
+429s; a run that gets any stops with an error:
+
+    RATE_LIMIT_RATE=0 uvicorn app.main:app
+    python -m bench.concurrency --url http://localhost:8000 --concurrency 32 --requests 2000
+
+Check out the commit before and after a change and compare the req/s and
+latency lines. With a blocking data layer req/s stays flat as concurrency
+grows, with an async one it scales until mongo or the CPU saturates.
+"""
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def get_token(session: requests.Session, url: str, username: str, password: str) -> str:
+    session.post(f"{url}/auth/signup",
+                 json={"username": username, "email": f"{username}@example.com", "password": password})
+    response = session.post(f"{url}/token", data={"username": username, "password": password})
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+def seed_events(session: requests.Session, url: str, headers: dict, count: int):
+    for i in range(count):
+        response = session.post(f"{url}/events/events/", headers=headers, json={
+            "name": f"bench event {i}",
+            "description": "seeded by bench.concurrency",
+            "tags": [{"tag": "bench"}],
+            "time_details": {"start_time": "2021-01-01T10:00:00", "end_time": "2021-01-01T11:00:00"},
+            "presentation": {"color": "red"},
+        })
+        if response.status_code == 429:
+            raise SystemExit("seeding: rate limited, start the server with RATE_LIMIT_RATE=0")
+        response.raise_for_status()
+
+
+def run(url: str, path: str, headers: dict, concurrency: int, total: int):
+    local = threading.local()
+
+    def one_request(_):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        session = local.session
+        start = time.perf_counter()
+        response = session.get(f"{url}{path}", headers=headers)
+        elapsed = time.perf_counter() - start
+        return response.status_code, elapsed
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one_request, range(total)))
+    wall = time.perf_counter() - started
+
+    latencies = sorted(elapsed for _, elapsed in results)
+    errors = sum(1 for code, _ in results if code >= 400)
+    if any(code == 429 for code, _ in results):
+        raise SystemExit(f"{path}: rate limited, start the server with RATE_LIMIT_RATE=0")
+    print(f"{path} concurrency={concurrency} requests={total} errors={errors}")
+    print(f"  throughput {total / wall:.1f} req/s")
+    print(f"  latency p50 {statistics.median(latencies) * 1000:.1f} ms"
+          f"  p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f} ms"
+          f"  max {latencies[-1] * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--username", default="bench-user")
+    parser.add_argument("--password", default="bench-password")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=50, help="events to create before measuring")
+    args = parser.parse_args()
+
+    session = requests.Session()
+    headers = {"Authorization": f"Bearer {get_token(session, args.url, args.username, args.password)}"}
+    seed_events(session, args.url, headers, args.seed)
+    for concurrency in args.concurrency:
+        run(args.url, "/events/events/", headers, concurrency, args.requests)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Cost of answering "which events are unblocked" from a ConstraintGraph, against rebuilding it per request.
+
+No database needed. Run from src/:
+
+    python -m bench.constraints --events 10000 --links 3
+"""
+import argparse
+import random
+import time
+
+from bson import ObjectId
+
+from app.Models.Constraint import ConstraintType
+from app.Models.Event import Stage
+from app.constraints import ConstraintGraph
+
+
+def stored_documents(count: int, links: int):
+    """Events and constraints as the graph load reads them, each event waiting on up to `links` earlier events
+    so there is no cycle."""
+    ids = [str(ObjectId()) for _ in range(count)]
+    events, constraints = [], []
+    for i, event_id in enumerate(ids):
+        events.append({'_id': event_id, 'stage': random.choice([Stage.started, Stage.in_progress, Stage.complete]),
+                       'presentation': {'color': '#f00'}})
+        for prerequisite in random.sample(ids[:i], min(i, random.randint(0, links))):
+            constraints.append({'_id': ObjectId(), 'event_id': event_id, 'prerequisite_id': prerequisite,
+                                'constraint_type': ConstraintType.stage})
+    return events, constraints
+
+
+def build(events, constraints) -> ConstraintGraph:
+    graph = ConstraintGraph()
+    for event in events:
+        graph.set_event(event)
+    for constraint in constraints:
+        graph.add_constraint(constraint)
+    return graph
+
+
+def timed(label: str, func, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{label:<32} {elapsed * 1e3:9.3f} ms")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=10000)
+    parser.add_argument('--links', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    events, constraints = stored_documents(args.events, args.links)
+    graph = build(events, constraints)
+    rebuild = timed("build graph", lambda: build(events, constraints), max(1, args.repeat // 10))
+    query = timed("unblocked()", graph.unblocked, args.repeat)
+    print(f"{'':<32} {rebuild / query:9.1f}x faster than rebuilding")
+
+    def stage_change():
+        event = random.choice(events)
+        event['stage'] = Stage.complete if event['stage'] != Stage.complete else Stage.started
+        graph.set_event({'_id': event['_id'], 'stage': event['stage']})
+    timed("stage change, incremental", stage_change, args.repeat * 100)
+    timed("cycles()", graph.cycles, max(1, args.repeat // 10))
+
+    fresh = build(events, constraints)
+    assert fresh.unblocked() == graph.unblocked(), "incremental graph drifted from a rebuild"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""Latency under overload, with admission control off and then on.
+
+Well behaved users send a request at a time next to one noisy user sending many at once, all faster than the
+db can answer. Every request goes through the real app in-process. Run from src/ on the in-memory stand-in
+(pip install mongomock-motor), where each db operation holds one of --pool connections for --db-latency ms:
+
+    python -m bench.overload --backend memory --pool 10 --db-latency 5
+
+or against a local mongod, where pool saturation comes from the driver's own pool events:
+
+    MONGO_URI=mongodb://localhost:27017 python -m bench.overload --pool 10
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+
+import orjson
+
+os.environ.setdefault('MONGO_DATABASE', 'reminder_bench')
+# Every read should reach the db
+os.environ.setdefault('EVENT_CACHE_SIZE', '0')
+
+from app import admission, metrics  # noqa: E402
+from app.DB import DB  # noqa: E402
+from app.main import app, create_access_token  # noqa: E402
+from bench.suite import backend_client, synthetic_event  # noqa: E402
+
+USER_PREFIX = 'bench-overload-'
+EVENTS_PER_USER = 20
+POOL_ADDRESS = ('memory', 0)
+
+
+class PooledCollection:
+    """Makes every operation of an in-memory collection take a connection from a pool of fixed size for
+    latency seconds, reporting it to the pool listener as the driver would."""
+
+    def __init__(self, collection, pool: asyncio.Semaphore, latency: float, listener: metrics.PoolListener):
+        self._collection, self._pool, self._latency, self._listener = collection, pool, latency, listener
+
+    async def _hold_connection(self):
+        event = SimpleNamespace(address=POOL_ADDRESS)
+        self._listener.connection_check_out_started(event)
+        await self._pool.acquire()
+        self._listener.connection_checked_out(event)
+        try:
+            await asyncio.sleep(self._latency)
+        finally:
+            self._pool.release()
+            self._listener.connection_checked_in(event)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name == 'find':
+            def find(*args, **kwargs):
+                cursor = attribute(*args, **kwargs)
+                to_list = cursor.to_list
+
+                async def pooled_to_list(*list_args, **list_kwargs):
+                    await self._hold_connection()
+                    return await to_list(*list_args, **list_kwargs)
+                cursor.to_list = pooled_to_list
+                return cursor
+            return find
+        if not asyncio.iscoroutinefunction(attribute):
+            return attribute
+
+        async def pooled(*args, **kwargs):
+            await self._hold_connection()
+            return await attribute(*args, **kwargs)
+        return pooled
+
+
+class PooledDatabase:
+    def __init__(self, database, *pool_args):
+        self._database, self._pool_args = database, pool_args
+        # mongomock-motor patches the collection again on every get_collection, until the patches overflow the stack
+        self._collections = {}
+
+    def get_collection(self, name):
+        if name not in self._collections:
+            self._collections[name] = PooledCollection(self._database.get_collection(name), *self._pool_args)
+        return self._collections[name]
+
+    def __getattr__(self, name):
+        return getattr(self._database, name)
+
+
+class PooledClient:
+    def __init__(self, client, *pool_args):
+        self._client, self._pool_args = client, pool_args
+        self._databases = {}
+
+    def get_database(self, name):
+        if name not in self._databases:
+            self._databases[name] = PooledDatabase(self._client.get_database(name), *self._pool_args)
+        return self._databases[name]
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+async def request(method: str, path: str, headers: dict, body=None) -> int:
+    """Sends one request straight to the ASGI app, returns the status."""
+    content = orjson.dumps(body) if body is not None else b''
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http', 'path': path,
+             'raw_path': path.encode(), 'query_string': query.encode(), 'root_path': '',
+             'server': ('bench', 80), 'client': ('bench', 1),
+             'headers': [(name.lower().encode(), value.encode()) for name, value in headers.items()]
+             + [(b'content-type', b'application/json'), (b'content-length', str(len(content)).encode())]}
+    done = asyncio.Event()
+    status_code = 0
+    body_sent = False
+
+    async def receive():
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {'type': 'http.request', 'body': content, 'more_body': False}
+        await done.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        nonlocal status_code
+        if message['type'] == 'http.response.start':
+            status_code = message['status']
+        elif message['type'] == 'http.response.body' and not message.get('more_body'):
+            done.set()
+
+    await app(scope, receive, send)
+    return status_code
+
+
+async def seed(user_count: int) -> dict:
+    """Replaces the bench users and their events, returns {username: [event ids]}."""
+    users, events = DB.get_collection('users'), DB.get_collection('events')
+    old_ids = [str(user['_id']) async for user in users.find({'username': {'$regex': f'^{USER_PREFIX}'}})]
+    await events.delete_many({'owner_id': {'$in': old_ids}})
+    await users.delete_many({'username': {'$regex': f'^{USER_PREFIX}'}})
+    rng = random.Random(1)
+    seeded = {}
+    for i in range(user_count):
+        username = f"{USER_PREFIX}{i}"
+        result = await users.insert_one({'username': username, 'email': f"{username}@example.com",
+                                         'hashed_password': '', 'disabled': False})
+        batch = [synthetic_event(rng, str(result.inserted_id)) for _ in range(EVENTS_PER_USER)]
+        result = await events.insert_many(batch)
+        seeded[username] = [str(event_id) for event_id in result.inserted_ids]
+    return seeded
+
+
+async def client_loop(username: str, event_ids: list, deadline: float, retry_delay: float, results: list):
+    """One client sending requests back to back, alternating reads and writes of its events."""
+    headers = {'Authorization': f"Bearer {create_access_token({'sub': username})}"}
+    i = 0
+    while time.perf_counter() < deadline:
+        event_id = event_ids[i % len(event_ids)]
+        start = time.perf_counter()
+        if i % 3 == 2:
+            status_code = await request('POST', f"/events/events/{event_id}/set/name", headers, f"renamed {i}")
+        elif i % 3 == 1:
+            status_code = await request('GET', '/events/events/?limit=20', headers)
+        else:
+            status_code = await request('GET', f"/events/events/{event_id}", headers)
+        results.append((status_code, time.perf_counter() - start))
+        i += 1
+        # Turned away clients come back shortly, sooner than Retry-After asks as an impatient client would
+        await asyncio.sleep(retry_delay if status_code in (429, 503) else 0)
+
+
+def summarize(label: str, results: list, duration: float):
+    served = sorted(latency for status_code, latency in results if status_code < 400)
+    statuses = defaultdict(int)
+    for status_code, _ in results:
+        statuses[status_code] += 1
+    if not served:
+        print(f"  {label:<8} nothing served, statuses {dict(statuses)}")
+        return
+    p99 = served[max(0, int(len(served) * 0.99) - 1)]
+    print(f"  {label:<8} served {len(served) / duration:7.1f}/s  p50 {statistics.median(served) * 1000:8.1f} ms"
+          f"  p99 {p99 * 1000:8.1f} ms  statuses {dict(sorted(statuses.items()))}")
+
+
+async def run_phase(seeded: dict, noisy: str, args):
+    deadline = time.perf_counter() + args.duration
+    normal_results, noisy_results = [], []
+    tasks = [client_loop(username, event_ids, deadline, args.retry_delay, normal_results)
+             for username, event_ids in seeded.items() if username != noisy]
+    tasks += [client_loop(noisy, seeded[noisy], deadline, args.retry_delay, noisy_results)
+              for _ in range(args.noisy_clients)]
+    await asyncio.gather(*tasks)
+    summarize('normal', normal_results, args.duration)
+    summarize('noisy', noisy_results, args.duration)
+
+
+def configure(enabled: bool, args):
+    admission.RATE_LIMIT_RATE = args.rate if enabled else 0
+    admission.RATE_LIMIT_BURST = args.rate * 2
+    admission.buckets.clear()
+    admission.buckets.ttl = admission.RATE_LIMIT_BURST / args.rate
+    admission.ROUTE_CONCURRENCY = args.route_concurrency if enabled else 0
+    admission.SHED_DB_OPERATIONS = args.pool * 2 if enabled else 0
+
+
+async def main_async(args):
+    listener = metrics.PoolListener()
+    client = backend_client(args.backend)
+    if args.backend == 'memory':
+        client = PooledClient(client, asyncio.Semaphore(args.pool), args.db_latency / 1000, listener)
+    DB.connect(client=client)
+    await app.router.startup()
+    try:
+        seeded = await seed(args.users + 1)
+        noisy = f"{USER_PREFIX}{args.users}"
+        print(f"{args.users} users with one client each, 1 user with {args.noisy_clients}, {args.backend} "
+              f"backend, pool of {args.pool}")
+        for enabled in (False, True):
+            configure(enabled, args)
+            print(f"admission control {'on' if enabled else 'off'}:")
+            await run_phase(seeded, noisy, args)
+    finally:
+        await app.router.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', choices=['mongod', 'memory'], default='mongod')
+    parser.add_argument('--users', type=int, default=20, help="well behaved users")
+    parser.add_argument('--noisy-clients', type=int, default=100, help="concurrent clients of the noisy user")
+    parser.add_argument('--pool', type=int, default=10, help="db connections, for the memory backend")
+    parser.add_argument('--db-latency', type=float, default=5, help="ms per db operation, memory backend")
+    parser.add_argument('--duration', type=float, default=5, help="seconds per phase")
+    parser.add_argument('--retry-delay', type=float, default=0.1, help="seconds a turned away client waits")
+    parser.add_argument('--rate', type=float, default=100, help="RATE_LIMIT_RATE while admission control is on")
+    parser.add_argument('--route-concurrency', type=int, default=8)
+    args = parser.parse_args()
+    if args.backend == 'mongod':
+        # The driver's pool then reports saturation, sized like the simulated one
+        DB.connect(maxPoolSize=args.pool, event_listeners=metrics.listeners())
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
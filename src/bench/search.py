@@ -0,0 +1,105 @@
+"""Event search latency over a synthetic corpus.
+
+Needs a real mongod, text indexes are not available in the in-memory stand-ins.
+Run from src/:
+
+    MONGO_URI=mongodb://localhost:27017 python -m bench.search --events 100000
+
+Events are seeded once into the MONGO_DATABASE database (reminder_bench by
+default) and reused by later runs with the same --events.
+"""
+import argparse
+import itertools
+import os
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault('MONGO_DATABASE', 'reminder_bench')
+# A benchmark is one client sending as fast as it can, which the per-user rate limit is there to stop
+os.environ.setdefault('RATE_LIMIT_RATE', '0')
+
+from starlette.testclient import TestClient  # noqa: E402
+
+from app.DB.DB import get_collection  # noqa: E402
+from app.Models.Event import NewEventInDB, Stage  # noqa: E402
+from app.main import app, create_access_token  # noqa: E402
+
+USERNAME = 'bench-search'
+WORDS = [f'word{i}' for i in range(5000)]
+COMMON_WORDS = WORDS[:20]
+# Zipf skew so a few terms match many events and most match few
+WORD_CUM_WEIGHTS = list(itertools.accumulate(1 / rank for rank in range(1, len(WORDS) + 1)))
+TAGS = [f'tag{i}' for i in range(200)]
+INSERT_BATCH = 5000
+
+
+def synthetic_event(rng: random.Random, owner_id: str) -> dict:
+    def words(count):
+        return ' '.join(rng.choices(WORDS, cum_weights=WORD_CUM_WEIGHTS, k=count))
+
+    start = datetime(2021, 1, 1) + timedelta(minutes=rng.randrange(60 * 24 * 365))
+    return NewEventInDB(
+        name=words(rng.randint(1, 6))[:64], description=words(rng.randint(0, 30))[:256],
+        tags=[{'tag': tag} for tag in rng.sample(TAGS, rng.randint(0, 4))],
+        time_details={'start_time': start, 'end_time': start + timedelta(hours=1)},
+        presentation={'color': rng.choice(['red', 'green', 'blue'])},
+        stage=Stage.started, owner_id=owner_id).dict()
+
+
+async def seed(event_count: int) -> str:
+    users = get_collection('users')
+    user = await users.find_one({'username': USERNAME})
+    if user is None:
+        await users.insert_one({'username': USERNAME, 'hashed_password': '', 'disabled': False})
+        user = await users.find_one({'username': USERNAME})
+    owner_id = str(user['_id'])
+
+    events = get_collection('events')
+    existing = await events.count_documents({'owner_id': owner_id})
+    if existing != event_count:
+        await events.delete_many({'owner_id': owner_id})
+        rng = random.Random(42)
+        for offset in range(0, event_count, INSERT_BATCH):
+            batch = [synthetic_event(rng, owner_id) for _ in range(min(INSERT_BATCH, event_count - offset))]
+            await events.insert_many(batch, ordered=False)
+    return owner_id
+
+
+def measure(client: TestClient, headers: dict, label: str, queries, limit: int):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        response = client.get('/events/search', params={'q': query, 'limit': limit}, headers=headers)
+        latencies.append(time.perf_counter() - start)
+        response.raise_for_status()
+    latencies.sort()
+    print(f"{label:<8} n={len(latencies)}  p50 {statistics.median(latencies) * 1000:7.2f} ms"
+          f"  p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:7.2f} ms"
+          f"  p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    with TestClient(app) as client:
+        started = time.perf_counter()
+        client.portal.call(seed, args.events)
+        print(f"corpus ready: {args.events} events ({time.perf_counter() - started:.1f} s)")
+        headers = {'Authorization': f"Bearer {create_access_token({'sub': USERNAME})}"}
+
+        measure(client, headers, 'common', [rng.choice(COMMON_WORDS) for _ in range(args.queries)], args.limit)
+        measure(client, headers, 'rare', [rng.choice(WORDS[1000:]) for _ in range(args.queries)], args.limit)
+        measure(client, headers, 'tag', [rng.choice(TAGS) for _ in range(args.queries)], args.limit)
+        measure(client, headers, 'multi', [' '.join(rng.sample(WORDS[:500], 3)) for _ in range(args.queries)],
+                args.limit)
+
+
+if __name__ == "__main__":
+    main()
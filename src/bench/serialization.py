@@ -0,0 +1,86 @@
+"""Per-event serialization cost of the event models, old response path against the new one.
+
+No database needed. Run from src/:
+
+    python -m bench.serialization --events 1000 --rounds 20
+"""
+import argparse
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+import orjson
+from bson import ObjectId
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from app.Models.Event import EventInDB, EventResponse, NewEventInDB, Stage, event_response
+
+
+def stored_events(count: int) -> List[dict]:
+    """Documents shaped like what motor returns for the events collection."""
+    start = datetime(2021, 1, 1, 9)
+    events = []
+    for i in range(count):
+        event = NewEventInDB(
+            name=f"event {i}", description="a description of the event " * 4,
+            tags=[{'tag': f"tag{j}"} for j in range(i % 5)],
+            time_details={'start_time': start + timedelta(hours=i), 'end_time': start + timedelta(hours=i + 1)},
+            presentation={'color': 'red'}, stage=Stage.started, owner_id=str(ObjectId())).dict()
+        event['_id'] = ObjectId()
+        events.append(event)
+    return events
+
+
+async def old_single(events, field):
+    # Mutating routes built EventInDB, then FastAPI validated it against response_model and encoded with json
+    for event in events:
+        content = await serialize_response(field=field, response_content=EventInDB(**event))
+        json.dumps(content).encode()
+
+
+async def old_list(events, field):
+    content = await serialize_response(field=field, response_content=events)
+    json.dumps(content).encode()
+
+
+async def new_single(events, _):
+    for event in events:
+        orjson.dumps(event_response(event))
+
+
+async def new_list(events, _):
+    orjson.dumps([event_response(event) for event in events])
+
+
+def timed(label: str, func, events, field, rounds: int):
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        asyncio.run(func(events, field))
+        best = min(best, time.perf_counter() - start)
+    print(f"{label:<28} {best / len(events) * 1e6:8.2f} us/event")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    events = stored_events(args.events)
+    single_field = create_response_field(name='response', type_=EventResponse)
+    list_field = create_response_field(name='response', type_=List[EventResponse])
+    old = timed("single, EventInDB + model", old_single, events, single_field, args.rounds)
+    new = timed("single, event_response", new_single, events, single_field, args.rounds)
+    print(f"{'':<28} {old / new:8.1f}x faster")
+    old = timed("list, response_model", old_list, events, list_field, args.rounds)
+    new = timed("list, event_response", new_list, events, list_field, args.rounds)
+    print(f"{'':<28} {old / new:8.1f}x faster")
+
+
+if __name__ == "__main__":
+    main()
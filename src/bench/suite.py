@@ -0,0 +1,278 @@
+"""Per-endpoint latency, throughput and db operation counts of the app, driven in-process.
+
+Seeds synthetic users and events, then sends each endpoint --requests requests through the real app. Run from
+src/ against a local mongod:
+
+    MONGO_URI=mongodb://localhost:27017 python -m bench.suite --users 10 --events 1000
+
+or the in-memory stand-in (pip install mongomock-motor), which needs no server but says little about
+latency, use it for the db operation counts:
+
+    python -m bench.suite --backend memory
+
+--save-baseline PATH stores the results, --baseline PATH compares a run against them and exits 1 when any
+endpoint's p95 grew past --tolerance or it issued more db operations per request. bench/baselines/memory.json
+is a run of the in-memory stand-in with the defaults. Its db operation counts hold on any machine, its
+latencies only on the one that took it, so compare against it with a loose tolerance:
+
+    python -m bench.suite --backend memory --baseline bench/baselines/memory.json --tolerance 10
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+os.environ.setdefault('MONGO_DATABASE', 'reminder_bench')
+# A benchmark is one client sending as fast as it can, which the per-user rate limit is there to stop
+os.environ.setdefault('RATE_LIMIT_RATE', '0')
+# Cache entries outlive the run, so db operation counts follow the seeded request sequence rather than its speed
+os.environ.setdefault('USER_CACHE_TTL', '3600')
+os.environ.setdefault('EVENT_CACHE_TTL', '3600')
+
+from starlette.testclient import TestClient  # noqa: E402
+
+from app import passwords  # noqa: E402
+from app.DB import DB  # noqa: E402
+from app.Models.Event import NewEventInDB, Stage  # noqa: E402
+from app.main import app  # noqa: E402
+
+USER_PREFIX = 'bench-suite-'
+PASSWORD = 'bench-password'
+TAGS = [f'tag{i}' for i in range(50)]
+INSERT_BATCH = 5000
+
+# Driver calls counted as db operations. Cursors count once, for their first batch.
+OPERATIONS = {'find', 'find_one', 'find_one_and_update', 'find_one_and_delete', 'find_one_and_replace',
+              'insert_one', 'insert_many', 'update_one', 'update_many', 'replace_one', 'delete_one', 'delete_many',
+              'bulk_write', 'aggregate', 'count_documents', 'distinct', 'create_indexes'}
+operation_counts = Counter()
+current_endpoint = None
+
+
+class CountingCollection:
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name not in OPERATIONS:
+            return attribute
+
+        def counted(*args, **kwargs):
+            operation_counts[current_endpoint] += 1
+            return attribute(*args, **kwargs)
+        return counted
+
+
+class CountingDatabase:
+    def __init__(self, database):
+        self._database = database
+        # mongomock-motor patches the collection again on every get_collection, until the patches overflow the stack
+        self._collections = {}
+
+    def get_collection(self, name):
+        if name not in self._collections:
+            self._collections[name] = CountingCollection(self._database.get_collection(name))
+        return self._collections[name]
+
+    def __getattr__(self, name):
+        return getattr(self._database, name)
+
+
+class CountingClient:
+    """Wraps a motor client so every collection it hands out counts operations against current_endpoint."""
+
+    def __init__(self, client):
+        self._client = client
+        self._databases = {}
+
+    def get_database(self, name):
+        if name not in self._databases:
+            self._databases[name] = CountingDatabase(self._client.get_database(name))
+        return self._databases[name]
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def backend_client(backend: str):
+    if backend == 'memory':
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            raise SystemExit("--backend memory needs mongomock-motor, pip install mongomock-motor")
+        return AsyncMongoMockClient()
+    return DB.connect()
+
+
+def synthetic_event(rng: random.Random, owner_id: str) -> dict:
+    start = datetime(2021, 1, 1) + timedelta(minutes=rng.randrange(60 * 24 * 365))
+    return NewEventInDB(
+        name=f"event {rng.randrange(10 ** 6)}", description="benchmark event " * rng.randint(0, 10),
+        tags=[{'tag': tag} for tag in rng.sample(TAGS, rng.randint(0, 4))],
+        time_details={'start_time': start, 'end_time': start + timedelta(hours=1)},
+        presentation={'color': rng.choice(['red', 'green', 'blue'])},
+        stage=Stage.started, owner_id=owner_id).dict()
+
+
+async def seed(user_count: int, event_count: int, rng: random.Random):
+    """Replaces the bench users and their events, returns {username: [event ids]}."""
+    users, events = DB.get_collection('users'), DB.get_collection('events')
+    old_ids = [str(user['_id']) async for user in users.find({'username': {'$regex': f'^{USER_PREFIX}'}})]
+    for name in ('events', 'tag_counts', 'constraints', 'tombstones'):
+        await DB.get_collection(name).delete_many({'owner_id': {'$in': old_ids}})
+    await DB.get_collection('summaries').delete_many({'_id': {'$in': old_ids}})
+    await users.delete_many({'username': {'$regex': f'^{USER_PREFIX}'}})
+
+    hashed_password = await passwords.get_password_hash(PASSWORD)
+    seeded = {}
+    for i in range(user_count):
+        username = f"{USER_PREFIX}{i}"
+        result = await users.insert_one({'username': username, 'email': f"{username}@example.com",
+                                         'hashed_password': hashed_password, 'disabled': False})
+        owner_id = str(result.inserted_id)
+        event_ids = []
+        for offset in range(0, event_count, INSERT_BATCH):
+            batch = [synthetic_event(rng, owner_id) for _ in range(min(INSERT_BATCH, event_count - offset))]
+            result = await events.insert_many(batch, ordered=False)
+            event_ids += [str(event_id) for event_id in result.inserted_ids]
+        seeded[username] = event_ids
+    return seeded
+
+
+def scenarios(rng: random.Random):
+    """Endpoint name to a function sending one request, given the username, its auth headers and an event id."""
+    def tag_round_trip(client, headers, event_id):
+        tag = {'tag': f"bench{rng.randrange(10 ** 9)}"}
+        client.post(f"/events/events/{event_id}/tags", json=tag, headers=headers)
+        return client.delete(f"/events/events/{event_id}/tags", json=tag, headers=headers)
+
+    def conditional_get(client, headers, event_id):
+        # Seeded events stay at version 1 until the set_* scenarios after this one run
+        response = client.get(f"/events/events/{event_id}", headers={**headers, 'If-None-Match': '"1"'})
+        if response.status_code != 304:
+            raise SystemExit(f"get_event_304: expected 304, got {response.status_code}")
+        return response
+
+    return {
+        'token': lambda client, headers, event_id, username: client.post(
+            '/token', data={'username': username, 'password': PASSWORD}),
+        'list': lambda client, headers, event_id, username: client.get('/events/events/', headers=headers),
+        'list_tag': lambda client, headers, event_id, username: client.get(
+            '/events/events/', params={'tag': rng.choice(TAGS)}, headers=headers),
+        'get_event': lambda client, headers, event_id, username: client.get(
+            f"/events/events/{event_id}", headers=headers),
+        'get_event_304': lambda client, headers, event_id, username: conditional_get(client, headers, event_id),
+        'get_tags': lambda client, headers, event_id, username: client.get(
+            f"/events/events/{event_id}/tags", headers=headers),
+        'set_name': lambda client, headers, event_id, username: client.post(
+            f"/events/events/{event_id}/set/name", json=f"renamed {rng.randrange(1000)}", headers=headers),
+        'set_description': lambda client, headers, event_id, username: client.post(
+            f"/events/events/{event_id}/set/description", json="described", headers=headers),
+        'set_stage': lambda client, headers, event_id, username: client.post(
+            f"/events/events/{event_id}/set/stage", params={'stage': rng.choice(list(Stage)).value},
+            headers=headers),
+        'set_presentation': lambda client, headers, event_id, username: client.post(
+            f"/events/events/{event_id}/set/presentation", json={'color': rng.choice(['red', 'blue'])},
+            headers=headers),
+        'set_tags': lambda client, headers, event_id, username: client.post(
+            f"/events/events/{event_id}/set/tags", json=[{'tag': tag} for tag in rng.sample(TAGS, 3)],
+            headers=headers),
+        'add_and_remove_tag': lambda client, headers, event_id, username: tag_round_trip(client, headers, event_id),
+    }
+
+
+def percentile(latencies, fraction: float) -> float:
+    return latencies[max(0, int(len(latencies) * fraction) - 1)]
+
+
+def run(client: TestClient, seeded: dict, rng: random.Random, requests: int, warmup: int) -> dict:
+    global current_endpoint
+    tokens = {}
+    for username in seeded:
+        response = client.post('/token', data={'username': username, 'password': PASSWORD})
+        response.raise_for_status()
+        tokens[username] = {'Authorization': f"Bearer {response.json()['access_token']}"}
+
+    results = {}
+    for endpoint, send in scenarios(rng).items():
+        latencies = []
+        operation_counts[endpoint] = 0
+        for i in range(warmup + requests):
+            username = rng.choice(list(seeded))
+            event_id = rng.choice(seeded[username])
+            current_endpoint = endpoint if i >= warmup else None
+            start = time.perf_counter()
+            response = send(client, tokens[username], event_id, username)
+            elapsed = time.perf_counter() - start
+            current_endpoint = None
+            if response.status_code >= 400:
+                raise SystemExit(f"{endpoint}: {response.status_code} {response.text}")
+            if i >= warmup:
+                latencies.append(elapsed)
+        latencies.sort()
+        results[endpoint] = {
+            'p50': statistics.median(latencies) * 1000, 'p95': percentile(latencies, 0.95) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000, 'rps': len(latencies) / sum(latencies),
+            'ops': operation_counts[endpoint] / len(latencies),
+        }
+    return results
+
+
+def report(results: dict, baseline: dict, tolerance: float) -> bool:
+    """Prints the results next to the baseline, returns False when an endpoint regressed."""
+    passed = True
+    print(f"{'endpoint':<20} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8} {'db ops':>7}")
+    for endpoint, result in results.items():
+        notes = []
+        base = baseline.get(endpoint)
+        if base:
+            if result['p95'] > base['p95'] * (1 + tolerance):
+                notes.append(f"p95 was {base['p95']:.2f}")
+            if result['ops'] > base['ops'] + 1e-9:
+                notes.append(f"db ops was {base['ops']:.2f}")
+        passed = passed and not notes
+        print(f"{endpoint:<20} {result['p50']:8.2f} {result['p95']:8.2f} {result['p99']:8.2f} "
+              f"{result['rps']:8.1f} {result['ops']:7.2f}  {'REGRESSED ' + ', '.join(notes) if notes else ''}")
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', choices=['mongod', 'memory'], default='mongod')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--events', type=int, default=1000, help="events per user")
+    parser.add_argument('--requests', type=int, default=200, help="measured requests per endpoint")
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--baseline', help="JSON results to compare against")
+    parser.add_argument('--save-baseline', help="write the results as JSON here")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed p95 growth over the baseline")
+    args = parser.parse_args()
+
+    DB.connect(client=CountingClient(backend_client(args.backend)))
+    rng = random.Random(args.seed)
+    with TestClient(app) as client:
+        started = time.perf_counter()
+        seeded = client.portal.call(seed, args.users, args.events, rng)
+        print(f"seeded {args.users} users x {args.events} events ({time.perf_counter() - started:.1f} s), "
+              f"{args.backend}")
+        results = run(client, seeded, rng, args.requests, args.warmup)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    passed = report(results, baseline, args.tolerance)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+    raise SystemExit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
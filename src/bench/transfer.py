@@ -0,0 +1,130 @@
+"""Throughput and memory of the streaming export and import against what they replace.
+
+Seeds --events events for one owner, exports them to a file in each --formats, imports every file to a fresh
+owner, then runs the old way on the same data: the whole list read into memory for export, and one insert_one
+per event, as add_event does, on --baseline-events of them. Peak RSS is printed after each step, streaming
+should leave it flat where the list grows it. Run from src/ against a local mongod:
+
+    MONGO_URI=mongodb://localhost:27017 python -m bench.transfer --events 1000000
+
+The in-memory stand-in (pip install mongomock-motor) holds the db in the process and copies what a cursor
+reads, so use it with few events and ignore its RSS:
+
+    python -m bench.transfer --backend memory --events 20000
+"""
+import argparse
+import asyncio
+import os
+import random
+import resource
+import tempfile
+import time
+
+import bson
+import orjson
+
+os.environ.setdefault('MONGO_DATABASE', 'reminder_bench')
+
+from app.DB import DB  # noqa: E402
+from app.DB.DB import get_collection  # noqa: E402
+from app.DB.Transfer import export_events, import_events, read_file  # noqa: E402
+from app.Models.Event import event_response  # noqa: E402
+from app.Models.Transfer import TransferFormat  # noqa: E402
+from bench.suite import backend_client, synthetic_event  # noqa: E402
+
+INSERT_BATCH = 5000
+OWNER_COLLECTIONS = ('events', 'tag_counts')
+
+
+def peak_rss() -> float:
+    """MiB, ru_maxrss is in KiB on Linux."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def report(label: str, count: int, elapsed: float, size: int = 0):
+    line = f"{label:<28} {count / elapsed:10,.0f} events/s  {elapsed:7.1f} s"
+    if size:
+        line += f"  {size / 2 ** 20:8.1f} MiB  {size / count:6.1f} bytes/event"
+    print(f"{line}  peak RSS {peak_rss():7.0f} MiB")
+
+
+async def seed(owner_id: str, count: int, rng: random.Random):
+    events = get_collection('events')
+    for offset in range(0, count, INSERT_BATCH):
+        batch = [synthetic_event(rng, owner_id) for _ in range(min(INSERT_BATCH, count - offset))]
+        await events.insert_many(batch, ordered=False)
+
+
+async def clean(owner_ids: list):
+    for name in OWNER_COLLECTIONS:
+        await get_collection(name).delete_many({'owner_id': {'$in': owner_ids}})
+    await get_collection('summaries').delete_many({'_id': {'$in': owner_ids}})
+
+
+async def streamed(owner_id: str, transfer_format: TransferFormat, count: int, directory: str) -> str:
+    path = os.path.join(directory, f"events.{transfer_format.value}.gz")
+    start = time.perf_counter()
+    with open(path, 'wb') as file:
+        async for block in export_events(owner_id, transfer_format):
+            file.write(block)
+    report(f"export {transfer_format.value}.gz", count, time.perf_counter() - start, os.path.getsize(path))
+
+    imported_owner = str(bson.ObjectId())
+    start = time.perf_counter()
+    result = await import_events(imported_owner, read_file(path), transfer_format)
+    report(f"import {transfer_format.value}.gz", count, time.perf_counter() - start)
+    assert result.imported == count and not result.failed, result.dict()
+    await clean([imported_owner])
+    return path
+
+
+async def materialized(owner_id: str, count: int, baseline_events: int):
+    """The list export, and an insert_one per event extrapolated from baseline_events of them."""
+    start = time.perf_counter()
+    events = await get_collection('events').find({'owner_id': owner_id}).to_list(length=None)
+    body = orjson.dumps([event_response(event) for event in events])
+    report("export list, json", count, time.perf_counter() - start, len(body))
+    del body
+
+    inserted_owner = str(bson.ObjectId())
+    sample = [{**event, 'owner_id': inserted_owner} for event in events[:baseline_events]]
+    for event in sample:
+        event.pop('_id')
+    del events
+    collection = get_collection('events')
+    start = time.perf_counter()
+    for event in sample:
+        await collection.insert_one(event)
+    report(f"insert_one x{len(sample)}", len(sample), time.perf_counter() - start)
+    await clean([inserted_owner])
+
+
+async def main_async(args):
+    DB.connect(client=backend_client(args.backend))
+    owner_id = str(bson.ObjectId())
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    await seed(owner_id, args.events, rng)
+    report("seed", args.events, time.perf_counter() - start)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for name in args.formats:
+                await streamed(owner_id, TransferFormat(name), args.events, directory)
+        await materialized(owner_id, args.events, args.baseline_events)
+    finally:
+        await clean([owner_id])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', choices=['mongod', 'memory'], default='mongod')
+    parser.add_argument('--events', type=int, default=1000000)
+    parser.add_argument('--formats', nargs='+', choices=[item.value for item in TransferFormat],
+                        default=[item.value for item in TransferFormat])
+    parser.add_argument('--baseline-events', type=int, default=10000, help="events inserted one at a time")
+    parser.add_argument('--seed', type=int, default=42)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+import pytest
+from bson import ObjectId
+
+
+@pytest.fixture
+def client():
+    """The app in-process on an in-memory db, needs mongomock-motor."""
+    mongomock_motor = pytest.importorskip('mongomock_motor')
+    from starlette.testclient import TestClient
+
+    from app import main
+    from app.DB import DB
+
+    DB.connect(client=mongomock_motor.AsyncMongoMockClient())
+    with TestClient(main.app) as client:
+        yield client
+
+
+@pytest.fixture
+def headers(client) -> dict:
+    """Auth headers of a new user."""
+    username = f"user{ObjectId()}"
+    client.post('/auth/signup', json={'username': username, 'email': f"{username}@example.com",
+                                      'password': 'password123'}).raise_for_status()
+    response = client.post('/token', data={'username': username, 'password': 'password123'})
+    response.raise_for_status()
+    return {'Authorization': f"Bearer {response.json()['access_token']}"}
@@ -0,0 +1,133 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from app import admission
+from app.DB.Cache import TTLCache
+
+RATE, BURST = 2, 3
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A monotonic clock the test moves by hand, with fresh buckets."""
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(admission.time, 'monotonic', lambda: clock.now)
+    monkeypatch.setattr(admission, 'RATE_LIMIT_RATE', RATE)
+    monkeypatch.setattr(admission, 'RATE_LIMIT_BURST', BURST)
+    monkeypatch.setattr(admission, 'buckets', TTLCache(10, BURST / RATE))
+    return clock
+
+
+def spend(count: int, username: str = 'alice'):
+    for _ in range(count):
+        admission.take_token(username)
+
+
+def test_burst_then_rate_limited(clock):
+    spend(BURST)
+    with pytest.raises(HTTPException) as error:
+        admission.take_token('alice')
+    assert error.value.status_code == 429
+    assert error.value.headers['Retry-After'] == '1'
+    # Users have buckets of their own
+    spend(BURST, 'bob')
+
+
+def test_bucket_refills_at_rate(clock):
+    spend(BURST)
+    clock.now += 1 / RATE
+    spend(1)
+    with pytest.raises(HTTPException):
+        admission.take_token('alice')
+    clock.now += 1
+    spend(RATE)
+    with pytest.raises(HTTPException):
+        admission.take_token('alice')
+
+
+def test_bucket_fills_up_to_burst(clock):
+    spend(BURST)
+    # Long enough for the bucket to expire from the cache, a missing bucket is a full one
+    clock.now += 3600
+    spend(BURST)
+    with pytest.raises(HTTPException):
+        admission.take_token('alice')
+
+
+def test_rate_limit_off(clock, monkeypatch):
+    monkeypatch.setattr(admission, 'RATE_LIMIT_RATE', 0)
+    spend(BURST * 10)
+
+
+def bulk_events():
+    pass
+
+
+def request_to(handler):
+    return SimpleNamespace(scope={'endpoint': handler})
+
+
+def event_feed():
+    pass
+
+
+@pytest.fixture
+def routes(monkeypatch):
+    monkeypatch.setattr(admission, 'SHED_DB_OPERATIONS', 0)
+    monkeypatch.setattr(admission, 'ROUTE_CONCURRENCY_LIMITS', {'bulk_events': 2})
+    monkeypatch.setattr(admission, '_in_flight', {})
+
+
+async def enter(request):
+    """Runs admit up to the handler, returns the generator to close once the handler is done."""
+    admitted = admission.admit(request)
+    await admitted.__anext__()
+    return admitted
+
+
+async def handle(request):
+    await (await enter(request)).aclose()
+
+
+def test_shedding(routes, monkeypatch):
+    monkeypatch.setattr(admission, 'SHED_DB_OPERATIONS', 4)
+    monkeypatch.setattr(admission, 'db_operations', lambda: 4)
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(handle(request_to(bulk_events)))
+    assert error.value.status_code == 503 and error.value.headers['Retry-After'] == '1'
+
+    monkeypatch.setattr(admission, 'db_operations', lambda: 3)
+    asyncio.run(handle(request_to(bulk_events)))
+    monkeypatch.setattr(admission, 'SHED_DB_OPERATIONS', 0)
+    monkeypatch.setattr(admission, 'db_operations', lambda: 100)
+    asyncio.run(handle(request_to(bulk_events)))
+
+
+def test_unlimited_route(routes, monkeypatch):
+    monkeypatch.setattr(admission, 'ROUTE_CONCURRENCY_LIMITS', {'event_feed': 1})
+
+    async def scenario():
+        return [await enter(request_to(event_feed)) for _ in range(3)]
+
+    asyncio.run(scenario())
+    assert admission._in_flight == {}
+
+
+def test_route_concurrency(routes):
+
+    async def scenario():
+        first = await enter(request_to(bulk_events))
+        second = await enter(request_to(bulk_events))
+        with pytest.raises(HTTPException) as error:
+            await enter(request_to(bulk_events))
+        assert error.value.status_code == 503
+        await first.aclose()
+        third = await enter(request_to(bulk_events))
+        for admitted in (second, third):
+            await admitted.aclose()
+
+    asyncio.run(scenario())
+    assert admission._in_flight == {'bulk_events': 0}
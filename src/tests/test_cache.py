@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+from app.DB import Cache
+from app.DB.Cache import CacheBackend, LocalCache, TTLCache
+
+
+def test_incomplete_backend_fails_when_made():
+    class GetOnly(CacheBackend):
+        async def get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        GetOnly()
+
+
+def test_local_cache():
+    cache = LocalCache(10, 60)
+    asyncio.run(cache.set('key', 1))
+    assert asyncio.run(cache.get('key')) == 1
+    asyncio.run(cache.invalidate('key'))
+    assert asyncio.run(cache.get('key')) is None
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+
+def test_ttl_cache_expires_and_evicts(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(Cache.time, 'monotonic', lambda: now[0])
+    cache = TTLCache(2, 10)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    # b is the least recently used
+    cache.set('c', 3)
+    assert cache.get('b') is None and cache.evictions == 1
+    now[0] += 11
+    assert cache.get('a') is None and len(cache) == 1
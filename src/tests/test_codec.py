@@ -0,0 +1,185 @@
+import asyncio
+from datetime import datetime
+from typing import List
+
+import pytest
+import pymongo
+from bson import ObjectId
+from pymongo import ASCENDING, TEXT, IndexModel
+
+from app.DB import Codec
+from app.DB.Codec import CodecCollection, DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne, \
+    storage_indexes, translate_filter, translate_projection, translate_sort, translate_update
+from app.Models.Compact import decode_color, decode_event, encode_color, encode_event
+from app.Models.Event import NewEventInDB, Stage
+
+OWNER = str(ObjectId())
+
+
+def new_event(**fields) -> dict:
+    event = NewEventInDB(name="standup", description="daily", tags=[{'tag': 'work'}, {'tag': 'team'}],
+                         time_details={'start_time': datetime(2024, 1, 1, 9), 'end_time': datetime(2024, 1, 1, 10)},
+                         presentation={'color': 'red'}, stage=Stage.started, owner_id=OWNER).dict()
+    return {**event, **fields}
+
+
+@pytest.mark.parametrize('color', ['#f00', '#123456', '#12345680', '#fff'])
+def test_color_round_trip(color):
+    assert decode_color(encode_color(color)) == color
+
+
+def test_event_round_trip():
+    event = {**new_event(), '_id': ObjectId(), 'version': 3}
+    stored = encode_event(event)
+    assert stored['o'] == OWNER and stored['g'] == ['work', 'team'] and stored['c'] == encode_color('#f00')
+    assert stored['t'] == {'s': datetime(2024, 1, 1, 9), 'e': datetime(2024, 1, 1, 10)}
+    assert decode_event(stored) == event
+
+
+def test_all_day_round_trip():
+    event = new_event(time_details={'start_time': datetime(2024, 1, 1), 'end_time': datetime(2024, 1, 2),
+                                    'all_day': True})
+    assert encode_event(event)['t']['a'] is True
+    assert decode_event(encode_event(event)) == event
+
+
+def test_translate_filter():
+    query = {'owner_id': OWNER, 'tags.tag': {'$in': ['work']}, 'presentation.color': '#f00',
+             '$or': [{'time_details.start_time': {'$gte': datetime(2024, 1, 1)}}, {'stage': {'$ne': 'complete'}}],
+             '$text': {'$search': 'standup'}}
+    assert translate_filter(query) == {
+        'o': OWNER, 'g': {'$in': ['work']}, 'c': encode_color('#f00'),
+        '$or': [{'t.s': {'$gte': datetime(2024, 1, 1)}}, {'s': {'$ne': 'complete'}}],
+        '$text': {'$search': 'standup'}}
+
+
+def test_translate_update():
+    update = {'$set': {'presentation': {'color': '#f00'}, 'name': 'renamed'},
+              '$push': {'tags': {'$each': [{'tag': 'a'}, {'tag': 'b'}]}}, '$inc': {'version': 1}}
+    assert translate_update(update) == {'$set': {'c': encode_color('#f00'), 'n': 'renamed'},
+                                        '$push': {'g': {'$each': ['a', 'b']}}, '$inc': {'v': 1}}
+    assert translate_update({'$pull': {'tags': {'tag': 'a'}}}) == {'$pull': {'g': 'a'}}
+    pipeline = [{'$set': {'v': 1}}]
+    assert translate_update(pipeline) is pipeline
+
+
+def test_translate_projection_and_sort():
+    assert translate_projection({'name': 1, 'tags': 1, 'time_details.start_time': 1}) == {'n': 1, 'g': 1, 't.s': 1}
+    assert translate_projection(['_id', 'stage']) == ['_id', 's']
+    assert translate_sort([('owner_id', ASCENDING), ('_id', ASCENDING)]) == [('o', ASCENDING), ('_id', ASCENDING)]
+
+
+def test_storage_indexes():
+    indexes = [IndexModel([('owner_id', ASCENDING), ('tags.tag', ASCENDING)], name='owner_id_tags'),
+               IndexModel([('owner_id', ASCENDING), ('name', TEXT)], name='owner_id_text')]
+    names = {mode: [index.document['name'] for index in storage_indexes(indexes, mode)]
+             for mode in ('legacy', 'dual', 'compact')}
+    assert names == {'legacy': ['owner_id_tags', 'owner_id_text'],
+                     'dual': ['owner_id_tags', 'owner_id_text', 'compact_owner_id_tags'],
+                     'compact': ['compact_owner_id_tags', 'compact_owner_id_text']}
+    # Once compact_events moved the text index
+    assert [index.document['name'] for index in storage_indexes(indexes, 'dual', compact_text=True)] == [
+        'owner_id_tags', 'compact_owner_id_tags', 'compact_owner_id_text']
+    assert dict(storage_indexes(indexes, 'compact')[0].document['key']) == {'o': ASCENDING, 'g': ASCENDING}
+
+
+def test_compact_requests():
+    codec = CodecCollection(None, 'compact')
+    event_filter = {'owner_id': OWNER, '_id': ObjectId()}
+    stored_filter = {'o': OWNER, '_id': event_filter['_id']}
+    event = new_event()
+
+    assert codec._request(InsertOne(event)) == pymongo.InsertOne(encode_event(event))
+    for request_type in (UpdateOne, UpdateMany):
+        request = codec._request(request_type(event_filter, {'$set': {'stage': 'complete'}}, upsert=True))
+        pymongo_type = getattr(pymongo, request_type.__name__)
+        assert type(request) is pymongo_type
+        assert request == pymongo_type(stored_filter, {'$set': {'s': 'complete'}}, upsert=True)
+    assert codec._request(ReplaceOne(event_filter, event)) == pymongo.ReplaceOne(stored_filter, encode_event(event))
+    assert codec._request(DeleteOne(event_filter)) == pymongo.DeleteOne(stored_filter)
+    assert codec._request(DeleteMany(event_filter)) == pymongo.DeleteMany(stored_filter)
+
+
+def test_requests_work_without_codec():
+    """In legacy mode the requests go to motor as they are."""
+    event_filter = {'owner_id': OWNER}
+    request = UpdateOne(event_filter, {'$set': {'stage': 'complete'}}, upsert=True)
+    assert isinstance(request, pymongo.UpdateOne)
+    assert repr(request) == repr(pymongo.UpdateOne(event_filter, {'$set': {'stage': 'complete'}}, upsert=True))
+
+
+def test_pymongo_requests_are_refused():
+    """pymongo keeps a request's arguments in private fields the codec does not read."""
+    with pytest.raises(TypeError):
+        CodecCollection(None, 'compact')._request(pymongo.DeleteOne({'owner_id': OWNER}))
+
+
+def test_dual_requests():
+    codec = CodecCollection(None, 'dual')
+    event_filter = {'owner_id': OWNER, '_id': ObjectId()}
+    event = new_event()
+
+    document = {**event, **encode_event(event)}
+    assert codec._request(InsertOne(event)) == pymongo.InsertOne(document)
+    # Dual mode reads long keys and writes both
+    assert codec._request(UpdateOne(event_filter, {'$set': {'stage': 'complete'}})) == pymongo.UpdateOne(
+        event_filter, {'$set': {'stage': 'complete', 's': 'complete'}})
+    assert codec._decode(document) == event
+
+
+def test_dual_text_search_filter(monkeypatch):
+    codec = CodecCollection(None, 'dual')
+    query = {'owner_id': OWNER, '$text': {'$search': 'standup'}}
+    # The text index is on the long keys until compact_events moves it, and searches every event
+    monkeypatch.setattr(Codec, 'compact_text_index', False)
+    assert codec._filter(query) == query
+    monkeypatch.setattr(Codec, 'compact_text_index', True)
+    assert codec._filter(query) == {**query, 'o': OWNER}
+    assert codec._filter({'owner_id': OWNER}) == {'owner_id': OWNER}
+
+
+class RecordingCollection:
+    """Keeps one stored document and answers find_one_and_update with it, recording what it was sent."""
+
+    def __init__(self, stored: dict):
+        self.stored = stored
+        self.calls = []
+
+    async def find_one_and_update(self, *args, **kwargs):
+        self.calls.append((args, kwargs))
+        return self.stored
+
+
+@pytest.mark.parametrize('mode', ['dual', 'compact'])
+def test_find_one_and_update_round_trip(mode):
+    event = {**new_event(), '_id': ObjectId()}
+    codec = CodecCollection(None, mode)
+    stored = codec._document(event)
+    codec._collection = RecordingCollection(stored)
+    result = asyncio.run(codec.find_one_and_update({'_id': event['_id']}, {'$set': {'name': 'renamed'}},
+                                                   projection={'name': 1, 'tags': 1}))
+    assert result == event
+    (_, update), kwargs = codec._collection.calls[0]
+    if mode == 'compact':
+        assert update == {'$set': {'n': 'renamed'}} and kwargs['projection'] == {'n': 1, 'g': 1}
+    else:
+        assert update == {'$set': {'name': 'renamed', 'n': 'renamed'}}
+        assert kwargs['projection'] == {'name': 1, 'tags': 1}
+
+
+class IndexedCollection:
+    def __init__(self, indexes: List[IndexModel]):
+        self.indexes = indexes
+
+    async def index_information(self):
+        return {index.document['name']: {'key': list(index.document['key'].items())} for index in self.indexes}
+
+
+def test_detect_text_index(monkeypatch):
+    monkeypatch.setattr(Codec, 'EVENT_STORAGE', 'dual')
+    monkeypatch.setattr(Codec, 'compact_text_index', False)
+    indexes = [IndexModel([('owner_id', ASCENDING), ('name', TEXT)], name='owner_id_text')]
+    assert not asyncio.run(Codec.detect_text_index(IndexedCollection(storage_indexes(indexes, 'dual'))))
+    moved = storage_indexes(indexes, 'dual', compact_text=True)
+    assert asyncio.run(Codec.detect_text_index(IndexedCollection(moved)))
+    assert Codec.compact_text_index
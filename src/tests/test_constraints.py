@@ -0,0 +1,206 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+from pydantic import ValidationError
+
+from app import constraints as constraints_module
+from app.DB import Constraints
+from app.DB.Cache import TTLCache
+from app.DB.Constraints import constraint_document
+from app.Models.Constraint import ConstraintType, EventStageConstraint, EventTime, EventTimeConstraint
+from app.Models.Event import Stage, stored_values
+from app.constraints import ConstraintGraph, constraint_added, get_graph
+
+OWNER = 'owner'
+NOW = datetime(2024, 1, 1, 12)
+
+
+def event_ids(count: int):
+    return [str(ObjectId()) for _ in range(count)]
+
+
+def graph_of(*event_ids: str, complete=()) -> ConstraintGraph:
+    graph = ConstraintGraph()
+    for event_id in event_ids:
+        graph.set_event({'_id': event_id, 'stage': Stage.complete if event_id in complete else Stage.started})
+    return graph
+
+
+def wait_on(graph: ConstraintGraph, event_id: str, prerequisite_id: str):
+    constraint = EventStageConstraint(event_id=prerequisite_id, name="Waits on event", _id=str(ObjectId()))
+    graph.add_constraint(constraint_document(OWNER, event_id, constraint.dict()))
+
+
+def time_window(start: datetime, end: datetime) -> EventTimeConstraint:
+    return EventTimeConstraint(**EventTime(start_time=start, end_time=end).dict(), name="Time window",
+                               _id=str(ObjectId()))
+
+
+def test_time_constraint_is_created_and_evaluated():
+    event_id, = event_ids(1)
+    graph = graph_of(event_id)
+    constraint = time_window(NOW, NOW + timedelta(hours=1))
+    assert constraint.constraint_type == ConstraintType.time and not constraint.all_day
+    graph.add_constraint(constraint_document(OWNER, event_id, constraint.dict()))
+    assert graph.unblocked(NOW - timedelta(seconds=1)) == []
+    assert graph.unblocked(NOW) == [event_id]
+    assert graph.unblocked(NOW + timedelta(hours=1)) == []
+
+
+def test_time_window_must_end_after_start():
+    with pytest.raises(ValidationError):
+        EventTime(start_time=NOW, end_time=NOW)
+
+
+def test_stage_constraint_blocks_until_complete():
+    first, second = event_ids(2)
+    graph = graph_of(first, second)
+    wait_on(graph, second, first)
+    assert graph.unblocked(NOW) == [first]
+    graph.set_event({'_id': first, 'stage': Stage.complete})
+    assert graph.unblocked(NOW) == [second]
+    graph.set_event({'_id': first, 'stage': Stage.started})
+    assert graph.unblocked(NOW) == [first]
+
+
+def test_deleted_prerequisite_keeps_blocking():
+    first, second = event_ids(2)
+    graph = graph_of(first, second, complete={first})
+    wait_on(graph, second, first)
+    assert graph.unblocked(NOW) == [second]
+    graph.remove_event(first)
+    assert graph.unblocked(NOW) == []
+
+
+def test_would_cycle():
+    first, second, third = event_ids(3)
+    graph = graph_of(first, second, third)
+    wait_on(graph, second, first)
+    wait_on(graph, third, second)
+    assert graph.would_cycle(first, third)
+    assert graph.would_cycle(first, first)
+    assert not graph.would_cycle(third, first)
+
+
+def test_cycles():
+    a, b, c, d, e, f = event_ids(6)
+    graph = graph_of(a, b, c, d, e, f)
+    # a -> b -> c -> a, d waits on the cycle, e waits on itself, f is free
+    for event_id, prerequisite_id in ((a, b), (b, c), (c, a), (d, a), (e, e)):
+        wait_on(graph, event_id, prerequisite_id)
+    assert sorted(graph.cycles()) == sorted([sorted([a, b, c]), [e]])
+    assert graph.unblocked(NOW) == [f]
+    graph.remove_constraint(next(iter(graph.constraints[c].values())))
+    assert sorted(graph.cycles()) == [[e]]
+    assert graph.unblocked(NOW) == sorted([c, f])
+
+
+def test_cycles_on_a_long_chain():
+    chain = event_ids(5000)
+    graph = graph_of(*chain)
+    for event_id, prerequisite_id in zip(chain, chain[1:]):
+        wait_on(graph, event_id, prerequisite_id)
+    assert graph.cycles() == []
+    wait_on(graph, chain[-1], chain[0])
+    assert graph.cycles() == [sorted(chain)]
+
+
+class StoredCollection:
+    """find over a list of stored documents, enough for get_graph."""
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    async def _cursor(self):
+        for document in self.documents:
+            yield document
+
+    def find(self, query, *args, **kwargs):
+        return self._cursor()
+
+
+def test_unblocked_reflects_stored_time_constraints(monkeypatch):
+    waiting, later, free = event_ids(3)
+    events = [{'_id': ObjectId(event_id), 'stage': Stage.started} for event_id in (waiting, later, free)]
+    # Sent with an offset, stored and read back as naive UTC
+    window = EventTime(start_time='2024-01-01T15:00:00+02:00', end_time='2024-01-01T17:00:00+02:00')
+    constraints = [stored_values(constraint_document(OWNER, waiting, time_window(window.start_time,
+                                                                                 window.end_time).dict()))]
+    collections = {'events': StoredCollection(events), Constraints.COLLECTION: StoredCollection(constraints)}
+    monkeypatch.setattr(constraints_module, 'get_collection', collections.get)
+    monkeypatch.setattr(constraints_module, 'graph_cache', TTLCache(10, 300))
+
+    graph = asyncio.run(get_graph(OWNER))
+    assert graph.unblocked(NOW) == sorted([later, free])
+    assert graph.unblocked(NOW + timedelta(minutes=90)) == sorted([waiting, later, free])
+    constraint_added(OWNER, constraint_document(OWNER, later, time_window(NOW - timedelta(hours=1), NOW).dict()))
+    assert asyncio.run(get_graph(OWNER)).unblocked(NOW + timedelta(minutes=90)) == sorted([waiting, free])
+
+
+EVENT = {"name": "standup", "description": "daily", "tags": [{"tag": "work"}],
+         "time_details": {"start_time": "2024-01-01T09:00:00", "end_time": "2024-01-01T10:00:00"},
+         "presentation": {"color": "red"}}
+
+
+def add_event(client, headers) -> str:
+    response = client.post('/events/events/', json=EVENT, headers=headers)
+    response.raise_for_status()
+    return response.json()['_id']
+
+
+def test_generic_route_adds_each_type(client, headers):
+    first, second = add_event(client, headers), add_event(client, headers)
+    now = datetime.utcnow()
+    bodies = [
+        {'name': "after first", 'constraint_type': 'EventStageConstraint', 'event_id': first},
+        {'name': "soon", 'constraint_type': 'EventTimeConstraint',
+         'start_time': (now + timedelta(hours=1)).isoformat(), 'end_time': (now + timedelta(hours=2)).isoformat()},
+        {'name': "blue", 'constraint_type': 'EventColorConstraint', 'color': 'blue'},
+    ]
+    created = []
+    for body in bodies:
+        response = client.post(f'/events/{second}/constraint', json=body, headers=headers)
+        assert response.status_code == 200, response.text
+        created.append(response.json())
+    assert [constraint['constraint_type'] for constraint in created] == [body['constraint_type'] for body in bodies]
+    assert created[0]['event_id'] == first and created[2]['color'] == '#00f'
+    stored = client.get(f'/events/{second}/constraint', headers=headers).json()
+    assert [constraint['_id'] for constraint in stored] == [constraint['_id'] for constraint in created]
+    assert stored[0]['prerequisite_id'] == first
+    assert client.get('/events/constraint/unblocked', headers=headers).json() == [first]
+
+
+@pytest.mark.parametrize('body', [
+    {'name': "window", 'constraint_type': 'EventTimeConstraint'},
+    {'name': "window", 'constraint_type': 'EventTimeConstraint', 'start_time': '2024-01-02T00:00:00',
+     'end_time': '2024-01-01T00:00:00'},
+    {'name': "stage", 'constraint_type': 'EventStageConstraint', 'color': 'blue'},
+    {'name': "unknown", 'constraint_type': 'EventSizeConstraint'},
+])
+def test_generic_route_refuses_incomplete_constraints(client, headers, body):
+    event_id = add_event(client, headers)
+    assert client.post(f'/events/{event_id}/constraint', json=body, headers=headers).status_code == 422
+
+
+def test_generic_route_refuses_cycles(client, headers):
+    first, second = add_event(client, headers), add_event(client, headers)
+    body = {'name': "wait", 'constraint_type': 'EventStageConstraint'}
+    assert client.post(f'/events/{second}/constraint', json={**body, 'event_id': first},
+                       headers=headers).status_code == 200
+    response = client.post(f'/events/{first}/constraint', json={**body, 'event_id': second}, headers=headers)
+    assert response.status_code == 422 and response.json()['detail'] == "Constraint would create a cycle"
+
+
+def test_date_route_blocks_outside_window(client, headers):
+    event_id = add_event(client, headers)
+    now = datetime.utcnow()
+    window = {'start_time': (now - timedelta(hours=1)).isoformat() + '+00:00',
+              'end_time': (now + timedelta(hours=1)).isoformat() + '+00:00'}
+    response = client.post(f'/events/{event_id}/constraint/date', json=window, headers=headers)
+    assert response.status_code == 200 and response.json()['constraint_type'] == 'EventTimeConstraint'
+    assert client.get('/events/constraint/unblocked', headers=headers).json() == [event_id]
+    later = {'start_time': (now + timedelta(hours=1)).isoformat(), 'end_time': (now + timedelta(hours=2)).isoformat()}
+    client.post(f'/events/{event_id}/constraint/date', json=later, headers=headers).raise_for_status()
+    assert client.get('/events/constraint/unblocked', headers=headers).json() == []
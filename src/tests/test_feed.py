@@ -0,0 +1,31 @@
+import asyncio
+
+from bson import ObjectId
+
+from app.feed import LocalFeed, RESYNC, Subscription, change_message
+
+OWNER = 'owner'
+
+
+def test_publish_many_delivers_in_order():
+    feed = LocalFeed()
+    assert not feed.listened(OWNER)
+    subscription = feed.subscribe(OWNER)
+    other = feed.subscribe('other')
+    assert feed.listened(OWNER)
+    event = {'_id': ObjectId(), 'name': "standup", 'owner_id': OWNER, 'version': 2}
+    messages = [change_message('updated', event['_id'], 2, event), change_message('deleted', event['_id'], 2)]
+    asyncio.run(feed.publish_many(OWNER, messages))
+    assert [subscription.queue.get_nowait() for _ in range(2)] == messages
+    assert messages[0]['event'] == {'_id': str(event['_id']), 'name': "standup"}
+    assert other.queue.empty()
+    feed.unsubscribe(subscription)
+    assert not feed.listened(OWNER)
+
+
+def test_slow_subscriber_gets_resync():
+    subscription = Subscription(OWNER, maxsize=2)
+    for version in range(3):
+        subscription.offer(change_message('updated', ObjectId(), version))
+    assert subscription.queue.qsize() == 1 and subscription.queue.get_nowait() == RESYNC
+    assert subscription.dropped == 2
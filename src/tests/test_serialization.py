@@ -0,0 +1,37 @@
+from datetime import datetime
+
+import orjson
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+
+from app.Models.Event import EventResponse, NewEventInDB, PartialEventResponse, Stage, event_response, \
+    stored_values
+
+
+def stored_event(**fields) -> dict:
+    event = NewEventInDB(name="standup", description="daily", tags=[{'tag': 'work'}],
+                         time_details={'start_time': datetime(2024, 1, 1, 9, 30, 0, 123000),
+                                       'end_time': datetime(2024, 1, 1, 10)},
+                         presentation={'color': 'red'}, stage=Stage.started, owner_id=str(ObjectId()), **fields)
+    return {**stored_values(event.dict()), '_id': ObjectId(), 'version': 2}
+
+
+def validated(event: dict, model=EventResponse) -> dict:
+    """What the response used to be: the document validated against the response model, then encoded."""
+    return orjson.loads(orjson.dumps(jsonable_encoder(model(**event), by_alias=True, exclude_unset=True)))
+
+
+def test_event_response_matches_response_model():
+    event = stored_event()
+    response = orjson.loads(orjson.dumps(event_response(event)))
+    assert response == validated(event)
+    assert 'owner_id' not in response and 'version' not in response
+
+
+def test_sparse_event_response_matches_response_model():
+    event = stored_event()
+    fields = ('name', 'time_details')
+    response = orjson.loads(orjson.dumps(event_response(event, fields)))
+    assert set(response) == {'_id', 'name', 'time_details'}
+    partial = {'_id': str(event['_id']), **{field: event[field] for field in fields}}
+    assert response == validated(partial, PartialEventResponse)
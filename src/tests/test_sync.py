@@ -0,0 +1,31 @@
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException
+
+from app.Models.Event import utc_now
+from app.Routes.Event import parse_range_cursor, sync_token
+
+EVENT_ID = ObjectId()
+
+
+def test_token_round_trip():
+    updated_at = datetime(2024, 1, 1, 12, 30, 15, 250000)
+    assert parse_range_cursor(sync_token(updated_at, EVENT_ID)) == (updated_at, EVENT_ID)
+
+
+@pytest.mark.parametrize('sent', ['2024-01-01T02:00:00+02:00', '2024-01-01T00:00:00+00:00',
+                                  '2023-12-31T19:00:00-05:00'])
+def test_offset_token_is_naive_utc(sent):
+    updated_at, event_id = parse_range_cursor(f"{sent}_{EVENT_ID}")
+    assert (updated_at, event_id) == (datetime(2024, 1, 1), EVENT_ID)
+    # get_event_changes compares it with naive UTC
+    assert updated_at < utc_now() - timedelta(days=1)
+
+
+@pytest.mark.parametrize('token', ['2024-01-01T00:00:00', 'yesterday_' + str(EVENT_ID), '2024-01-01T00:00:00_xyz'])
+def test_invalid_token(token):
+    with pytest.raises(HTTPException) as error:
+        parse_range_cursor(token)
+    assert error.value.status_code == 422